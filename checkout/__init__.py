@@ -1,3 +1,5 @@
 # -*- encoding: utf-8 -*-
 
 from __future__ import unicode_literals
+
+default_app_config = 'checkout.apps.CheckoutConfig'
@@ -0,0 +1,89 @@
+# -*- encoding: utf-8 -*-
+from django.apps import AppConfig
+from django.core.signals import (
+    request_started,
+    setting_changed,
+)
+from django.db.models.signals import (
+    post_delete,
+    post_migrate,
+    post_save,
+)
+
+
+def _warm_cache(**kwargs):
+    """Load the lookup tables on the first request (and only the first)."""
+    from .models import (
+        CheckoutAction,
+        CheckoutState,
+    )
+    request_started.disconnect(_warm_cache, dispatch_uid='checkout_warm_cache')
+    CheckoutAction.objects.warm_cache()
+    CheckoutState.objects.warm_cache()
+
+
+class CheckoutConfig(AppConfig):
+
+    name = 'checkout'
+    verbose_name = 'Checkout'
+
+    def ready(self):
+        """Keep the lookup cache (see ``LookupManager``), the payment plan
+        cache and the notification email addresses up to date.  Put back the
+        lookup rows after a flush (see ``create_lookups``).
+
+        We don't query the database here (the tables might not exist yet), so
+        the cache is warmed by the first request.
+
+        """
+        from mail.models import Notify
+        from .gateway import reset_gateway
+        from .models import (
+            CheckoutAction,
+            CheckoutSettings,
+            CheckoutState,
+            clear_lookup_cache,
+            clear_notify_cache,
+            clear_payment_plan_cache,
+            create_lookups,
+            PaymentPlan,
+        )
+        for model in (CheckoutAction, CheckoutState):
+            uid = 'checkout_clear_lookup_cache_{}'.format(model.__name__)
+            post_save.connect(clear_lookup_cache, sender=model, dispatch_uid=uid)
+            post_delete.connect(clear_lookup_cache, sender=model, dispatch_uid=uid)
+        for model in (CheckoutSettings, PaymentPlan):
+            uid = 'checkout_clear_payment_plan_cache_{}'.format(model.__name__)
+            post_save.connect(
+                clear_payment_plan_cache, sender=model, dispatch_uid=uid
+            )
+            post_delete.connect(
+                clear_payment_plan_cache, sender=model, dispatch_uid=uid
+            )
+        post_save.connect(
+            clear_notify_cache,
+            sender=Notify,
+            dispatch_uid='checkout_clear_notify_cache'
+        )
+        post_delete.connect(
+            clear_notify_cache,
+            sender=Notify,
+            dispatch_uid='checkout_clear_notify_cache'
+        )
+        post_migrate.connect(
+            clear_lookup_cache,
+            dispatch_uid='checkout_clear_lookup_cache_migrate'
+        )
+        post_migrate.connect(
+            create_lookups,
+            sender=self,
+            dispatch_uid='checkout_create_lookups'
+        )
+        setting_changed.connect(
+            reset_gateway,
+            dispatch_uid='checkout_reset_gateway'
+        )
+        request_started.connect(
+            _warm_cache,
+            dispatch_uid='checkout_warm_cache'
+        )
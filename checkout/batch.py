@@ -0,0 +1,65 @@
+# -*- encoding: utf-8 -*-
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+
+class RateLimiter(object):
+    """Limit the number of calls per second (shared between threads).
+
+    Call ``wait`` before each request.  If ``per_second`` is ``None``, there
+    is no limit.
+
+    """
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def batches(items, count):
+    """Split ``items`` into (at most) ``count`` lists of a similar size."""
+    count = max(1, min(count, len(items)))
+    return [items[i::count] for i in range(count)]
+
+
+def chunks(items, size):
+    """Split ``items`` into lists of (at most) ``size`` items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def run_in_threads(func, items, workers):
+    """Split ``items`` into batches and call ``func`` for each batch.
+
+    If ``workers`` is more than one, the batches are processed by a pool of
+    threads (one batch per thread).  Each thread has its own database
+    connection, so we close it when the batch is complete.
+
+    Returns a list containing the result of each call to ``func``.
+
+    """
+    if workers < 2:
+        return [func(items)]
+
+    def _run(batch):
+        try:
+            return func(batch)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_run, batches(items, workers)))
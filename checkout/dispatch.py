@@ -0,0 +1,73 @@
+# -*- encoding: utf-8 -*-
+"""Queue the checkout tasks.
+
+The mail is queued by a celery task (so the customer doesn't wait for it) and
+requests to process the mail queue are combined (see ``process_mail``).
+
+The tasks read the checkout from the database, so call these functions after
+the transaction has committed (i.e. outside ``transaction.atomic``).  Django
+1.8 doesn't have ``transaction.on_commit``, so we can't wait for the commit.
+
+Requests are combined using the cache, so the cache must be shared by all the
+processes (e.g. ``django_redis.cache.RedisCache``).  The default cache
+(``LocMemCache``) is per process, so each process would queue its own task.
+
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from mail.tasks import process_mail as process_mail_task
+
+
+PROCESS_MAIL_CACHE_KEY = 'checkout_process_mail'
+PROCESS_STRIPE_EVENTS_CACHE_KEY = 'checkout_process_stripe_events'
+
+
+def notify(checkout, request=None):
+    """Queue the notification email for ``checkout``."""
+    # import here to avoid a circular import
+    from .tasks import notify as notify_task
+    url = None
+    if request:
+        url = request.build_absolute_uri(checkout.content_object_url)
+    notify_task.delay(checkout.pk, url)
+
+
+def process_checkout(checkout, token, request):
+    """Take the payment for ``checkout`` in a celery task.
+
+    Used when ``CHECKOUT_ASYNC`` is set (see ``CheckoutMixin``).
+
+    """
+    # import here to avoid a circular import
+    from .tasks import process_checkout as process_checkout_task
+    url = request.build_absolute_uri(checkout.content_object_url)
+    user_pk = request.user.pk
+    process_checkout_task.delay(checkout.pk, token, user_pk, url)
+
+
+def process_mail():
+    """Process the mail queue (at most once every few seconds).
+
+    The first request starts a timer (``CHECKOUT_PROCESS_MAIL_SECONDS``).
+    Any mail queued before the timer runs out is sent by the same task.
+
+    """
+    seconds = getattr(settings, 'CHECKOUT_PROCESS_MAIL_SECONDS', 10)
+    if cache.add(PROCESS_MAIL_CACHE_KEY, True, seconds):
+        process_mail_task.apply_async(countdown=seconds)
+
+
+def process_stripe_events():
+    """Apply the Stripe webhook events (at most once every few seconds).
+
+    The events which arrive before the timer
+    (``CHECKOUT_PROCESS_STRIPE_EVENTS_SECONDS``) runs out are applied as one
+    batch (see ``process_mail``).
+
+    """
+    # import here to avoid a circular import
+    from .tasks import process_stripe_events as process_stripe_events_task
+    seconds = getattr(settings, 'CHECKOUT_PROCESS_STRIPE_EVENTS_SECONDS', 10)
+    if cache.add(PROCESS_STRIPE_EVENTS_CACHE_KEY, True, seconds):
+        process_stripe_events_task.apply_async(countdown=seconds)
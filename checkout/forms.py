@@ -32,7 +32,7 @@ class CheckoutForm(forms.ModelForm):
     def _action_choices(self, actions):
         result = []
         for item in actions:
-            obj = CheckoutAction.objects.get(slug=item)
+            obj = CheckoutAction.objects.lookup(item)
             result.append((item, obj.name))
         return result
 
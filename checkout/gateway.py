@@ -0,0 +1,406 @@
+# -*- encoding: utf-8 -*-
+"""Payment gateways.
+
+All the payment requests go through one gateway object (see ``gateway``).
+The class is set by ``CHECKOUT_PAYMENT_GATEWAY``:
+
+- ``StripeGateway`` (the default) shares a pool of (keep-alive) connections
+  to the Stripe API and doesn't set the global ``stripe.api_key``.
+- ``FakeGateway`` doesn't talk to Stripe.  Use it for load testing.
+
+Charges are created with an idempotency key (see ``charge_create_retry``), so
+a request which fails with a network error can be retried without charging
+the card twice.
+
+"""
+import random
+import threading
+import time
+import uuid
+
+import requests
+import stripe
+
+from requests.adapters import HTTPAdapter
+from stripe.api_requestor import APIRequestor
+from urllib.parse import quote_plus
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+class PooledHTTPClient(stripe.http_client.HTTPClient):
+    """A Stripe HTTP client which re-uses connections.
+
+    The ``requests`` session is shared between threads.  ``pool_size`` is the
+    maximum number of connections kept open to the Stripe API.
+
+    """
+
+    name = 'requests'
+
+    def __init__(self, timeout, pool_size, verify_ssl_certs=True):
+        super().__init__(verify_ssl_certs=verify_ssl_certs)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, headers, post_data=None):
+        try:
+            result = self.session.request(
+                method,
+                url,
+                headers=headers,
+                data=post_data,
+                timeout=self.timeout,
+                verify=self._verify_ssl_certs,
+            )
+        except requests.exceptions.RequestException as e:
+            raise stripe.APIConnectionError(
+                'Unexpected error communicating with Stripe: {}'.format(e)
+            ) from e
+        return result.content, result.status_code, result.headers
+
+
+def _is_transient(e):
+    """Might the request succeed if we try again?
+
+    A network error, a rate limit (429) or an error on the Stripe servers.
+
+    """
+    if isinstance(e, stripe.APIConnectionError):
+        return True
+    return bool(e.http_status) and (
+        e.http_status == 429 or e.http_status >= 500
+    )
+
+
+def customer_card_expiry(customer):
+    """The expiry ``(year, month)`` of the default card for a Stripe customer.
+
+    ``customer`` is a ``stripe.Customer`` (or the customer in a webhook event).
+    Returns ``(0, 0)`` if the customer doesn't have a default card.
+
+    """
+    result = (0, 0)
+    default_card = customer.get('default_card') or customer.get(
+        'default_source'
+    )
+    cards = customer.get('cards') or customer.get('sources') or {}
+    # find the details of the default card
+    for card in cards.get('data', []):
+        if card['id'] == default_card:
+            # find the expiry date of the default card
+            result = (int(card['exp_year']), int(card['exp_month']))
+            break
+    return result
+
+
+class BaseGateway(object):
+    """The charge and customer API used by the checkout models.
+
+    A gateway is shared between threads.  The methods return (and raise) the
+    same objects (and exceptions) as the ``stripe`` library.
+
+    """
+
+    def charge_create(self, **kwargs):
+        raise NotImplementedError
+
+    def charge_create_retry(self, idempotency_key, retries=None, **kwargs):
+        """Create a charge and retry if the error is transient.
+
+        Stripe returns the original charge if a request is repeated with the
+        same ``idempotency_key``, so a retry will never charge the card twice
+        (even if the first request reached Stripe before the connection was
+        lost).
+
+        ``CHECKOUT_STRIPE_RETRIES`` is the number of retries and the delay
+        (``CHECKOUT_STRIPE_RETRY_SECONDS``) doubles after each one.
+
+        """
+        if retries is None:
+            retries = getattr(settings, 'CHECKOUT_STRIPE_RETRIES', 3)
+        delay = getattr(settings, 'CHECKOUT_STRIPE_RETRY_SECONDS', 0.5)
+        attempt = 0
+        while True:
+            try:
+                return self.charge_create(
+                    idempotency_key=idempotency_key, **kwargs
+                )
+            except stripe.StripeError as e:
+                if _is_transient(e) and attempt < retries:
+                    time.sleep(delay * 2 ** attempt)
+                    attempt = attempt + 1
+                else:
+                    raise
+
+    def charge_list(self, customer_id, created=None):
+        """The charges for a customer (since ``created``, a unix timestamp)."""
+        raise NotImplementedError
+
+    def charge_find(self, customer_id, checkout_pk, created=None):
+        """Find the charge for a checkout (using the charge metadata).
+
+        Returns ``None`` if the charge didn't reach Stripe.
+
+        """
+        for charge in self.charge_list(customer_id, created):
+            metadata = charge.get('metadata') or {}
+            if str(metadata.get('checkout_pk')) == str(checkout_pk):
+                return charge
+        return None
+
+    def customer_create(self, **kwargs):
+        raise NotImplementedError
+
+    def customer_retrieve(self, customer_id):
+        raise NotImplementedError
+
+    def customer_update(self, customer_id, **kwargs):
+        raise NotImplementedError
+
+    def card_expiry(self, customer_id):
+        """The expiry ``(year, month)`` of the default card for a customer.
+
+        Returns ``(0, 0)`` if the customer doesn't have a default card.
+
+        """
+        return customer_card_expiry(self.customer_retrieve(customer_id))
+
+
+class StripeGateway(BaseGateway):
+    """The Stripe API.
+
+    The API key is sent with each request, so the gateway can be used by
+    several threads at the same time.
+
+    The requests are sent using our own ``APIRequestor`` (with the pooled
+    client), because the ``stripe`` resource methods (e.g.
+    ``stripe.Charge.create``) always create a new HTTP client.
+
+    """
+
+    def __init__(self, api_key=None, timeout=None, pool_size=None):
+        if api_key is None:
+            api_key = settings.STRIPE_SECRET_KEY
+        if timeout is None:
+            timeout = getattr(settings, 'CHECKOUT_STRIPE_TIMEOUT', 30)
+        if pool_size is None:
+            pool_size = getattr(settings, 'CHECKOUT_STRIPE_POOL_SIZE', 10)
+        self.api_key = api_key
+        self.client = PooledHTTPClient(timeout, pool_size)
+
+    def _customer_url(self, customer_id):
+        return '{}/{}'.format(
+            stripe.Customer.class_url(), quote_plus(customer_id)
+        )
+
+    def _request(self, method, url, params=None, idempotency_key=None):
+        """Send a request to Stripe (using the pooled client)."""
+        requestor = APIRequestor(self.api_key, client=self.client)
+        headers = None
+        if idempotency_key:
+            headers = {'Idempotency-Key': idempotency_key}
+        response, api_key = requestor.request(method, url, params, headers)
+        return response
+
+    def charge_create(self, idempotency_key=None, **kwargs):
+        response = self._request(
+            'post', stripe.Charge.class_url(), kwargs, idempotency_key
+        )
+        return stripe.Charge.construct_from(response, self.api_key)
+
+    def charge_list(self, customer_id, created=None):
+        params = dict(customer=customer_id, limit=100)
+        if created:
+            params.update(created={'gte': created})
+        response = self._request('get', stripe.Charge.class_url(), params)
+        return [
+            stripe.Charge.construct_from(item, self.api_key)
+            for item in response['data']
+        ]
+
+    def customer_create(self, **kwargs):
+        response = self._request(
+            'post', stripe.Customer.class_url(), kwargs
+        )
+        return stripe.Customer.construct_from(response, self.api_key)
+
+    def customer_retrieve(self, customer_id):
+        response = self._request('get', self._customer_url(customer_id))
+        return stripe.Customer.construct_from(response, self.api_key)
+
+    def customer_update(self, customer_id, **kwargs):
+        response = self._request(
+            'post', self._customer_url(customer_id), kwargs
+        )
+        return stripe.Customer.construct_from(response, self.api_key)
+
+
+class FakeGateway(BaseGateway):
+    """An in-memory gateway for load testing (no requests to Stripe).
+
+    Settings:
+
+    - ``CHECKOUT_FAKE_GATEWAY_LATENCY``: seconds to wait for each request.
+    - ``CHECKOUT_FAKE_GATEWAY_DECLINE_RATE``: fraction of charges which fail
+      with a ``stripe.CardError``.
+    - ``CHECKOUT_FAKE_GATEWAY_RATE_LIMIT_RATE``: fraction of requests which
+      fail with a ``stripe.StripeError`` (HTTP status 429).
+    - ``CHECKOUT_FAKE_GATEWAY_SEED``: seed for the random number generator
+      (so a test run can be repeated).
+
+    Customers have a default card which expires in ``EXPIRY_YEAR``.  A charge
+    with the same ``idempotency_key`` as an earlier charge returns the earlier
+    charge (as Stripe does).
+
+    """
+
+    EXPIRY_YEAR = 2050
+
+    def __init__(self, latency=None, decline_rate=None, rate_limit_rate=None,
+                 seed=None):
+        def _setting(value, name, default):
+            if value is None:
+                value = getattr(settings, name, default)
+            return value
+        self.latency = _setting(latency, 'CHECKOUT_FAKE_GATEWAY_LATENCY', 0)
+        self.decline_rate = _setting(
+            decline_rate, 'CHECKOUT_FAKE_GATEWAY_DECLINE_RATE', 0
+        )
+        self.rate_limit_rate = _setting(
+            rate_limit_rate, 'CHECKOUT_FAKE_GATEWAY_RATE_LIMIT_RATE', 0
+        )
+        self.random = random.Random(
+            _setting(seed, 'CHECKOUT_FAKE_GATEWAY_SEED', None)
+        )
+        self.lock = threading.Lock()
+        self.charges = []
+        self.customers = {}
+        self.idempotent_charges = {}
+
+    def _chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def _request(self):
+        """Simulate the latency and rate limit of a request to Stripe."""
+        if self.latency:
+            time.sleep(self.latency)
+        if self._chance(self.rate_limit_rate):
+            raise stripe.StripeError(
+                'Too many requests hit the API too quickly.',
+                http_status=429,
+            )
+
+    def _new_id(self, prefix):
+        return '{}_{}'.format(prefix, uuid.uuid4().hex)
+
+    def charge_create(self, idempotency_key=None, **kwargs):
+        self._request()
+        with self.lock:
+            if idempotency_key in self.idempotent_charges:
+                return self.idempotent_charges[idempotency_key]
+        if self._chance(self.decline_rate):
+            raise stripe.CardError(
+                'Your card was declined.',
+                None,
+                'card_declined',
+                http_status=402,
+            )
+        charge = stripe.Charge.construct_from(
+            dict(id=self._new_id('ch'), paid=True, **kwargs), None
+        )
+        with self.lock:
+            self.charges.append(charge)
+            if idempotency_key:
+                self.idempotent_charges[idempotency_key] = charge
+        return charge
+
+    def charge_list(self, customer_id, created=None):
+        self._request()
+        with self.lock:
+            return [
+                charge for charge in self.charges
+                if charge.get('customer') == customer_id
+            ]
+
+    def _customer(self, customer_id, **kwargs):
+        card_id = self._new_id('card')
+        kwargs.pop('card', None)
+        customer = stripe.Customer.construct_from(
+            dict(
+                id=customer_id,
+                default_card=card_id,
+                cards=dict(data=[dict(
+                    id=card_id,
+                    exp_month=12,
+                    exp_year=self.EXPIRY_YEAR,
+                )]),
+                **kwargs
+            ),
+            None
+        )
+        self.customers[customer_id] = customer
+        return customer
+
+    def customer_create(self, **kwargs):
+        self._request()
+        with self.lock:
+            return self._customer(self._new_id('cus'), **kwargs)
+
+    def customer_retrieve(self, customer_id):
+        """Customers who aren't in memory are created (for load testing with
+        customers from the database).
+
+        """
+        self._request()
+        with self.lock:
+            try:
+                return self.customers[customer_id]
+            except KeyError:
+                return self._customer(customer_id)
+
+    def customer_update(self, customer_id, **kwargs):
+        customer = self.customer_retrieve(customer_id)
+        kwargs.pop('card', None)
+        for name, value in kwargs.items():
+            setattr(customer, name, value)
+        return customer
+
+
+def gateway():
+    """The payment gateway for this process (created on first use).
+
+    The class is set by ``CHECKOUT_PAYMENT_GATEWAY``.
+
+    """
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                path = getattr(
+                    settings,
+                    'CHECKOUT_PAYMENT_GATEWAY',
+                    'checkout.gateway.StripeGateway'
+                )
+                _gateway = import_string(path)()
+    return _gateway
+
+
+def reset_gateway(setting=None, **kwargs):
+    """Create a new gateway on next use (e.g. when a test changes settings).
+
+    Connected to the ``setting_changed`` signal in ``checkout.apps``.
+
+    """
+    global _gateway
+    if setting is None or setting.startswith(('CHECKOUT_', 'STRIPE_')):
+        with _gateway_lock:
+            _gateway = None
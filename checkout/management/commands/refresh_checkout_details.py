@@ -0,0 +1,19 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from checkout.models import (
+    Checkout,
+    ObjectPaymentPlan,
+    refresh_checkout_details,
+)
+
+
+class Command(BaseCommand):
+
+    help = "Copy the email address and name from the checkout content objects"
+
+    def handle(self, *args, **options):
+        for model in (Checkout, ObjectPaymentPlan):
+            count = refresh_checkout_details(model.objects.all())
+            print("Updated {} {} rows...".format(count, model.__name__))
+        print("Refreshed checkout details...")
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0004_auto_20150907_1607'),
+    ]
+
+    operations = [
+        migrations.RenameModel(
+            old_name='CheckoutInvoice',
+            new_name='CheckoutAdditional',
+        ),
+        migrations.AlterModelOptions(
+            name='checkoutadditional',
+            options={'verbose_name': 'Checkout Additional Information', 'ordering': ('email',), 'verbose_name_plural': 'Checkout Additional Information'},
+        ),
+        migrations.AddField(
+            model_name='checkoutadditional',
+            name='date_of_birth',
+            field=models.DateField(null=True, blank=True),
+        ),
+    ]
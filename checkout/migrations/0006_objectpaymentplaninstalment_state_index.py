@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0005_checkoutadditional'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='objectpaymentplaninstalment',
+            index_together=set([('state', 'object_payment_plan')]),
+        ),
+    ]
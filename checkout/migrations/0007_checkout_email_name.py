@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    """The details for the existing rows are copied from the content objects
+    by the ``refresh_checkout_details`` management command (a migration can
+    only use the historical models, which don't have ``checkout_email``).
+
+    """
+
+    dependencies = [
+        ('checkout', '0006_objectpaymentplaninstalment_state_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkout',
+            name='checkout_email',
+            field=models.EmailField(max_length=254, db_index=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='checkout',
+            name='checkout_name',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='objectpaymentplan',
+            name='checkout_email',
+            field=models.EmailField(max_length=254, db_index=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='objectpaymentplan',
+            name='checkout_name',
+            field=models.TextField(blank=True),
+        ),
+    ]
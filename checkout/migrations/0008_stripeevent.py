@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0007_checkout_email_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('event_id', models.CharField(max_length=255, unique=True)),
+                ('event_type', models.CharField(max_length=255)),
+                ('data', models.TextField()),
+                ('processed', models.BooleanField(default=False, db_index=True)),
+            ],
+            options={
+                'ordering': ('pk',),
+                'verbose_name': 'Stripe event',
+                'verbose_name_plural': 'Stripe events',
+            },
+        ),
+    ]
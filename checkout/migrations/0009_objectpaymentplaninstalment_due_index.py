@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+INDEX_NAME = 'checkout_objectpaymentplaninstalment_due_pending'
+
+
+def create_index(apps, schema_editor):
+    """Index the instalments for ``ObjectPaymentPlanInstalmentManager.due``.
+
+    The deposit is never in the list, so PostgreSQL (and SQLite) use a partial
+    index.  Other databases get the index on ``(state_id, due)``.
+
+    """
+    where = ''
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        where = ' WHERE NOT deposit'
+    schema_editor.execute(
+        'CREATE INDEX {} ON checkout_objectpaymentplaninstalment '
+        '(state_id, due){}'.format(INDEX_NAME, where)
+    )
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        sql = 'DROP INDEX {} ON checkout_objectpaymentplaninstalment'
+    else:
+        sql = 'DROP INDEX {}'
+    schema_editor.execute(sql.format(INDEX_NAME))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0008_stripeevent'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
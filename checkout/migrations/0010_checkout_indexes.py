@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0009_objectpaymentplaninstalment_due_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='checkout',
+            name='checkout_date',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='checkout',
+            index_together=set([('content_type', 'object_id'), ('state', 'checkout_date'), ('state', 'id')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0011_stripeevent_error'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='objectpaymentplaninstalment',
+            name='reconcile_count',
+            field=models.IntegerField(default=0, help_text='Number of times reconcile found no checkout'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import uuid
+
+from django.db import models, migrations
+
+
+def set_uuid(apps, schema_editor):
+    """A different ``uuid`` for each of the existing checkouts."""
+    model = apps.get_model('checkout', 'Checkout')
+    pks = list(model.objects.values_list('pk', flat=True))
+    for pk in pks:
+        model.objects.filter(pk=pk).update(uuid=uuid.uuid4())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0012_objectpaymentplaninstalment_reconcile_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkout',
+            name='uuid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(set_uuid, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='checkout',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0013_checkout_uuid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='objectpaymentplan',
+            name='customer',
+            field=models.ForeignObject(to='checkout.Customer', related_name='+', serialize=False, null=True, from_fields=['checkout_email'], to_fields=['email']),
+        ),
+    ]
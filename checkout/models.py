@@ -1,24 +1,46 @@
 # -*- encoding: utf-8 -*-
+import json
 import logging
+import time
+import uuid
 
-from datetime import date
+from collections import (
+    Counter,
+    defaultdict,
+)
+from datetime import (
+    date,
+    datetime,
+)
 from dateutil.relativedelta import relativedelta
 from dateutil.rrule import (
     MONTHLY,
     rrule,
 )
 from decimal import Decimal
+from functools import lru_cache
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.db import (
+    DEFAULT_DB_ALIAS,
+    IntegrityError,
     models,
+    OperationalError,
     transaction,
 )
+from django.db.models import (
+    Case,
+    F,
+    Prefetch,
+    Value,
+    When,
+)
 from django.utils import timezone
 
 import reversion
@@ -32,9 +54,57 @@ from mail.service import (
     queue_mail_template,
 )
 
+from .batch import (
+    chunks,
+    RateLimiter,
+    run_in_threads,
+)
+from .gateway import (
+    customer_card_expiry,
+    gateway,
+)
+
 
 CURRENCY = 'GBP'
 logger = logging.getLogger(__name__)
+# rows from the lookup tables e.g. 'CheckoutState' (see 'LookupManager')
+_lookup_cache = {}
+
+
+def _add_to_revision(model, objs):
+    """Add records created by ``bulk_create`` to the current revision.
+
+    ``bulk_create`` doesn't send the ``post_save`` signal, so reversion
+    doesn't know about the new records.
+
+    """
+    if reversion.revision_context_manager.is_active():
+        manager = reversion.default_revision_manager
+        adapter = manager.get_adapter(model)
+        for obj in objs:
+            reversion.revision_context_manager.add_to_context(
+                manager, obj, adapter.get_version_data(obj)
+            )
+
+
+def _cached(key, seconds, func):
+    """Get a value from the lookup cache (or call ``func`` to get it).
+
+    The value is kept for ``seconds`` (the cache is cleared when the rows are
+    saved in this process, but we can't tell if they are updated in another
+    process).
+
+    """
+    now = time.monotonic()
+    try:
+        expires, value = _lookup_cache[key]
+        if now < expires:
+            return value
+    except KeyError:
+        pass
+    value = func()
+    _lookup_cache[key] = (now + seconds, value)
+    return value
 
 
 def _card_error(e):
@@ -49,6 +119,46 @@ def _card_error(e):
     )
 
 
+def _card_expiry_date(year, month):
+    """A card expires on the last day of the month."""
+    return date(year, month, 1) + relativedelta(months=+1, day=1, days=-1)
+
+
+def _lock_not_available(e):
+    """Is the error from a locked row (``select_for_update(nowait=True)``)?
+
+    PostgreSQL uses the ``lock_not_available`` error code.
+
+    """
+    return getattr(e.__cause__, 'pgcode', None) == '55P03'
+
+
+def _round_half_even(numerator, denominator):
+    """Divide and round half to even (the default for ``Decimal.quantize``).
+
+    ``denominator`` must be positive.
+
+    """
+    quotient, remainder = divmod(numerator, denominator)
+    if remainder * 2 > denominator or (
+            remainder * 2 == denominator and quotient % 2):
+        quotient = quotient + 1
+    return quotient
+
+
+def _unsettled_state_pks():
+    """A checkout in these states is waiting for the outcome of a charge.
+
+    The asynchronous checkout is in the 'request' state while the task asks
+    Stripe for the money (see ``CheckoutManager.process_checkout``).
+
+    """
+    return [
+        CheckoutState.objects.pending.pk,
+        CheckoutState.objects.request.pk,
+    ]
+
+
 def _stripe_error(e):
     return ("http body: '{}' http status: '{}'".format(
         e.http_body,
@@ -60,13 +170,131 @@ def as_pennies(total):
     return int(total * Decimal('100'))
 
 
+def clear_lookup_cache(**kwargs):
+    """Empty the process-wide cache of lookup rows.
+
+    Connected to the ``post_save``, ``post_delete`` and ``post_migrate``
+    signals in ``checkout.apps``.
+
+    """
+    _lookup_cache.clear()
+
+
+def clear_notify_cache(**kwargs):
+    """Empty the cache of notification email addresses.
+
+    Connected to the ``post_save`` and ``post_delete`` signals for ``Notify``
+    in ``checkout.apps``.
+
+    """
+    _lookup_cache.pop(Notify, None)
+
+
+def clear_payment_plan_cache(**kwargs):
+    """Empty the cache of checkout settings and payment plan examples.
+
+    Connected to the ``post_save`` and ``post_delete`` signals for
+    ``PaymentPlan`` and ``CheckoutSettings`` in ``checkout.apps``.
+
+    """
+    _lookup_cache.pop(CheckoutSettings, None)
+    _payment_plan_example.cache_clear()
+
+
+def create_lookups(**kwargs):
+    """Create the default actions and states (if they don't exist).
+
+    The rows are created by migration ``0002``, but a flush (e.g. after a
+    ``transactional_db`` test) deletes them.  Connected to the
+    ``post_migrate`` signal (which is also sent after a flush) in
+    ``checkout.apps``.
+
+    """
+    using = kwargs.get('using', DEFAULT_DB_ALIAS)
+    for slug, name, payment in (
+            (CheckoutAction.CARD_REFRESH, 'Card Refresh', False),
+            (CheckoutAction.CHARGE, 'Charge', True),
+            (CheckoutAction.INVOICE, 'Invoice', False),
+            (CheckoutAction.MANUAL, 'Manual', False),
+            (CheckoutAction.PAYMENT, 'Payment', True),
+            (CheckoutAction.PAYMENT_PLAN, 'Payment Plan', False)):
+        CheckoutAction.objects.db_manager(using).get_or_create(
+            slug=slug, defaults=dict(name=name, payment=payment)
+        )
+    for slug, name in (
+            (CheckoutState.FAIL, 'Fail'),
+            (CheckoutState.PENDING, 'Pending'),
+            (CheckoutState.REQUEST, 'Request'),
+            (CheckoutState.SUCCESS, 'Success')):
+        CheckoutState.objects.db_manager(using).get_or_create(
+            slug=slug, defaults=dict(name=name)
+        )
+
+
+def notify_email_addresses():
+    """Email addresses for checkout notifications (cached).
+
+    The list is cached for ``CHECKOUT_NOTIFY_CACHE_SECONDS``.
+
+    """
+    return _cached(
+        Notify,
+        getattr(settings, 'CHECKOUT_NOTIFY_CACHE_SECONDS', 300),
+        lambda: [n.email for n in Notify.objects.all()],
+    )
+
+
+def refresh_checkout_details(qs):
+    """Copy the email address and name from the content objects in ``qs``.
+
+    Used by the ``refresh_checkout_details`` management command (for rows
+    created before we kept a copy, or if the content object has changed) and
+    before we refresh the card expiry dates.  Rows for a content object which
+    has been deleted are left alone.  The rows are updated with one
+    ``UPDATE`` for each email and name.
+
+    """
+    count = 0
+    pks = list(qs.values_list('pk', flat=True))
+    for batch in chunks(pks, 500):
+        details = defaultdict(list)
+        rows = qs.model.objects.filter(
+            pk__in=batch
+        ).prefetch_related(
+            'content_object'
+        )
+        for obj in rows:
+            if obj.content_object is None:
+                continue
+            key = (
+                obj.content_object.checkout_email,
+                obj.content_object.checkout_name,
+            )
+            if key != (obj.checkout_email, obj.checkout_name):
+                details[key].append(obj.pk)
+        for (email, name), update_pks in details.items():
+            count = count + qs.model.objects.filter(
+                pk__in=update_pks
+            ).update(
+                checkout_email=email,
+                checkout_name=name,
+            )
+    return count
+
+
 def default_checkout_state():
-    return CheckoutState.objects.get(slug=CheckoutState.PENDING).pk
+    return CheckoutState.objects.pending.pk
+
 
+@lru_cache(maxsize=256)
+def _payment_plan_example(payment_plan, modified, deposit_due_date, total):
+    """Cache the payment plan examples (see ``PaymentPlan.cached_example``).
 
-def expiry_date_as_str(item):
-    d = item.get('expiry_date', None)
-    return d.strftime('%Y%m%d') if d else ''
+    A model instance is hashed on its primary key, so ``modified`` is part of
+    the key in case the payment plan has been updated.
+
+    """
+    return tuple(payment_plan.example(deposit_due_date, total))
 
 
 class CheckoutError(Exception):
@@ -79,15 +307,46 @@ class CheckoutError(Exception):
         return repr('%s, %s' % (self.__class__.__name__, self.value))
 
 
-class CheckoutStateManager(models.Manager):
+class LookupManager(models.Manager):
+    """Process-wide cache for the rows of a lookup table (by ``slug``).
+
+    The lookup tables are small and only change with a migration, so the rows
+    are loaded in one query and then shared by every request in the process.
+    The instances are shared, so please don't update them.
+
+    """
+
+    def _rows(self):
+        try:
+            return _lookup_cache[self.model]
+        except KeyError:
+            rows = {obj.slug: obj for obj in self.model.objects.all()}
+            _lookup_cache[self.model] = rows
+            return rows
+
+    def lookup(self, slug):
+        rows = self._rows()
+        try:
+            return rows[slug]
+        except KeyError:
+            obj = self.model.objects.get(slug=slug)
+            rows[slug] = obj
+            return obj
+
+    def warm_cache(self):
+        """Load the rows (so the first request doesn't have to)."""
+        self._rows()
+
+
+class CheckoutStateManager(LookupManager):
 
     @property
     def fail(self):
-        return self.model.objects.get(slug=self.model.FAIL)
+        return self.lookup(self.model.FAIL)
 
     @property
     def pending(self):
-        return self.model.objects.get(slug=self.model.PENDING)
+        return self.lookup(self.model.PENDING)
 
     @property
     def request(self):
@@ -97,11 +356,11 @@ class CheckoutStateManager(models.Manager):
         the account.
 
         """
-        return self.model.objects.get(slug=self.model.REQUEST)
+        return self.lookup(self.model.REQUEST)
 
     @property
     def success(self):
-        return self.model.objects.get(slug=self.model.SUCCESS)
+        return self.lookup(self.model.SUCCESS)
 
 
 class CheckoutState(TimeStampedModel):
@@ -135,31 +394,31 @@ class CheckoutState(TimeStampedModel):
 reversion.register(CheckoutState)
 
 
-class CheckoutActionManager(models.Manager):
+class CheckoutActionManager(LookupManager):
 
     @property
     def card_refresh(self):
-        return self.model.objects.get(slug=self.model.CARD_REFRESH)
+        return self.lookup(self.model.CARD_REFRESH)
 
     @property
     def charge(self):
-        return self.model.objects.get(slug=self.model.CHARGE)
+        return self.lookup(self.model.CHARGE)
 
     @property
     def invoice(self):
-        return self.model.objects.get(slug=self.model.INVOICE)
+        return self.lookup(self.model.INVOICE)
 
     @property
     def manual(self):
-        return self.model.objects.get(slug=self.model.MANUAL)
+        return self.lookup(self.model.MANUAL)
 
     @property
     def payment(self):
-        return self.model.objects.get(slug=self.model.PAYMENT)
+        return self.lookup(self.model.PAYMENT)
 
     @property
     def payment_plan(self):
-        return self.model.objects.get(slug=self.model.PAYMENT_PLAN)
+        return self.lookup(self.model.PAYMENT_PLAN)
 
 
 class CheckoutAction(TimeStampedModel):
@@ -204,8 +463,7 @@ class CustomerManager(models.Manager):
     def _stripe_create(self, email, description, token):
         """Use the Stripe API to create a customer."""
         try:
-            stripe.api_key = settings.STRIPE_SECRET_KEY
-            customer = stripe.Customer.create(
+            customer = gateway().customer_create(
                 email=email,
                 description=description,
                 card=token,
@@ -218,26 +476,16 @@ class CustomerManager(models.Manager):
             )) from e
 
     def _stripe_get_card_expiry(self, customer_id):
-        result = (0, 0)
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        customer = stripe.Customer.retrieve(customer_id)
-        default_card = customer['default_card']
-        # find the details of the default card
-        for card in customer['cards']['data']:
-            if card['id'] == default_card:
-                # find the expiry date of the default card
-                result = (int(card['exp_year']), int(card['exp_month']))
-                break
-        return result
+        return gateway().card_expiry(customer_id)
 
     def _stripe_update(self, customer_id, description, token):
         """Use the Stripe API to update a customer."""
         try:
-            stripe.api_key = settings.STRIPE_SECRET_KEY
-            stripe_customer = stripe.Customer.retrieve(customer_id)
-            stripe_customer.description = description
-            stripe_customer.card = token
-            stripe_customer.save()
+            gateway().customer_update(
+                customer_id,
+                description=description,
+                card=token,
+            )
         except stripe.StripeError as e:
             raise CheckoutError(
                 "Error updating Stripe customer '{}': {}".format(
@@ -286,33 +534,105 @@ class CustomerManager(models.Manager):
             pass
         return result
 
-    def update_card_expiry(self, email):
-        """Find the customer, get the expiry date from Stripe and update."""
-        try:
-            obj = self._get_customer(email)
-            year, month = self._stripe_get_card_expiry(obj.customer_id)
+    def _card_expiry_dates(self, customers, limiter, retries):
+        """Get the card expiry date for each customer from Stripe.
+
+        Stripe returns a status of 429 if we make too many requests, so we
+        retry.  The delay (``CHECKOUT_STRIPE_RETRY_SECONDS``) doubles after
+        each retry.
+
+        Returns a ``dict`` of customer ``pk`` to the expiry date (or ``None``
+        if the customer doesn't have a default card).
+
+        """
+        delay = getattr(settings, 'CHECKOUT_STRIPE_RETRY_SECONDS', 0.5)
+        result = {}
+        for obj in customers:
+            attempt = 0
+            while True:
+                limiter.wait()
+                try:
+                    year, month = self._stripe_get_card_expiry(obj.customer_id)
+                    break
+                except stripe.StripeError as e:
+                    if e.http_status == 429 and attempt < retries:
+                        time.sleep(delay * 2 ** attempt)
+                        attempt = attempt + 1
+                    else:
+                        logger.error(
+                            "Cannot get card expiry for customer '{}': "
+                            "{}".format(obj.email, _stripe_error(e))
+                        )
+                        year = month = None
+                        break
             if year and month:
-                # last day of the month
-                obj.expiry_date = date(year, month, 1) + relativedelta(
-                    months=+1, day=1, days=-1
+                result[obj.pk] = _card_expiry_date(year, month)
+        return result
+
+    def update_card_expiry_dates(
+            self, emails, workers=1, requests_per_second=None, retries=3):
+        """Update the card expiry dates for many customers.
+
+        Each customer is only requested from Stripe once (however many times
+        the email address appears in ``emails``).  The requests are shared
+        between ``workers`` threads and limited to ``requests_per_second``.
+
+        The changes are saved with one ``UPDATE`` for each expiry date and the
+        customer is sent an email if their ``refresh`` flag changes (see
+        ``save_card_expiry_dates``).
+
+        """
+        emails = list(set(emails))
+        customers = []
+        for batch in chunks(emails, 500):
+            customers = customers + list(
+                self.model.objects.filter(email__in=batch)
+            )
+        limiter = RateLimiter(requests_per_second)
+        expiry_dates = {}
+        for item in run_in_threads(
+                lambda batch: self._card_expiry_dates(batch, limiter, retries),
+                customers,
+                workers):
+            expiry_dates.update(item)
+        self.save_card_expiry_dates(customers, expiry_dates)
+
+    def save_card_expiry_dates(self, customers, expiry_dates):
+        """Save the card expiry dates (``dict`` of customer ``pk`` to date).
+
+        The changes are saved with one ``UPDATE`` for each expiry date and the
+        customer is sent an email if their ``refresh`` flag changes.  The
+        expiry date is saved even if the ``refresh`` flag hasn't changed (so
+        the card expiry report is up to date).
+
+        """
+        changes = defaultdict(list)
+        refreshed = []
+        for obj in customers:
+            expiry_date = expiry_dates.get(obj.pk)
+            if not expiry_date:
+                continue
+            before = (obj.expiry_date, obj.refresh)
+            obj.expiry_date = expiry_date
+            obj.refresh = obj.is_expiring
+            if obj.refresh != before[1]:
+                refreshed.append(obj)
+            if (obj.expiry_date, obj.refresh) != before:
+                changes[(obj.expiry_date, obj.refresh)].append(obj.pk)
+        with transaction.atomic():
+            for (expiry_date, refresh), pks in changes.items():
+                for batch in chunks(pks, 500):
+                    self.model.objects.filter(pk__in=batch).update(
+                        expiry_date=expiry_date,
+                        refresh=refresh,
+                        modified=timezone.now(),
+                    )
+            for obj in refreshed:
+                queue_mail_template(
+                    obj,
+                    self.model.MAIL_TEMPLATE_CARD_EXPIRY,
+                    {obj.email: dict(name=obj.name)}
                 )
-                # is the card expiring soon?
-                is_expiring = obj.is_expiring
-                if obj.refresh == is_expiring:
-                    pass
-                else:
-                    with transaction.atomic():
-                        obj.refresh = is_expiring
-                        # save the details
-                        obj.save()
-                        # email the customer
-                        queue_mail_template(
-                            obj,
-                            self.model.MAIL_TEMPLATE_CARD_EXPIRY,
-                            {obj.email: dict(name=obj.name)}
-                        )
-        except Customer.DoesNotExist:
-            pass
 
 
 class Customer(TimeStampedModel):
@@ -370,7 +690,22 @@ reversion.register(Customer)
 class CheckoutManager(models.Manager):
 
     def audit(self):
-        return self.model.objects.all().order_by('-pk')
+        """All the checkout transactions (most recent first).
+
+        The related objects displayed in ``_checkout_list.html`` are fetched
+        in bulk.  The generic ``content_object`` is fetched using one query
+        for each content type.
+
+        """
+        return self.model.objects.all().select_related(
+            'action',
+            'checkoutadditional',
+            'customer',
+            'state',
+            'user',
+        ).prefetch_related(
+            'content_object',
+        ).order_by('-pk')
 
     def create_checkout(self, action, content_object, user):
         """Create a checkout payment request."""
@@ -391,7 +726,7 @@ class CheckoutManager(models.Manager):
         obj.save()
         return obj
 
-    def charge(self, content_object, current_user):
+    def charge(self, content_object, current_user, notify=True):
         """Collect some money from a customer.
 
         You must be a member of staff to use this method.  For payment plans,
@@ -401,6 +736,10 @@ class CheckoutManager(models.Manager):
         We should only attempt to collect money if the customer has already
         entered their card details.
 
+        If the charge fails, we send a notification email (unless ``notify``
+        is ``False`` e.g. when the failures are sent as a digest by
+        ``notify_digest``).
+
         """
         content_object.refresh_from_db()
         if not content_object.checkout_can_charge:
@@ -430,7 +769,9 @@ class CheckoutManager(models.Manager):
         except CheckoutError:
             with transaction.atomic():
                 checkout.fail()
-                checkout.notify()
+                if notify:
+                    checkout.notify()
+        return checkout
 
     def manual(self, content_object, current_user):
         """Mark a transaction as paid (manual).
@@ -464,9 +805,140 @@ class CheckoutManager(models.Manager):
             with transaction.atomic():
                 checkout.fail()
 
+    def process_checkout(self, checkout_pk, token, user_pk=None):
+        """Take the payment for a checkout (in the background).
+
+        Used by the asynchronous checkout (see ``CheckoutMixin``).  The
+        checkout was created (in the 'pending' state) by the view.
+
+        We move the checkout to the 'request' state before asking for the
+        money (as for ``process_payments``).  If the checkout is no longer
+        pending (e.g. the task was retried or the status page stopped
+        waiting), we don't take the payment (and return ``None``).
+
+        If the payment fails with an unexpected error, the checkout is marked
+        as failed (so the status page stops waiting) and the error is raised.
+        Once the card has been charged, we don't mark the checkout as failed.
+
+        """
+        count = self.model.objects.filter(
+            pk=checkout_pk,
+            state=CheckoutState.objects.pending,
+        ).update(
+            state=CheckoutState.objects.request,
+            modified=timezone.now(),
+        )
+        if not count:
+            return None
+        checkout = self.model.objects.get(pk=checkout_pk)
+        try:
+            if user_pk:
+                current_user = get_user_model().objects.get(pk=user_pk)
+            else:
+                current_user = AnonymousUser()
+            checkout.charge_token(token, current_user)
+        except CheckoutError as e:
+            logger.error(e)
+            with transaction.atomic():
+                checkout.fail()
+            return checkout
+        except Exception:
+            logger.exception('process_checkout {}'.format(checkout_pk))
+            with transaction.atomic():
+                checkout.fail()
+            raise
+        try:
+            with transaction.atomic():
+                checkout.success()
+        except Exception:
+            # the card was charged, so leave the checkout in the 'request'
+            # state (the Stripe webhook will try again)
+            logger.exception(
+                'process_checkout {}: the card was charged, but we cannot '
+                'update the checkout'.format(checkout_pk)
+            )
+            raise
+        return checkout
+
+    def notify_digest(self, checkouts, errors=None):
+        """Send one notification email listing the failed ``checkouts``.
+
+        Used by ``process_payments`` (rather than one email for each failed
+        payment).  ``errors`` is a list of ``(content_object, message)`` for
+        payments which failed before we could create a checkout.
+
+        """
+        errors = errors or []
+        if not checkouts and not errors:
+            return
+        email_addresses = notify_email_addresses()
+        if email_addresses:
+            subject = 'FAIL - {} payments failed'.format(
+                len(checkouts) + len(errors)
+            )
+            lines = [
+                '{} - {} from {}, {}: {} {}'.format(
+                    obj.created.strftime('%d/%m/%Y %H:%M'),
+                    obj.action.name,
+                    obj.checkout_name,
+                    obj.checkout_email,
+                    obj.description,
+                    obj.total,
+                )
+                for obj in checkouts
+            ] + [
+                '{}: {}'.format(content_object, message)
+                for content_object, message in errors
+            ]
+            queue_mail_message(
+                checkouts[0] if checkouts else errors[0][0],
+                email_addresses,
+                subject,
+                '{}:\n\n{}'.format(subject, '\n'.join(lines)),
+            )
+        else:
+            logger.error(
+                "Cannot send email notification of checkout transactions.  "
+                "No email addresses set-up in 'enquiry.models.Notify'"
+            )
+
+    def _between(self, state, from_date, to_date):
+        """Checkouts in ``state`` from ``from_date`` to ``to_date``.
+
+        The dates are inclusive (the range ends at midnight after
+        ``to_date``).
+
+        """
+        def _midnight(day):
+            return timezone.make_aware(
+                datetime.combine(day, datetime.min.time())
+            )
+        return self.audit().filter(
+            checkout_date__gte=_midnight(from_date),
+            checkout_date__lt=_midnight(to_date + relativedelta(days=1)),
+            state=state,
+        )
+
+    def fail_between(self, from_date, to_date):
+        """Failed checkouts (most recent first) for a range of dates."""
+        return self._between(CheckoutState.objects.fail, from_date, to_date)
+
+    def for_content_object(self, content_object):
+        """The checkouts for ``content_object`` (most recent first)."""
+        return self.audit().filter(
+            content_type=ContentType.objects.get_for_model(content_object),
+            object_id=content_object.pk,
+        )
+
     def success(self):
         return self.audit().filter(state=CheckoutState.objects.success)
 
+    def success_between(self, from_date, to_date):
+        """Successful checkouts (most recent first) for a range of dates."""
+        return self._between(
+            CheckoutState.objects.success, from_date, to_date
+        )
+
 
 class Checkout(TimeStampedModel):
     """Checkout.
@@ -477,7 +949,7 @@ class Checkout(TimeStampedModel):
 
     """
 
-    checkout_date = models.DateTimeField()
+    checkout_date = models.DateTimeField(db_index=True)
     action = models.ForeignKey(CheckoutAction)
     customer = models.ForeignKey(
         Customer,
@@ -507,15 +979,31 @@ class Checkout(TimeStampedModel):
     content_type = models.ForeignKey(ContentType)
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey()
+    # copy of the 'content_object' details (so we don't need to look them up)
+    checkout_email = models.EmailField(blank=True, db_index=True)
+    checkout_name = models.TextField(blank=True)
+    # a unique key for the Stripe charge (see ``idempotency_key``)
+    uuid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     objects = CheckoutManager()
 
     class Meta:
+        index_together = (
+            ('content_type', 'object_id'),
+            ('state', 'checkout_date'),
+            ('state', 'id'),
+        )
         ordering = ('pk',)
         verbose_name = 'Checkout'
         verbose_name_plural = 'Checkouts'
 
     def __str__(self):
-        return '{}'.format(self.content_object.checkout_email)
+        return '{}'.format(self.checkout_email)
+
+    def save(self, *args, **kwargs):
+        if self.pk is None and self.content_object and not self.checkout_email:
+            self.checkout_email = self.content_object.checkout_email
+            self.checkout_name = self.content_object.checkout_name
+        super().save(*args, **kwargs)
 
     def _charge(self):
         """Charge the card."""
@@ -523,14 +1011,20 @@ class Checkout(TimeStampedModel):
             self._charge_stripe()
 
     def _charge_stripe(self):
-        """Create the charge on stripe's servers."""
-        stripe.api_key = settings.STRIPE_SECRET_KEY
+        """Create the charge on stripe's servers.
+
+        The charge is tagged with the checkout, so it can be found (and
+        safely retried) if we don't know the outcome of the request.
+
+        """
         try:
-            stripe.Charge.create(
+            gateway().charge_create_retry(
+                self.idempotency_key,
                 amount=as_pennies(self.total),
                 currency=CURRENCY,
                 customer=self.customer.customer_id,
                 description=self.description,
+                metadata={'checkout_pk': self.pk},
             )
         except stripe.CardError as e:
             raise CheckoutError(
@@ -568,6 +1062,19 @@ class Checkout(TimeStampedModel):
                 current_user.email, self.customer.email
             ))
 
+    def charge_token(self, token, current_user):
+        """Initialise the Stripe customer (with the token) and charge the card.
+
+        The ``customer`` is saved before the charge (so we can diagnose the
+        checkout if the charge fails).
+
+        """
+        self.customer = Customer.objects.init_customer(
+            self.content_object, token
+        )
+        self.save()
+        self.charge_user(current_user)
+
     def charge_user(self, current_user):
         """Charge the card of the current user.
 
@@ -600,12 +1107,12 @@ class Checkout(TimeStampedModel):
     @property
     def failed(self):
         """Did the checkout request fail?"""
-        return self.state == CheckoutState.objects.fail
+        return self.state_id == CheckoutState.objects.fail.pk
 
     @property
     def invoice_data(self):
         try:
-            data = self.checkoutinvoice
+            data = self.checkoutadditional
             return filter(None, (
                 data.contact_name,
                 data.company_name,
@@ -624,47 +1131,63 @@ class Checkout(TimeStampedModel):
 
     @property
     def is_invoice(self):
-        return self.action == CheckoutAction.objects.invoice
+        return self.action_id == CheckoutAction.objects.invoice.pk
 
     @property
     def is_manual(self):
-        return self.action == CheckoutAction.objects.manual
+        return self.action_id == CheckoutAction.objects.manual.pk
+
+    @property
+    def idempotency_key(self):
+        """The Stripe idempotency key for the charge (see ``gateway``).
+
+        We use the ``uuid`` (not the ``pk``), because the key must be unique
+        for the Stripe account (which might be shared by more than one site).
+
+        """
+        return 'checkout-{}'.format(self.uuid)
+
+    @property
+    def is_pending(self):
+        return self.state_id == CheckoutState.objects.pending.pk
 
     @property
     def is_payment(self):
-        return self.action == CheckoutAction.objects.payment
+        return self.action_id == CheckoutAction.objects.payment.pk
 
     @property
     def is_payment_plan(self):
         """Used in success templates."""
-        return self.action == CheckoutAction.objects.payment_plan
+        return self.action_id == CheckoutAction.objects.payment_plan.pk
 
-    def notify(self, request=None):
+    def notify(self, request=None, url=None):
         """Send notification of checkout status.
 
-        Pass in a 'request' if you want the email to contain the URL of the
-        checkout transaction.
+        Pass in a 'request' (or the absolute 'url' of the content object) if
+        you want the email to contain the URL of the checkout transaction.
 
         """
-        email_addresses = [n.email for n in Notify.objects.all()]
+        if request:
+            url = request.build_absolute_uri(self.content_object_url)
+        email_addresses = notify_email_addresses()
         if email_addresses:
             caption = self.action.name
             state = self.state.name
             subject = '{} - {} from {}'.format(
                 state.upper(),
                 caption.capitalize(),
-                self.content_object.checkout_name,
+                self.checkout_name,
             )
             message = '{} - {} - {} from {}, {}:'.format(
                 self.created.strftime('%d/%m/%Y %H:%M'),
                 state.upper(),
                 caption,
-                self.content_object.checkout_name,
-                self.content_object.checkout_email,
+                self.checkout_name,
+                self.checkout_email,
             )
             message = message + '\n\n{}\n\n{}'.format(
                 self.description,
-                request.build_absolute_uri(self.content_object_url) if request else '',
+                url or '',
             )
             queue_mail_message(
                 self,
@@ -716,7 +1239,7 @@ class CheckoutAdditional(TimeStampedModel):
     contact_name = models.CharField(max_length=100, blank=True)
     email = models.EmailField(blank=False)
     phone = models.CharField(max_length=50, blank=True)
-    date_of_birth = models.DateField(}
+    date_of_birth = models.DateField(blank=True, null=True)
     objects = CheckoutAdditionalManager()
 
     class Meta:
@@ -834,6 +1357,74 @@ class PaymentPlan(TimeStampedModel):
         ]
         return result + self.instalments(deposit_due_date, total)
 
+    def cached_example(self, deposit_due_date, total):
+        """The same as ``example``, but cached (for the checkout pages)."""
+        return list(
+            _payment_plan_example(self, self.modified, deposit_due_date, total)
+        )
+
+    def _schedule_pennies(self, offsets, deposit_due_date, pennies):
+        """Calculate the schedule for a total in pennies (see ``schedules``).
+
+        Uses integer arithmetic (with the same *half even* rounding as
+        ``Decimal.quantize``) and the month ``offsets`` of each instalment
+        rather than ``rrule``.
+
+        """
+        deposit = _round_half_even(pennies * self.deposit, 100)
+        instalment = _round_half_even(pennies - deposit, self.count)
+        first_interval = self.interval
+        if deposit_due_date.day > 15:
+            first_interval = first_interval + 1
+        month = deposit_due_date.year * 12 + deposit_due_date.month - 1
+        month = month + first_interval
+        result = [(deposit_due_date, deposit)]
+        for offset in offsets:
+            year, m = divmod(month + offset, 12)
+            result.append((date(year, m + 1, 1), instalment))
+        # make the total match
+        check = deposit + instalment * self.count
+        d, value = result[-1]
+        result[-1] = (d, value + (pennies - check))
+        return result
+
+    def schedules(self, items, pennies=False):
+        """Calculate the ``example`` schedule for many plans at once.
+
+        ``items`` is an iterable of ``(deposit_due_date, total)``.  Returns a
+        list containing a schedule for each item (in the same order).  Each
+        schedule is identical to the result of ``example``.  If ``pennies`` is
+        set, the amounts are returned as an integer number of pennies.
+
+        """
+        result = []
+        offsets = [i * self.interval for i in range(self.count)]
+        for deposit_due_date, total in items:
+            total_pennies = Decimal(total).scaleb(2)
+            if self.count > 0 and total_pennies == int(total_pennies):
+                schedule = self._schedule_pennies(
+                    offsets, deposit_due_date, int(total_pennies)
+                )
+                if not pennies:
+                    schedule = [
+                        (d, Decimal(value).scaleb(-2)) for d, value in schedule
+                    ]
+                    # the last instalment has the precision of the total
+                    exponent = min(total_pennies.as_tuple().exponent - 2, -2)
+                    d, value = schedule[-1]
+                    schedule[-1] = (
+                        d, value.quantize(Decimal(1).scaleb(exponent))
+                    )
+            else:
+                # not a whole number of pennies, so use 'Decimal'
+                schedule = self.example(deposit_due_date, total)
+                if pennies:
+                    schedule = [
+                        (d, int(value.scaleb(2))) for d, value in schedule
+                    ]
+            result.append(schedule)
+        return result
+
 reversion.register(PaymentPlan)
 
 
@@ -864,6 +1455,98 @@ class ObjectPaymentPlanManager(models.Manager):
         )
         return obj
 
+    def _plan_pks(self, keys):
+        """Map ``(content_type_id, object_id)`` to the payment plan ``pk``."""
+        object_ids = defaultdict(list)
+        for content_type_id, object_id in keys:
+            object_ids[content_type_id].append(object_id)
+        result = {}
+        for content_type_id, ids in object_ids.items():
+            for batch in chunks(ids, 500):
+                qs = self.model.objects.filter(
+                    content_type_id=content_type_id,
+                    object_id__in=batch,
+                ).values_list('object_id', 'pk')
+                for object_id, pk in qs:
+                    result[(content_type_id, object_id)] = pk
+        return result
+
+    def _create_object_payment_plans(self, keys, items):
+        """Create the payment plans (see ``create_object_payment_plans``)."""
+        seen = set(self._plan_pks(keys))
+        clashes = []
+        plans = []
+        for key, item in zip(keys, items):
+            if key in seen:
+                clashes.append(item)
+            else:
+                seen.add(key)
+                content_object, payment_plan, total = item
+                plans.append(self.model(
+                    content_object=content_object,
+                    payment_plan=payment_plan,
+                    total=total,
+                    checkout_email=content_object.checkout_email,
+                    checkout_name=content_object.checkout_name,
+                ))
+        self.model.objects.bulk_create(plans)
+        # 'bulk_create' doesn't set the primary key
+        pks = self._plan_pks(
+            [(obj.content_type_id, obj.object_id) for obj in plans]
+        )
+        for obj in plans:
+            obj.pk = pks[(obj.content_type_id, obj.object_id)]
+        ObjectPaymentPlanInstalment.objects.bulk_create([
+            ObjectPaymentPlanInstalment(
+                object_payment_plan=obj,
+                count=1,
+                deposit=True,
+                amount=obj.payment_plan.deposit_amount(obj.total),
+                due=date.today(),
+                state=CheckoutState.objects.pending,
+            )
+            for obj in plans
+        ])
+        _add_to_revision(self.model, plans)
+        _add_to_revision(
+            ObjectPaymentPlanInstalment,
+            ObjectPaymentPlanInstalment.objects.filter(
+                object_payment_plan__in=[obj.pk for obj in plans],
+                deposit=True,
+            ),
+        )
+        return plans, clashes
+
+    def create_object_payment_plans(self, items):
+        """Create payment plans (with a deposit record) for many objects.
+
+        ``items`` is an iterable of ``(content_object, payment_plan, total)``.
+
+        The payment plans and the deposit records are each created with a
+        single ``INSERT`` inside one transaction.  An object can only have
+        one payment plan, so objects which already have a plan (or which
+        appear more than once in ``items``) are skipped.  If another process
+        creates a plan for one of the objects at the same time, we check
+        again (so the new plan is reported as a clash).
+
+        Returns a list of the new payment plans and a list of the ``items``
+        which clashed with an existing plan.
+
+        """
+        items = list(items)
+        keys = [
+            (ContentType.objects.get_for_model(content_object).pk,
+             content_object.pk)
+            for content_object, payment_plan, total in items
+        ]
+        try:
+            with transaction.atomic():
+                return self._create_object_payment_plans(keys, items)
+        except IntegrityError:
+            logger.info('payment plan created by another process')
+        with transaction.atomic():
+            return self._create_object_payment_plans(keys, items)
+
     def for_content_object(self, obj):
         return self.model.objects.get(
             content_type=ContentType.objects.get_for_model(obj),
@@ -876,51 +1559,112 @@ class ObjectPaymentPlanManager(models.Manager):
 
         Used to refresh card expiry dates.
 
+        The instalments are filtered in a sub-query (using the index on
+        ``state`` and ``object_payment_plan``), so the result is a lazy
+        ``QuerySet`` (which can be paginated).
+
         """
-        values = ObjectPaymentPlanInstalment.objects.filter(
-            state__slug__in=(
-                CheckoutState.FAIL,
-                CheckoutState.PENDING,
-                CheckoutState.REQUEST,
+        instalments = ObjectPaymentPlanInstalment.objects.filter(
+            state__in=(
+                CheckoutState.objects.fail.pk,
+                CheckoutState.objects.pending.pk,
+                CheckoutState.objects.request.pk,
             ),
-        ).values_list(
-            'object_payment_plan__pk',
-            flat=True
-        )
-        # 'set' will remove duplicate 'values'
+        ).values('object_payment_plan')
         return self.model.objects.filter(
-            pk__in=(set(values)),
+            pk__in=instalments,
         ).exclude(
             deleted=True,
         )
 
+    def prefetch_payments(self, qs):
+        """Prefetch the content object and payments for a list of plans.
+
+        The payments (instalments) are used by ``ObjectPaymentPlan.payments``.
+
+        """
+        return qs.select_related('payment_plan').prefetch_related(
+            'content_object',
+            Prefetch(
+                'objectpaymentplaninstalment_set',
+                queryset=ObjectPaymentPlanInstalment.objects.select_related(
+                    'state'
+                ).order_by('count'),
+                to_attr='prefetched_payments',
+            ),
+        )
+
+    @property
+    def card_expiry_payment_plans(self):
+        """Outstanding payment plans ordered by card expiry date.
+
+        The plans are joined to the customer (on ``checkout_email``) and
+        ordered in the database (plans for customers without an expiry date
+        are first), so the ``QuerySet`` can be paginated.  To get the expiry
+        dates for a page of plans, use ``card_expiry_dates``.
+
+        """
+        return self.prefetch_payments(
+            self.outstanding_payment_plans
+        ).annotate(
+            has_expiry_date=Case(
+                When(customer__expiry_date__isnull=True, then=Value(0)),
+                default=Value(1),
+                output_field=models.IntegerField(),
+            ),
+        ).order_by('has_expiry_date', 'customer__expiry_date', 'pk')
+
     @property
     def report_card_expiry_dates(self):
-        emails = []
-        result = []
-        payment_plans = self.outstanding_payment_plans
-        for item in payment_plans:
-            emails.append(item.content_object.checkout_email)
-        # get the expiry date for all the customers (as a 'dict')
+        """Outstanding payment plans ordered by card expiry date.
+
+        Returns a list of ``dict`` (``expiry_date`` and
+        ``object_payment_plan``).  To paginate the report, use
+        ``card_expiry_payment_plans``.
+
+        """
+        return self.card_expiry_dates(self.card_expiry_payment_plans)
+
+    def card_expiry_dates(self, payment_plans):
+        """The card expiry date for each payment plan (in one query).
+
+        Returns a list of ``dict`` (``expiry_date`` and
+        ``object_payment_plan``).
+
+        """
         customers = dict(Customer.objects.filter(
-            email__in=emails
+            email__in=set(obj.checkout_email for obj in payment_plans)
         ).values_list(
             'email', 'expiry_date'
         ))
-        for item in payment_plans:
-            expiry_date = customers.get(item.content_object.checkout_email)
-            result.append(dict(
-                expiry_date=expiry_date,
-                object_payment_plan=item,
-            ))
-        return sorted(result, key=expiry_date_as_str)
-
-    def refresh_card_expiry_dates(self):
-        """Refresh the card expiry dates for outstanding payment plans."""
-        for plan in self.outstanding_payment_plans:
-            Customer.objects.update_card_expiry(
-                plan.content_object.checkout_email
+        return [
+            dict(
+                expiry_date=customers.get(obj.checkout_email),
+                object_payment_plan=obj,
             )
+            for obj in payment_plans
+        ]
+
+    def refresh_card_expiry_dates(self, workers=1, requests_per_second=None):
+        """Refresh the card expiry dates for outstanding payment plans.
+
+        The email addresses are copied from the content objects first (see
+        ``refresh_checkout_details``), so the copy on the payment plan doesn't
+        get out of date.
+
+        For the ``workers`` and ``requests_per_second`` parameters, see
+        ``CustomerManager.update_card_expiry_dates``.
+
+        """
+        refresh_checkout_details(self.outstanding_payment_plans)
+        qs = self.outstanding_payment_plans.order_by().values_list(
+            'checkout_email', flat=True
+        ).distinct()
+        Customer.objects.update_card_expiry_dates(
+            list(qs),
+            workers=workers,
+            requests_per_second=requests_per_second,
+        )
 
 
 class ObjectPaymentPlan(TimeStampedModel):
@@ -936,6 +1680,19 @@ class ObjectPaymentPlan(TimeStampedModel):
     total = models.DecimalField(max_digits=8, decimal_places=2)
     # is this object deleted?
     deleted = models.BooleanField(default=False)
+    # copy of the 'content_object' details (so we don't need to look them up)
+    checkout_email = models.EmailField(blank=True, db_index=True)
+    checkout_name = models.TextField(blank=True)
+    # the customer for 'checkout_email' (no database column, the tables are
+    # joined on the email address e.g. for 'card_expiry_payment_plans')
+    customer = models.ForeignObject(
+        Customer,
+        from_fields=['checkout_email'],
+        to_fields=['email'],
+        null=True,
+        related_name='+',
+        serialize=False,
+    )
     objects = ObjectPaymentPlanManager()
 
     class Meta:
@@ -947,6 +1704,12 @@ class ObjectPaymentPlan(TimeStampedModel):
     def __str__(self):
         return '{} created {}'.format(self.payment_plan.name, self.created)
 
+    def save(self, *args, **kwargs):
+        if self.pk is None and self.content_object and not self.checkout_email:
+            self.checkout_email = self.content_object.checkout_email
+            self.checkout_name = self.content_object.checkout_name
+        super().save(*args, **kwargs)
+
     @property
     def _check_create_instalments(self):
         """Check the current records to make sure we can create instalments."""
@@ -982,16 +1745,10 @@ class ObjectPaymentPlan(TimeStampedModel):
             deposit_due_date,
             self.total
         )
-        count = 1
-        for due, amount in instalments:
-            count = count + 1
-            ObjectPaymentPlanInstalment.objects.create_object_payment_plan_instalment(
-                self,
-                count,
-                False,
-                amount,
-                due,
-            )
+        ObjectPaymentPlanInstalment.objects.create_instalments(
+            self,
+            instalments,
+        )
 
     def charge_deposit(self, user):
         self._check_create_instalments
@@ -1004,7 +1761,11 @@ class ObjectPaymentPlan(TimeStampedModel):
 
     @property
     def payments(self):
-        return self.objectpaymentplaninstalment_set.all().order_by('count')
+        """The payments in order (see ``prefetch_payments`` for a list)."""
+        try:
+            return self.prefetched_payments
+        except AttributeError:
+            return self.objectpaymentplaninstalment_set.all().order_by('count')
 
 reversion.register(ObjectPaymentPlan)
 
@@ -1032,49 +1793,329 @@ class ObjectPaymentPlanInstalmentManager(models.Manager):
         obj.save()
         return obj
 
+    def create_instalments(self, object_payment_plan, instalments):
+        """Create the instalments (after the deposit) in a single ``INSERT``.
+
+        ``instalments`` is a list of ``(due, amount)`` e.g. from
+        ``PaymentPlan.instalments``.  The deposit has a ``count`` of ``1``, so
+        the instalments start at ``2``.
+
+        """
+        state = CheckoutState.objects.pending
+        self.model.objects.bulk_create([
+            self.model(
+                object_payment_plan=object_payment_plan,
+                count=count,
+                deposit=False,
+                amount=amount,
+                due=due,
+                state=state,
+            )
+            for count, (due, amount) in enumerate(instalments, start=2)
+        ])
+        # 'bulk_create' doesn't set the primary key
+        _add_to_revision(self.model, self.model.objects.filter(
+            object_payment_plan=object_payment_plan,
+            deposit=False,
+        ))
+
     @property
     def due(self):
         """Lock the records while we try and take the payment.
 
+        We filter on the ``state_id`` (rather than joining to the state), so
+        the database can use the partial index on ``(state_id, due)`` (see
+        migration ``0009``).
+
         TODO Do we need to check that a payment is not already linked to this
         record?
 
         """
         return self.model.objects.filter(
+            deposit=False,
             due__lte=date.today(),
-            state__slug=CheckoutState.PENDING,
-        ).exclude(
-            deposit=True,
-        ).exclude(
-            object_payment_plan__deleted=True,
+            object_payment_plan__deleted=False,
+            state=CheckoutState.objects.pending,
         )
 
-    def process_payments(self):
-        """Process pending payments.
+    def due_shard(self, shard, shards):
+        """The due instalments for one shard (of ``shards``).
 
-        We set the status to 'request' before asking for the money.  This is
-        because we can't put the payment request into a transaction.  If we are
-        not careful, we could have a situation where the payment succeeds and
-        we don't manage to set the state to 'success'.  In the code below, if
-        the payment fails the record will be left in the 'request' state and
-        so we won't ask for the money again.
+        The instalments are partitioned by payment plan, so all the instalments
+        for a plan are processed by the same worker.
 
         """
-        pks = [o.pk for o in self.due]
-        for pk in pks:
+        return self.due.annotate(
+            shard=F('object_payment_plan') % shards,
+        ).filter(
+            shard=shard,
+        )
+
+    def _process_payment(self, pk, failed=None, errors=None):
+        """Request payment for a single instalment.
+
+        If ``failed`` is a list, a failed checkout is added to it (rather than
+        sending a notification email).
+
+        If we cannot charge the card (e.g. the customer has not registered a
+        card), the instalment is left in the 'request' state and
+        ``(instalment, message)`` is added to ``errors``.
+
+        Returns the slug of the checkout state, ``error`` or ``None`` if the
+        instalment was skipped (locked or no longer pending).
+
+        """
+        try:
             with transaction.atomic():
                 # make sure the payment is still pending
                 instalment = self.model.objects.select_for_update(
                     nowait=True
                 ).get(
                     pk=pk,
-                    state__slug=CheckoutState.PENDING
+                    state=CheckoutState.objects.pending,
                 )
                 # we are ready to request payment
                 instalment.state = CheckoutState.objects.request
                 instalment.save()
-            # request payment
-            Checkout.objects.charge(instalment, AnonymousUser())
+        except self.model.DoesNotExist:
+            logger.info('instalment {} is no longer pending'.format(pk))
+            return None
+        except OperationalError as e:
+            if not _lock_not_available(e):
+                raise
+            logger.info('instalment {} is locked'.format(pk))
+            return None
+        # request payment
+        try:
+            checkout = Checkout.objects.charge(
+                instalment,
+                AnonymousUser(),
+                notify=failed is None,
+            )
+        except (CheckoutError, stripe.StripeError) as e:
+            logger.error('cannot process instalment {}: {}'.format(pk, e))
+            if errors is not None:
+                errors.append((instalment, str(e)))
+            return 'error'
+        if failed is not None and checkout.failed:
+            failed.append(checkout)
+        return checkout.state.slug
+
+    def _process_payments(self, pks, failed=None, errors=None):
+        """Request payment for a batch of instalments (one worker)."""
+        result = Counter()
+        for pk in pks:
+            slug = self._process_payment(pk, failed, errors)
+            result[slug or 'skip'] += 1
+        return result
+
+    def _find_charges(self, checkouts, limiter):
+        """Find the Stripe charge for each checkout (one worker).
+
+        Returns a list of ``(checkout, charge)``.  ``charge`` is ``None`` if
+        the request didn't reach Stripe.  If we can't ask Stripe, the error is
+        logged and the checkout is left for the next run.
+
+        """
+        result = []
+        for checkout in checkouts:
+            charge = None
+            if checkout.customer:
+                limiter.wait()
+                # allow for a difference between our clock and Stripe
+                created = int(checkout.created.timestamp()) - 300
+                try:
+                    charge = gateway().charge_find(
+                        checkout.customer.customer_id, checkout.pk, created
+                    )
+                except stripe.StripeError as e:
+                    logger.error(
+                        "Cannot find the charge for checkout '{}': {}".format(
+                            checkout.pk, _stripe_error(e)
+                        )
+                    )
+                    continue
+            result.append((checkout, charge))
+        return result
+
+    def _reconcile(self, checkout, charge):
+        """Update the checkout (and instalment) using the Stripe charge.
+
+        Returns the checkout state slug (or ``None`` if the instalment is no
+        longer in the 'request' state).
+
+        """
+        try:
+            with transaction.atomic():
+                self.model.objects.select_for_update(nowait=True).get(
+                    pk=checkout.object_id,
+                    state=CheckoutState.objects.request,
+                )
+                # lock the checkout after the instalment (the same order as
+                # ``StripeEventManager._lock_checkout``)
+                checkout = Checkout.objects.select_for_update().get(
+                    pk=checkout.pk
+                )
+                if not checkout.state_id == CheckoutState.objects.pending.pk:
+                    return None
+                if charge and charge.get('paid'):
+                    checkout.success()
+                else:
+                    checkout.fail()
+        except self.model.DoesNotExist:
+            return None
+        except OperationalError as e:
+            if not _lock_not_available(e):
+                raise
+            logger.info('instalment {} is locked'.format(checkout.object_id))
+            return None
+        return checkout.state.slug
+
+    def reconcile(self, minutes=None, workers=1, requests_per_second=None):
+        """Resolve instalments stuck in the 'request' state.
+
+        ``process_payments`` leaves an instalment in the 'request' state if we
+        don't know the outcome of the charge (e.g. the worker was stopped).
+        If the instalment hasn't been updated for ``minutes``
+        (``CHECKOUT_RECONCILE_MINUTES``), we look for the charge on Stripe
+        (the checkout is in the metadata, see ``Checkout._charge_stripe``):
+
+        - No checkout (we didn't ask for the money): back to 'pending', so the
+          next ``process_payments`` will charge the card.  After
+          ``CHECKOUT_RECONCILE_MAX_ATTEMPTS``, we stop trying: the instalment
+          is marked as failed and a member of staff is notified.
+        - The card was charged: 'success'.
+        - The charge failed (or didn't reach Stripe): 'fail'.  The failures
+          are sent as one notification email (see ``notify_digest``).
+
+        The instalments are processed in batches.  The Stripe requests are
+        shared between ``workers`` threads and limited to
+        ``requests_per_second``.
+
+        Returns a ``dict`` with the number of instalments in each state.
+
+        """
+        if minutes is None:
+            minutes = getattr(settings, 'CHECKOUT_RECONCILE_MINUTES', 60)
+        attempts = getattr(settings, 'CHECKOUT_RECONCILE_MAX_ATTEMPTS', 3)
+        fail = CheckoutState.objects.fail
+        pending = CheckoutState.objects.pending
+        request = CheckoutState.objects.request
+        content_type = ContentType.objects.get_for_model(self.model)
+        pks = list(self.model.objects.filter(
+            deposit=False,
+            modified__lt=timezone.now() + relativedelta(minutes=-minutes),
+            state=request,
+        ).values_list('pk', flat=True))
+        limiter = RateLimiter(requests_per_second)
+        failed = []
+        errors = []
+        result = Counter()
+        for batch in chunks(pks, 500):
+            checkouts = {}
+            qs = Checkout.objects.filter(
+                content_type=content_type,
+                object_id__in=batch,
+                state=pending,
+            ).select_related('customer').order_by('pk')
+            for checkout in qs:
+                # the latest checkout for the instalment
+                checkouts[checkout.object_id] = checkout
+            no_checkout = [pk for pk in batch if pk not in checkouts]
+            if no_checkout:
+                qs = self.model.objects.filter(
+                    pk__in=no_checkout,
+                    state=request,
+                )
+                give_up = list(
+                    qs.filter(reconcile_count__gte=attempts - 1)
+                )
+                if give_up:
+                    result[CheckoutState.FAIL] += self.model.objects.filter(
+                        pk__in=[obj.pk for obj in give_up],
+                        state=request,
+                    ).update(state=fail, modified=timezone.now())
+                    message = 'No checkout after {} attempts'.format(
+                        attempts
+                    )
+                    errors = errors + [(obj, message) for obj in give_up]
+                result[CheckoutState.PENDING] += qs.exclude(
+                    pk__in=[obj.pk for obj in give_up],
+                ).update(
+                    modified=timezone.now(),
+                    reconcile_count=F('reconcile_count') + 1,
+                    state=pending,
+                )
+            for item in run_in_threads(
+                    lambda items: self._find_charges(items, limiter),
+                    list(checkouts.values()),
+                    workers):
+                for checkout, charge in item:
+                    slug = self._reconcile(checkout, charge)
+                    if slug == CheckoutState.FAIL:
+                        failed.append(checkout)
+                    result[slug or 'skip'] += 1
+        Checkout.objects.notify_digest(failed, errors)
+        result = dict(result, count=len(pks))
+        logger.info('reconcile: {}'.format(result))
+        return result
+
+    def process_payments(self, workers=1, shard=0, shards=1, digest=False):
+        """Process pending payments.
+
+        We set the status to 'request' before asking for the money.  This is
+        because we can't put the payment request into a transaction.  If we are
+        not careful, we could have a situation where the payment succeeds and
+        we don't manage to set the state to 'success'.  In the code below, if
+        the payment fails the record will be left in the 'request' state and
+        so we won't ask for the money again.
+
+        Set ``workers`` to charge the instalments using a pool of threads.
+        Records locked by another worker are skipped.
+
+        Set ``shard`` and ``shards`` to process a single shard of the due
+        instalments (see ``due_shard``).  Overlapping shards (or a task which
+        is retried) are safe because a record is only charged after moving it
+        from 'pending' to 'request' whilst it is locked.
+
+        Set ``digest`` to send one notification email listing all the failed
+        payments (rather than one email for each failure).  Instalments which
+        we cannot charge (e.g. the customer has not registered a card) are
+        always sent as one notification email.
+
+        Returns a ``dict`` with the number of instalments in each state and the
+        throughput of the run.
+
+        """
+        start = time.time()
+        if shards > 1:
+            qs = self.due_shard(shard, shards)
+        else:
+            qs = self.due
+        pks = list(qs.values_list('pk', flat=True))
+        failed = [] if digest else None
+        errors = []
+        result = Counter()
+        for item in run_in_threads(
+                lambda batch: self._process_payments(batch, failed, errors),
+                pks,
+                workers):
+            result.update(item)
+        Checkout.objects.notify_digest(failed or [], errors)
+        seconds = time.time() - start
+        result = dict(
+            result,
+            count=len(pks),
+            seconds=seconds,
+            per_second=len(pks) / seconds if seconds else 0,
+        )
+        logger.info(
+            'process_payments: {count} instalments in {seconds:.1f} seconds '
+            '({per_second:.1f} per second) {result}'.format(
+                result=result, **result
+            )
+        )
+        return result
 
 
 class ObjectPaymentPlanInstalment(TimeStampedModel):
@@ -1098,9 +2139,17 @@ class ObjectPaymentPlanInstalment(TimeStampedModel):
     deposit = models.BooleanField(help_text='Is this the initial payment')
     amount = models.DecimalField(max_digits=8, decimal_places=2)
     due = models.DateField()
+    reconcile_count = models.IntegerField(
+        default=0,
+        help_text='Number of times reconcile found no checkout',
+    )
     objects = ObjectPaymentPlanInstalmentManager()
 
     class Meta:
+        # the partial index for 'due' is created by migration '0009'
+        index_together = (
+            ('state', 'object_payment_plan'),
+        )
         unique_together = (
             ('object_payment_plan', 'due'),
             ('object_payment_plan', 'count'),
@@ -1201,12 +2250,27 @@ class CheckoutSettingsManager(models.Manager):
 
     @property
     def settings(self):
-        try:
-            return self.model.objects.get()
-        except self.model.DoesNotExist:
-            raise CheckoutError(
-                "Checkout settings have not been set-up in admin"
-            )
+        """The checkout settings (with the default payment plan).
+
+        The settings are cached for ``CHECKOUT_SETTINGS_CACHE_SECONDS`` (the
+        cache in this process is cleared when the settings are saved, but we
+        can't tell if they are updated in another process).
+
+        """
+        def _settings():
+            try:
+                return self.model.objects.select_related(
+                    'default_payment_plan'
+                ).get()
+            except self.model.DoesNotExist:
+                raise CheckoutError(
+                    "Checkout settings have not been set-up in admin"
+                )
+        return _cached(
+            self.model,
+            getattr(settings, 'CHECKOUT_SETTINGS_CACHE_SECONDS', 60),
+            _settings,
+        )
 
 
 class CheckoutSettings(SingletonModel):
@@ -1227,6 +2291,239 @@ class CheckoutSettings(SingletonModel):
 reversion.register(CheckoutSettings)
 
 
+class StripeEventManager(models.Manager):
+
+    def create_stripe_event(self, data):
+        """Store a webhook event (unless we already have it).
+
+        Stripe might send the same event more than once.
+
+        """
+        obj, created = self.model.objects.get_or_create(
+            event_id=data['id'],
+            defaults=dict(
+                event_type=data['type'],
+                data=json.dumps(data),
+            ),
+        )
+        return obj
+
+    def _customer_events(self, events, errors):
+        """Update the card expiry date for the customers.
+
+        Our customers have one card (see ``CustomerManager.init_customer``),
+        so we use the card in a ``customer.source.updated`` event.
+
+        If we can't read an event (or save the expiry dates), the error is
+        added to ``errors``.
+
+        Returns the ``pk`` of the events which have been processed.
+
+        """
+        expiry_dates = {}
+        result = []
+        for event in events:
+            try:
+                obj = event.object_data
+                if event.event_type == StripeEvent.CUSTOMER_UPDATED:
+                    customer_id = obj['id']
+                    year, month = customer_card_expiry(obj)
+                else:
+                    customer_id = obj.get('customer')
+                    year = int(obj.get('exp_year') or 0)
+                    month = int(obj.get('exp_month') or 0)
+                if customer_id and year and month:
+                    # the events are in order, so the latest date wins
+                    expiry_dates[customer_id] = _card_expiry_date(year, month)
+                result.append(event.pk)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.exception('stripe event {}'.format(event.event_id))
+                errors[event.pk] = str(e) or e.__class__.__name__
+        try:
+            with transaction.atomic():
+                customers = list(Customer.objects.filter(
+                    customer_id__in=list(expiry_dates)
+                ))
+                Customer.objects.save_card_expiry_dates(customers, {
+                    obj.pk: expiry_dates[obj.customer_id] for obj in customers
+                })
+        except Exception as e:
+            logger.exception('stripe customer events')
+            for pk in result:
+                errors[pk] = str(e) or e.__class__.__name__
+            result = []
+        return result
+
+    def _lock_checkout(self, checkout):
+        """Lock the checkout (and the instalment) before we settle it.
+
+        The locks are taken in the same order as
+        ``ObjectPaymentPlanInstalmentManager._reconcile`` (the instalment,
+        then the checkout), so the webhook and ``reconcile`` can't deadlock.
+
+        Returns the checkout (or ``None`` if it has been settled).
+
+        """
+        content_type = ContentType.objects.get_for_model(
+            ObjectPaymentPlanInstalment
+        )
+        if checkout.content_type_id == content_type.pk:
+            list(ObjectPaymentPlanInstalment.objects.select_for_update(
+            ).filter(pk=checkout.object_id))
+        checkout = Checkout.objects.select_for_update().get(pk=checkout.pk)
+        if checkout.state_id in _unsettled_state_pks():
+            return checkout
+        return None
+
+    def _charge_event(self, event, before):
+        """Settle the checkout using the outcome of the charge.
+
+        Returns ``False`` if the checkout is still being processed (modified
+        since ``before``), so we don't settle a checkout twice.
+
+        """
+        checkout_pk = event.checkout_pk
+        if not checkout_pk:
+            return True
+        try:
+            checkout = Checkout.objects.get(
+                pk=checkout_pk,
+                state__in=_unsettled_state_pks(),
+            )
+        except Checkout.DoesNotExist:
+            return True
+        if checkout.modified > before:
+            return False
+        checkout = self._lock_checkout(checkout)
+        if checkout:
+            if event.event_type == StripeEvent.CHARGE_SUCCEEDED:
+                checkout.success()
+            else:
+                checkout.fail()
+        return True
+
+    def _charge_events(self, events, errors):
+        """Settle the checkouts using the outcome of the charge.
+
+        A checkout which is still being processed (modified in the last
+        ``CHECKOUT_RECONCILE_MINUTES``) is left alone, so we don't settle a
+        checkout twice.  The event is processed in a later batch (the
+        ``reconcile_payments`` task processes the events periodically).
+
+        Each event is processed in a savepoint.  If an event fails, the error
+        is added to ``errors`` (so the event won't block the events after it).
+
+        Returns the ``pk`` of the events which have been processed.
+
+        """
+        minutes = getattr(settings, 'CHECKOUT_RECONCILE_MINUTES', 60)
+        before = timezone.now() + relativedelta(minutes=-minutes)
+        result = []
+        for event in events:
+            try:
+                with transaction.atomic():
+                    if self._charge_event(event, before):
+                        result.append(event.pk)
+            except Exception as e:
+                logger.exception('stripe event {}'.format(event.event_id))
+                errors[event.pk] = str(e) or e.__class__.__name__
+        return result
+
+    def process_events(self, batch_size=500):
+        """Apply the webhook events which haven't been processed.
+
+        The events are applied in order (in batches of ``batch_size``).  Event
+        types we don't use are marked as processed.  An event which fails is
+        marked as processed (with the ``error``), so it doesn't block the
+        events after it.
+
+        Returns the number of events processed.
+
+        """
+        pks = list(self.model.objects.filter(
+            processed=False,
+        ).order_by('pk').values_list('pk', flat=True))
+        count = 0
+        for batch in chunks(pks, batch_size):
+            events = list(
+                self.model.objects.filter(pk__in=batch).order_by('pk')
+            )
+            customer_events = []
+            charge_events = []
+            processed = []
+            errors = {}
+            for event in events:
+                if event.event_type in StripeEvent.CUSTOMER_EVENTS:
+                    customer_events.append(event)
+                elif event.event_type in StripeEvent.CHARGE_EVENTS:
+                    charge_events.append(event)
+                else:
+                    processed.append(event.pk)
+            if customer_events:
+                processed = processed + self._customer_events(
+                    customer_events, errors
+                )
+            if charge_events:
+                processed = processed + self._charge_events(
+                    charge_events, errors
+                )
+            count = count + self.model.objects.filter(
+                pk__in=processed
+            ).update(processed=True)
+            for pk, error in errors.items():
+                self.model.objects.filter(pk=pk).update(
+                    processed=True,
+                    error=error,
+                )
+        logger.info('process_events: {} of {}'.format(count, len(pks)))
+        return count
+
+
+class StripeEvent(TimeStampedModel):
+    """A Stripe webhook event.
+
+    The events are stored as they arrive (see ``StripeWebhookView``) and are
+    applied in batches by ``process_events``.  We don't update the event
+    (apart from the ``processed`` flag and the ``error``).
+
+    """
+
+    CHARGE_FAILED = 'charge.failed'
+    CHARGE_SUCCEEDED = 'charge.succeeded'
+    CUSTOMER_SOURCE_UPDATED = 'customer.source.updated'
+    CUSTOMER_UPDATED = 'customer.updated'
+
+    CHARGE_EVENTS = (CHARGE_FAILED, CHARGE_SUCCEEDED)
+    CUSTOMER_EVENTS = (CUSTOMER_SOURCE_UPDATED, CUSTOMER_UPDATED)
+
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=255)
+    data = models.TextField()
+    processed = models.BooleanField(default=False, db_index=True)
+    error = models.TextField(blank=True)
+    objects = StripeEventManager()
+
+    class Meta:
+        ordering = ('pk',)
+        verbose_name = 'Stripe event'
+        verbose_name_plural = 'Stripe events'
+
+    def __str__(self):
+        return '{} {}'.format(self.event_id, self.event_type)
+
+    @property
+    def checkout_pk(self):
+        """The checkout for a charge (see ``Checkout._charge_stripe``)."""
+        metadata = self.object_data.get('metadata') or {}
+        checkout_pk = metadata.get('checkout_pk')
+        return int(checkout_pk) if checkout_pk else None
+
+    @property
+    def object_data(self):
+        """The Stripe object in the event e.g. the charge or customer."""
+        return json.loads(self.data)['data']['object']
+
+
 #class ObjectPaymentPlanInstalmentCheckoutAudit(TimeStampedModel):
 #    """Keep an audit of checkout status."""
 #
@@ -3,18 +3,121 @@ import logging
 
 from celery import task
 
-from checkout.models import ObjectPaymentPlanInstalment
+from django.conf import settings
+
+from checkout import dispatch
+from checkout.models import (
+    Checkout,
+    ObjectPaymentPlan,
+    ObjectPaymentPlanInstalment,
+    StripeEvent,
+)
 
 logger = logging.getLogger(__name__)
 
 
+def _workers():
+    """Number of threads charging cards at the same time (per task)."""
+    return getattr(settings, 'CHECKOUT_PROCESS_PAYMENTS_WORKERS', 1)
+
+
+@task()
+def notify(checkout_pk, url=None):
+    """Queue the notification email for a checkout (see ``dispatch``)."""
+    logger.info('notify checkout {}'.format(checkout_pk))
+    Checkout.objects.get(pk=checkout_pk).notify(url=url)
+    dispatch.process_mail()
+
+
+@task()
+def process_checkout(checkout_pk, token, user_pk=None, url=None):
+    """Take the payment for an asynchronous checkout (see ``CheckoutMixin``).
+
+    ``url`` is the absolute URL of the content object (for the notification
+    email).
+
+    """
+    logger.info('process_checkout {}'.format(checkout_pk))
+    checkout = Checkout.objects.process_checkout(checkout_pk, token, user_pk)
+    if checkout and not checkout.failed:
+        checkout.notify(url=url)
+        dispatch.process_mail()
+
+
 @task()
 def process_payments():
+    """Process pending payments.
+
+    If ``CHECKOUT_PROCESS_PAYMENTS_SHARDS`` is more than one, the due
+    instalments are split into shards and each shard is processed by a separate
+    task (so the work is shared between all the celery workers).
+
+    """
     logger.info('process_payments')
-    ObjectPaymentPlanInstalment.objects.process_payments()
+    shards = getattr(settings, 'CHECKOUT_PROCESS_PAYMENTS_SHARDS', 1)
+    if shards > 1:
+        for shard in range(shards):
+            process_payments_shard.delay(shard, shards)
+    else:
+        ObjectPaymentPlanInstalment.objects.process_payments(
+            workers=_workers(),
+            digest=True,
+        )
+
+
+@task()
+def process_payments_shard(shard, shards):
+    logger.info('process_payments_shard {} of {}'.format(shard, shards))
+    ObjectPaymentPlanInstalment.objects.process_payments(
+        workers=_workers(),
+        shard=shard,
+        shards=shards,
+        digest=True,
+    )
+
+
+@task()
+def process_stripe_events():
+    """Apply the Stripe webhook events (see ``StripeWebhookView``)."""
+    logger.info('process_stripe_events')
+    StripeEvent.objects.process_events()
+
+
+@task()
+def reconcile_payments():
+    """Resolve instalments left in the 'request' state by ``process_payments``.
+
+    The webhook events are applied first.  An event for a checkout which was
+    still being processed is left for later (see ``_charge_events``), and this
+    task runs periodically (``CELERYBEAT_SCHEDULE``), so the event will be
+    applied even if no other event arrives.
+
+    See ``ObjectPaymentPlanInstalmentManager.reconcile``.
+
+    """
+    logger.info('reconcile_payments')
+    StripeEvent.objects.process_events()
+    ObjectPaymentPlanInstalment.objects.reconcile(
+        workers=_workers(),
+        requests_per_second=getattr(
+            settings, 'CHECKOUT_STRIPE_REQUESTS_PER_SECOND', None
+        ),
+    )
 
 
 @task()
 def refresh_card_expiry_dates():
+    """Refresh the card expiry dates for outstanding payment plans.
+
+    ``CHECKOUT_CARD_EXPIRY_WORKERS`` threads share the Stripe requests, and
+    ``CHECKOUT_STRIPE_REQUESTS_PER_SECOND`` limits the request rate (so we
+    stay within the Stripe rate limit).
+
+    """
     logger.info('refresh_card_expiry_dates')
-    ObjectPaymentPlan.objects.refresh_card_expiry_dates()
+    ObjectPaymentPlan.objects.refresh_card_expiry_dates(
+        workers=getattr(settings, 'CHECKOUT_CARD_EXPIRY_WORKERS', 1),
+        requests_per_second=getattr(
+            settings, 'CHECKOUT_STRIPE_REQUESTS_PER_SECOND', None
+        ),
+    )
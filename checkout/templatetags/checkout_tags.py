@@ -9,5 +9,5 @@ register = template.Library()
 
 @register.inclusion_tag('checkout/_payment_plan_example.html')
 def checkout_payment_plan_example(payment_plan, total):
-    example = payment_plan.example(date.today(), total)
+    example = payment_plan.cached_example(date.today(), total)
     return dict(example=example, total=total)
@@ -0,0 +1,78 @@
+# -*- encoding: utf-8 -*-
+"""Measure the performance of the checkout (see ``benchmark``).
+
+To run the benchmarks with more data::
+
+  CHECKOUT_BENCHMARK_COUNT=1000 py.test -s -k benchmark
+
+"""
+import os
+import time
+import tracemalloc
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+def benchmark_count():
+    """Number of operations for each benchmark (defaults to a quick run)."""
+    return int(os.environ.get('CHECKOUT_BENCHMARK_COUNT', 10))
+
+
+class BenchmarkResult(object):
+
+    def __init__(self, name, count, queries, seconds, peak_memory):
+        self.name = name
+        self.count = count
+        self.queries = queries
+        self.seconds = seconds
+        self.peak_memory = peak_memory
+
+    def __str__(self):
+        return (
+            '{}: {} operations, {:.1f} queries/op, {:.2f} ms/op, '
+            'peak memory {:.1f} KiB'.format(
+                self.name,
+                self.count,
+                self.queries_per_operation,
+                self.seconds_per_operation * 1000,
+                self.peak_memory / 1024,
+            )
+        )
+
+    @property
+    def queries_per_operation(self):
+        return self.queries / self.count if self.count else 0
+
+    @property
+    def seconds_per_operation(self):
+        return self.seconds / self.count if self.count else 0
+
+
+def benchmark(name, func, items=None):
+    """Call ``func`` and measure the queries, wall time and peak memory.
+
+    If ``items`` is set, ``func`` is called once for each item (and each call
+    is one operation), otherwise ``func`` is called once (with no parameters)
+    and should return the number of operations.
+
+    Set-up the data before calling ``benchmark``, so it isn't measured.
+
+    """
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            if items is None:
+                count = func()
+            else:
+                for item in items:
+                    func(item)
+                count = len(items)
+            seconds = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result = BenchmarkResult(name, count, len(queries), seconds, peak)
+    print(result)
+    return result
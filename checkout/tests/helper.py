@@ -1,4 +1,6 @@
 # -*- encoding: utf-8 -*-
+from datetime import date
+from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 
 from base.tests.model_maker import clean_and_save
@@ -6,7 +8,18 @@ from checkout.models import (
     CheckoutAction,
     CheckoutState,
 )
-from checkout.tests.factories import CheckoutFactory
+from checkout.tests.factories import (
+    CheckoutFactory,
+    CustomerFactory,
+    ObjectPaymentPlanFactory,
+    ObjectPaymentPlanInstalmentFactory,
+)
+from contact.tests.factories import ContactFactory
+from login.tests.factories import TEST_PASSWORD
+from login.tests.scenario import (
+    default_scenario_login,
+    get_user_staff,
+)
 
 
 def check_checkout(model_instance):
@@ -85,3 +98,24 @@ def check_object_payment_plan(model_instance):
     """The 'ObjectPaymentPlan' model links to generic content."""
     model_instance.checkout_email
     model_instance.checkout_name
+
+
+def login_staff(client):
+    """Log in the test client as a member of staff."""
+    default_scenario_login()
+    staff = get_user_staff()
+    assert client.login(username=staff.username, password=TEST_PASSWORD)
+
+
+def object_payment_plans(count):
+    """Payment plans (with a customer) and an instalment due yesterday."""
+    result = []
+    for i in range(count):
+        obj = ObjectPaymentPlanFactory(content_object=ContactFactory())
+        ObjectPaymentPlanInstalmentFactory(
+            object_payment_plan=obj,
+            due=date.today() + relativedelta(days=-1),
+        )
+        CustomerFactory(email=obj.checkout_email)
+        result.append(obj)
+    return result
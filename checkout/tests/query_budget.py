@@ -0,0 +1,115 @@
+# -*- encoding: utf-8 -*-
+"""Check the number of queries used by views and manager methods.
+
+``QueryBudget`` fails if a block of code uses more than ``max_queries``::
+
+  with QueryBudget(5):
+      response = client.get(url)
+
+``assert_flat_queries`` fails if the number of queries grows with the number
+of rows.  The error message lists the extra queries, so you can see which
+query is repeated for each row.
+
+"""
+import difflib
+import re
+
+from collections import Counter
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+def _normalise(sql):
+    """Replace numbers and strings, so queries for different rows match."""
+    sql = re.sub(r"'[^']*'", "'?'", sql)
+    return re.sub(r'\b\d+\b', '?', sql)
+
+
+def _extra(first, sql):
+    """The queries in ``sql`` which are not in ``first``."""
+    matcher = difflib.SequenceMatcher(a=first, b=sql, autojunk=False)
+    result = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ('insert', 'replace'):
+            result = result + sql[j1:j2]
+    return result
+
+
+def _sql(queries):
+    return [_normalise(q['sql']) for q in queries]
+
+
+class QueryBudget(object):
+    """Context manager which fails if there are more than ``max_queries``.
+
+    If ``max_queries`` is ``None``, the queries are captured, but not checked.
+
+    """
+
+    def __init__(self, max_queries):
+        self.max_queries = max_queries
+        self.context = CaptureQueriesContext(connection)
+
+    def __enter__(self):
+        self.context.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.context.__exit__(exc_type, exc_value, traceback)
+        if exc_type or self.max_queries is None:
+            return
+        if len(self) > self.max_queries:
+            # the most repeated queries first
+            counts = Counter(_sql(self.queries))
+            raise AssertionError(
+                '{} queries (budget {}):\n{}'.format(
+                    len(self),
+                    self.max_queries,
+                    '\n'.join(
+                        '{} x {}'.format(count, sql)
+                        for sql, count in counts.most_common()
+                    ),
+                )
+            )
+
+    def __len__(self):
+        return len(self.context)
+
+    @property
+    def queries(self):
+        return self.context.captured_queries
+
+
+def assert_flat_queries(func, setup, max_queries=None, counts=(1, 5)):
+    """Check the number of queries doesn't depend on the number of rows.
+
+    ``setup(count)`` creates ``count`` more rows (it is not measured), then
+    ``func()`` is run (and measured).  ``func`` is run after each of
+    ``counts``, so the rows add up.  If the number of queries is not the same
+    for each run, the assertion error lists the extra queries (compared with
+    the first run).  Each run must also be within ``max_queries`` (if set).
+
+    """
+    result = []
+    total = 0
+    for count in counts:
+        setup(count - total)
+        total = count
+        with QueryBudget(max_queries) as budget:
+            func()
+        result.append((total, _sql(budget.queries)))
+    first_count, first = result[0]
+    for count, sql in result[1:]:
+        if len(sql) != len(first):
+            raise AssertionError(
+                'The number of queries grows with the number of rows '
+                '({} rows: {} queries, {} rows: {} queries).  '
+                'The extra queries:\n{}'.format(
+                    first_count,
+                    len(first),
+                    count,
+                    len(sql),
+                    '\n'.join('+{}'.format(q) for q in _extra(first, sql)),
+                )
+            )
@@ -0,0 +1,51 @@
+# -*- encoding: utf-8 -*-
+from unittest import mock
+
+from checkout.batch import (
+    batches,
+    chunks,
+    RateLimiter,
+    run_in_threads,
+)
+
+
+def test_batches():
+    assert [[1, 3, 5], [2, 4]] == batches([1, 2, 3, 4, 5], 2)
+
+
+def test_batches_more_than_items():
+    assert [[1], [2]] == batches([1, 2], 4)
+
+
+def test_batches_empty():
+    assert [[]] == batches([], 3)
+
+
+def test_run_in_threads():
+    result = run_in_threads(sum, [1, 2, 3, 4], 1)
+    assert [10] == result
+
+
+def test_chunks():
+    assert [[1, 2], [3, 4], [5]] == chunks([1, 2, 3, 4, 5], 2)
+
+
+def test_chunks_empty():
+    assert [] == chunks([], 2)
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(4)
+    with mock.patch('time.sleep') as mock_sleep:
+        limiter.wait()
+        limiter.wait()
+    assert 1 == mock_sleep.call_count
+    assert 0 < mock_sleep.call_args[0][0] <= 0.25
+
+
+def test_rate_limiter_no_limit():
+    limiter = RateLimiter(None)
+    with mock.patch('time.sleep') as mock_sleep:
+        limiter.wait()
+        limiter.wait()
+    assert 0 == mock_sleep.call_count
@@ -0,0 +1,37 @@
+# -*- encoding: utf-8 -*-
+import pytest
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from checkout.models import CheckoutAction
+
+
+@pytest.mark.django_db
+def test_lookup():
+    assert CheckoutAction.CHARGE == CheckoutAction.objects.charge.slug
+    assert CheckoutAction.INVOICE == CheckoutAction.objects.lookup(
+        CheckoutAction.INVOICE
+    ).slug
+
+
+@pytest.mark.django_db
+def test_lookup_cache():
+    CheckoutAction.objects.warm_cache()
+    with CaptureQueriesContext(connection) as queries:
+        CheckoutAction.objects.card_refresh
+        CheckoutAction.objects.charge
+        CheckoutAction.objects.invoice
+        CheckoutAction.objects.manual
+        CheckoutAction.objects.payment
+        CheckoutAction.objects.payment_plan
+    assert 0 == len(queries)
+
+
+@pytest.mark.django_db
+def test_lookup_cache_delete():
+    CheckoutAction.objects.create(name='Gift', slug='gift', payment=False)
+    obj = CheckoutAction.objects.lookup('gift')
+    obj.delete()
+    with pytest.raises(CheckoutAction.DoesNotExist):
+        CheckoutAction.objects.lookup('gift')
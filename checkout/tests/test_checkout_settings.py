@@ -1,11 +1,20 @@
 # -*- encoding: utf-8 -*-
 import pytest
 
+from datetime import date
+from decimal import Decimal
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from checkout.models import (
     CheckoutError,
     CheckoutSettings,
 )
-from checkout.tests.factories import CheckoutSettingsFactory
+from checkout.tests.factories import (
+    CheckoutSettingsFactory,
+    PaymentPlanFactory,
+)
 
 
 @pytest.mark.django_db
@@ -26,6 +35,21 @@ def test_settings_none():
     assert 'not been set-up in admin' in str(e.value)
 
 
+@pytest.mark.django_db
+def test_settings_cache():
+    CheckoutSettingsFactory()
+    CheckoutSettings.objects.settings
+    with CaptureQueriesContext(connection) as queries:
+        obj = CheckoutSettings.objects.settings
+        obj.default_payment_plan
+    assert 0 == len(queries)
+    # saving the settings will clear the cache
+    plan = PaymentPlanFactory(slug='new')
+    obj.default_payment_plan = plan
+    obj.save()
+    assert plan == CheckoutSettings.objects.settings.default_payment_plan
+
+
 @pytest.mark.django_db
 def test_str():
     str(CheckoutSettingsFactory())
@@ -1,6 +1,9 @@
 # -*- encoding: utf-8 -*-
 import pytest
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from checkout.models import CheckoutState
 
 
@@ -10,3 +13,31 @@ def test_is_pending():
     assert CheckoutState.objects.pending.is_pending
     assert not CheckoutState.objects.request.is_pending
     assert not CheckoutState.objects.success.is_pending
+
+
+@pytest.mark.django_db
+def test_lookup_cache():
+    CheckoutState.objects.warm_cache()
+    with CaptureQueriesContext(connection) as queries:
+        CheckoutState.objects.fail
+        CheckoutState.objects.pending
+        CheckoutState.objects.request
+        CheckoutState.objects.success
+    assert 0 == len(queries)
+
+
+@pytest.mark.django_db
+def test_lookup_cache_save():
+    obj = CheckoutState.objects.success
+    obj.name = 'Paid'
+    obj.save()
+    assert 'Paid' == CheckoutState.objects.success.name
+    obj.name = 'Success'
+    obj.save()
+    assert 'Success' == CheckoutState.objects.success.name
+
+
+@pytest.mark.django_db
+def test_lookup_does_not_exist():
+    with pytest.raises(CheckoutState.DoesNotExist):
+        CheckoutState.objects.lookup('does-not-exist')
@@ -0,0 +1,16 @@
+# -*- encoding: utf-8 -*-
+from unittest import mock
+
+from django.core.cache import cache
+
+from checkout import dispatch
+
+
+def test_process_mail():
+    """Requests to process the mail queue are combined."""
+    cache.delete(dispatch.PROCESS_MAIL_CACHE_KEY)
+    with mock.patch('checkout.dispatch.process_mail_task') as mock_task:
+        dispatch.process_mail()
+        dispatch.process_mail()
+    assert 1 == mock_task.apply_async.call_count
+    cache.delete(dispatch.PROCESS_MAIL_CACHE_KEY)
@@ -0,0 +1,169 @@
+# -*- encoding: utf-8 -*-
+import json
+import pytest
+import stripe
+
+from unittest import mock
+
+from checkout.gateway import (
+    FakeGateway,
+    gateway,
+    PooledHTTPClient,
+    StripeGateway,
+)
+
+
+def _response(data, status_code=200):
+    """A response from the Stripe API (for the pooled ``requests`` session)."""
+    return mock.Mock(
+        content=json.dumps(data).encode(),
+        headers={},
+        status_code=status_code,
+    )
+
+
+def test_gateway():
+    assert gateway() is gateway()
+    assert isinstance(gateway().client, PooledHTTPClient)
+
+
+def test_gateway_setting(settings):
+    settings.CHECKOUT_PAYMENT_GATEWAY = 'checkout.gateway.FakeGateway'
+    assert isinstance(gateway(), FakeGateway)
+
+
+def test_charge_create():
+    """The request is sent using the pooled session."""
+    obj = StripeGateway('sk_test_123', 5, 2)
+    with mock.patch.object(obj.client.session, 'request') as mock_request:
+        mock_request.return_value = _response(
+            {'id': 'ch_1', 'object': 'charge', 'amount': 100, 'paid': True}
+        )
+        charge = obj.charge_create(
+            idempotency_key='checkout-1', amount=100, currency='GBP'
+        )
+    assert isinstance(charge, stripe.Charge)
+    assert 'ch_1' == charge.id
+    assert charge.paid is True
+    assert 1 == mock_request.call_count
+    args, kwargs = mock_request.call_args
+    assert 'post' == args[0]
+    assert args[1].endswith('/v1/charges')
+    assert 'amount=100' in kwargs['data']
+    assert 'Bearer sk_test_123' == kwargs['headers']['Authorization']
+    assert 'checkout-1' == kwargs['headers']['Idempotency-Key']
+    assert 5 == kwargs['timeout']
+
+
+def test_charge_create_card_error():
+    obj = StripeGateway('sk_test_123', 5, 2)
+    with mock.patch.object(obj.client.session, 'request') as mock_request:
+        mock_request.return_value = _response(
+            {'error': {
+                'type': 'card_error',
+                'code': 'card_declined',
+                'message': 'Your card was declined.',
+            }},
+            status_code=402,
+        )
+        with pytest.raises(stripe.CardError) as e:
+            obj.charge_create(amount=100, currency='GBP')
+    assert 'card_declined' == e.value.code
+
+
+def test_card_expiry():
+    obj = StripeGateway('sk_test_123', 5, 2)
+    with mock.patch.object(obj.client.session, 'request') as mock_request:
+        mock_request.return_value = _response({
+            'id': 'cus_123',
+            'object': 'customer',
+            'default_card': '1234',
+            'cards': {
+                'object': 'list',
+                'data': [
+                    {'id': '5678', 'exp_month': '1', 'exp_year': '2030'},
+                    {'id': '1234', 'exp_month': '8', 'exp_year': '2050'},
+                ],
+            },
+        })
+        assert (2050, 8) == obj.card_expiry('cus_123')
+    args, kwargs = mock_request.call_args
+    assert 'get' == args[0]
+    assert args[1].endswith('/v1/customers/cus_123')
+
+
+def test_fake_charge():
+    obj = FakeGateway(latency=0, decline_rate=0, rate_limit_rate=0)
+    charge = obj.charge_create(amount=100, currency='GBP', customer='cus_1')
+    assert 100 == charge.amount
+    assert [charge] == obj.charges
+
+
+def test_fake_charge_decline():
+    obj = FakeGateway(latency=0, decline_rate=1, rate_limit_rate=0)
+    with pytest.raises(stripe.CardError) as e:
+        obj.charge_create(amount=100, currency='GBP', customer='cus_1')
+    assert 'card_declined' == e.value.code
+    assert [] == obj.charges
+
+
+def test_fake_customer():
+    obj = FakeGateway(latency=0, decline_rate=0, rate_limit_rate=0)
+    customer = obj.customer_create(email='a@b.com', card='tok_1')
+    obj.customer_update(customer.id, description='Patrick')
+    result = obj.customer_retrieve(customer.id)
+    assert 'Patrick' == result.description
+    assert (FakeGateway.EXPIRY_YEAR, 12) == obj.card_expiry(customer.id)
+
+
+def test_fake_rate_limit():
+    obj = FakeGateway(latency=0, decline_rate=0, rate_limit_rate=1)
+    with pytest.raises(stripe.StripeError) as e:
+        obj.customer_retrieve('cus_1')
+    assert 429 == e.value.http_status
+
+
+def test_charge_create_retry():
+    obj = StripeGateway('sk_test_123', 5, 2)
+    with mock.patch.object(obj, 'charge_create') as mock_create:
+        mock_create.side_effect = [
+            stripe.APIConnectionError('Timeout'),
+            stripe.StripeError('Too many requests', http_status=429),
+            {'id': 'ch_1'},
+        ]
+        with mock.patch('time.sleep') as mock_sleep:
+            charge = obj.charge_create_retry('checkout-1', amount=100)
+    assert 'ch_1' == charge['id']
+    assert 3 == mock_create.call_count
+    assert 2 == mock_sleep.call_count
+    mock_create.assert_called_with(amount=100, idempotency_key='checkout-1')
+
+
+def test_charge_create_retry_card_error():
+    obj = StripeGateway('sk_test_123', 5, 2)
+    with mock.patch.object(obj, 'charge_create') as mock_create:
+        mock_create.side_effect = stripe.CardError(
+            'Your card was declined.', None, 'card_declined', http_status=402
+        )
+        with pytest.raises(stripe.CardError):
+            obj.charge_create_retry('checkout-1', amount=100)
+    assert 1 == mock_create.call_count
+
+
+def test_charge_create_retry_give_up():
+    obj = StripeGateway('sk_test_123', 5, 2)
+    with mock.patch.object(obj, 'charge_create') as mock_create:
+        mock_create.side_effect = stripe.APIConnectionError('Timeout')
+        with mock.patch('time.sleep'):
+            with pytest.raises(stripe.APIConnectionError):
+                obj.charge_create_retry('checkout-1', retries=2, amount=100)
+    assert 3 == mock_create.call_count
+
+
+def test_fake_charge_idempotency_key():
+    obj = FakeGateway(latency=0, decline_rate=0, rate_limit_rate=0)
+    charge = obj.charge_create(idempotency_key='checkout-1', amount=100)
+    assert charge is obj.charge_create(
+        idempotency_key='checkout-1', amount=100
+    )
+    assert [charge] == obj.charges
@@ -1,7 +1,10 @@
 # -*- encoding: utf-8 -*-
 from django.test import TestCase
 
-from checkout.management.commands import init_app_checkout
+from checkout.management.commands import (
+    init_app_checkout,
+    refresh_checkout_details,
+)
 
 
 class TestCommand(TestCase):
@@ -10,3 +13,7 @@ class TestCommand(TestCase):
         """ Test the management command """
         command = init_app_checkout.Command()
         command.handle()
+
+    def test_refresh_checkout_details(self):
+        command = refresh_checkout_details.Command()
+        command.handle()
@@ -6,6 +6,8 @@ from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from checkout.tests.factories import PaymentPlanFactory
 
@@ -110,3 +112,52 @@ def test_example():
         item[1] for item in plan.example(deposit_due_date, Decimal('100'))
     ]
     assert [Decimal('50'), Decimal('25'), Decimal('25')] == result
+
+
+@pytest.mark.django_db
+def test_cached_example():
+    plan = PaymentPlanFactory(deposit=50, count=2, interval=1)
+    deposit_due_date = date(2015, 1, 2)
+    expect = plan.example(deposit_due_date, Decimal('100'))
+    assert expect == plan.cached_example(deposit_due_date, Decimal('100'))
+    with CaptureQueriesContext(connection) as queries:
+        result = plan.cached_example(deposit_due_date, Decimal('100'))
+    assert 0 == len(queries)
+    assert expect == result
+
+
+@pytest.mark.django_db
+def test_cached_example_update():
+    plan = PaymentPlanFactory(deposit=50, count=2, interval=1)
+    deposit_due_date = date(2015, 1, 2)
+    plan.cached_example(deposit_due_date, Decimal('100'))
+    plan.deposit = 20
+    plan.save()
+    example = plan.cached_example(deposit_due_date, Decimal('100'))
+    result = [item[1] for item in example]
+    assert [Decimal('20'), Decimal('40'), Decimal('40')] == result
+
+
+@pytest.mark.django_db
+def test_schedules():
+    plan = PaymentPlanFactory(deposit=15, count=3, interval=1)
+    items = [
+        (date(2015, 1, 2), Decimal('100')),
+        (date(2015, 1, 20), Decimal('200.01')),
+        (date(2015, 11, 30), Decimal('99.999')),
+        (date(2015, 12, 1), Decimal('0')),
+    ]
+    result = plan.schedules(items)
+    assert [plan.example(d, total) for d, total in items] == result
+
+
+@pytest.mark.django_db
+def test_schedules_pennies():
+    plan = PaymentPlanFactory(deposit=50, count=3, interval=2)
+    result = plan.schedules([(date(2015, 1, 2), Decimal('200'))], pennies=True)
+    assert [[
+        (date(2015, 1, 2), 10000),
+        (date(2015, 3, 1), 3333),
+        (date(2015, 5, 1), 3333),
+        (date(2015, 7, 1), 3334),
+    ]] == result
@@ -0,0 +1,66 @@
+# -*- encoding: utf-8 -*-
+import pytest
+import time
+
+from checkout.models import CheckoutError
+from checkout.webhook import (
+    signature,
+    verify_signature,
+)
+
+
+PAYLOAD = b'{"id": "evt_1", "type": "charge.succeeded"}'
+SECRET = 'whsec_test'
+
+
+def _header(payload=PAYLOAD, secret=SECRET, timestamp=None):
+    if timestamp is None:
+        timestamp = int(time.time())
+    return 't={},v1={}'.format(
+        timestamp, signature(payload, secret, timestamp)
+    )
+
+
+def test_verify_signature():
+    verify_signature(PAYLOAD, _header(), SECRET)
+
+
+def test_verify_signature_many():
+    """Stripe sends more than one signature when the secret is rolled."""
+    timestamp = int(time.time())
+    header = 't={},v1={},v1={}'.format(
+        timestamp,
+        signature(PAYLOAD, 'whsec_old', timestamp),
+        signature(PAYLOAD, SECRET, timestamp),
+    )
+    verify_signature(PAYLOAD, header, SECRET)
+
+
+def test_verify_signature_does_not_match():
+    with pytest.raises(CheckoutError) as e:
+        verify_signature(PAYLOAD, _header(secret='whsec_other'), SECRET)
+    assert 'does not match' in str(e.value)
+
+
+def test_verify_signature_payload_changed():
+    with pytest.raises(CheckoutError):
+        verify_signature(PAYLOAD + b' ', _header(), SECRET)
+
+
+def test_verify_signature_missing():
+    with pytest.raises(CheckoutError) as e:
+        verify_signature(PAYLOAD, None, SECRET)
+    assert 'missing' in str(e.value)
+
+
+def test_verify_signature_no_secret():
+    with pytest.raises(CheckoutError) as e:
+        verify_signature(PAYLOAD, _header(), None)
+    assert 'not set' in str(e.value)
+
+
+def test_verify_signature_too_old():
+    header = _header(timestamp=int(time.time()) - 600)
+    with pytest.raises(CheckoutError) as e:
+        verify_signature(PAYLOAD, header, SECRET)
+    assert 'too old' in str(e.value)
@@ -9,6 +9,7 @@ from .views import (
     CheckoutAuditListView,
     CheckoutCardRefreshListView,
     CheckoutListView,
+    CheckoutStatusView,
     ObjectPaymentPlanCardExpiryListView,
     ObjectPaymentPlanDeleteView,
     ObjectPaymentPlanInstalmentDetailView,
@@ -18,6 +19,7 @@ from .views import (
     PaymentPlanDeleteView,
     PaymentPlanListView,
     PaymentPlanUpdateView,
+    StripeWebhookView,
 )
 
 
@@ -31,6 +33,10 @@ urlpatterns = patterns(
         view=CheckoutAuditListView.as_view(),
         name='checkout.list.audit'
         ),
+    url(regex=r'^status/(?P<pk>\d+)/$',
+        view=CheckoutStatusView.as_view(),
+        name='checkout.status'
+        ),
     url(regex=r'^customer/card/refresh/$',
         view=CheckoutCardRefreshListView.as_view(),
         name='checkout.card.refresh.list'
@@ -75,4 +81,8 @@ urlpatterns = patterns(
         view=PaymentPlanUpdateView.as_view(),
         name='checkout.payment.plan.update'
         ),
+    url(regex=r'^stripe/webhook/$',
+        view=StripeWebhookView.as_view(),
+        name='checkout.stripe.webhook'
+        ),
 )
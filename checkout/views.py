@@ -8,23 +8,30 @@ from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
 from django.db import transaction
-from django.http import HttpResponseRedirect
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+)
 from django.utils import timezone
 from django.views.generic import (
     CreateView,
     DetailView,
     ListView,
     UpdateView,
+    View,
 )
 
 from braces.views import (
+    CsrfExemptMixin,
     LoginRequiredMixin,
     StaffuserRequiredMixin,
 )
 
 from base.view_utils import BaseMixin
-from mail.tasks import process_mail
 
+from . import dispatch
 from .forms import (
     ObjectPaymentPlanEmptyForm,
     ObjectPaymentPlanInstalmentEmptyForm,
@@ -37,13 +44,16 @@ from .models import (
     CheckoutAction,
     CheckoutError,
     CheckoutAdditional,
+    CheckoutState,
     CheckoutSettings,
     CURRENCY,
     Customer,
     ObjectPaymentPlan,
     ObjectPaymentPlanInstalment,
     PaymentPlan,
+    StripeEvent,
 )
+from .webhook import verify_signature
 
 
 CONTENT_OBJECT_PK = 'content_object_pk'
@@ -91,12 +101,94 @@ def _check_perm_success(request, payment):
 def payment_plan_example(total):
     checkout_settings = CheckoutSettings.objects.settings
     payment_plan = checkout_settings.default_payment_plan
-    return payment_plan.example(date.today(), total)
+    return payment_plan.cached_example(date.today(), total)
+
+
+class CursorPage(object):
+    """A page of results for the ``CursorPaginateMixin``."""
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class CursorPaginateMixin(object):
+    """Keyset (cursor) pagination for a ``ListView``.
+
+    The page is selected using the ``after`` or ``before`` parameter e.g.
+    ``?after=123`` (see ``checkout/_paginate_cursor.html``).  We don't count
+    the rows or use an offset, so the cost of a page does not depend on how
+    far through the list we are.
+
+    ``cursor_ordering`` must be a unique field e.g. ``pk`` or ``-pk``.
+
+    """
+
+    cursor_ordering = '-pk'
+
+    def _cursor(self, name):
+        value = self.request.GET.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise Http404("Invalid cursor '{}'".format(value))
+
+    def paginate_queryset(self, queryset, page_size):
+        field = self.cursor_ordering.lstrip('-')
+        descending = self.cursor_ordering.startswith('-')
+        newer, older = ('gt', 'lt') if descending else ('lt', 'gt')
+        before = self._cursor('before')
+        if before is None:
+            after = self._cursor('after')
+            queryset = queryset.order_by(self.cursor_ordering)
+            if after is not None:
+                queryset = queryset.filter(
+                    **{'{}__{}'.format(field, older): after}
+                )
+            rows = list(queryset[:page_size + 1])
+            has_next = len(rows) > page_size
+            has_previous = after is not None
+            rows = rows[:page_size]
+        else:
+            # read backwards from the cursor, then reverse the page
+            reverse = field if descending else '-{}'.format(field)
+            queryset = queryset.filter(
+                **{'{}__{}'.format(field, newer): before}
+            ).order_by(reverse)
+            rows = list(queryset[:page_size + 1])
+            has_next = True
+            has_previous = len(rows) > page_size
+            rows = list(reversed(rows[:page_size]))
+        next_cursor = previous_cursor = None
+        if rows and has_next:
+            next_cursor = getattr(rows[-1], field)
+        if rows and has_previous:
+            previous_cursor = getattr(rows[0], field)
+        page = CursorPage(rows, next_cursor, previous_cursor)
+        return (None, page, rows, page.has_other_pages())
 
 
 class CheckoutAuditListView(
         LoginRequiredMixin, StaffuserRequiredMixin,
-        BaseMixin, ListView):
+        CursorPaginateMixin, BaseMixin, ListView):
 
     paginate_by = 10
 
@@ -111,8 +203,9 @@ class CheckoutAuditListView(
 
 class CheckoutCardRefreshListView(
         LoginRequiredMixin, StaffuserRequiredMixin,
-        BaseMixin, ListView):
+        CursorPaginateMixin, BaseMixin, ListView):
 
+    cursor_ordering = 'pk'
     paginate_by = 10
     template_name = 'checkout/card_refresh_list.html'
 
@@ -122,7 +215,7 @@ class CheckoutCardRefreshListView(
 
 class CheckoutListView(
         LoginRequiredMixin, StaffuserRequiredMixin,
-        BaseMixin, ListView):
+        CursorPaginateMixin, BaseMixin, ListView):
 
     paginate_by = 10
 
@@ -149,7 +242,7 @@ class CheckoutMixin(object):
         actions = self.object.checkout_actions
         result = {}
         for slug in actions:
-            obj = CheckoutAction.objects.get(slug=slug)
+            obj = CheckoutAction.objects.lookup(slug)
             result[slug] = dict(
                 name=obj.name,
                 payment=obj.payment,
@@ -160,11 +253,20 @@ class CheckoutMixin(object):
         data = form.invoice_data()
         CheckoutAdditional.objects.create_checkout_Additional(checkout, **data)
 
+    def _form_valid_async(self, checkout, token):
+        """Take the payment in the background (``CHECKOUT_ASYNC``).
+
+        The browser is redirected to the status page, which waits for the
+        task to succeed (or fail).
+
+        """
+        dispatch.process_checkout(checkout, token, self.request)
+        return HttpResponseRedirect(
+            reverse('checkout.status', args=[checkout.pk])
+        )
+
     def _form_valid_stripe(self, checkout, token):
-        customer = Customer.objects.init_customer(self.object, token)
-        checkout.customer = customer
-        checkout.save()
-        checkout.charge_user(self.request.user)
+        checkout.charge_token(token, self.request.user)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -208,7 +310,7 @@ class CheckoutMixin(object):
         self.object = form.save(commit=False)
         token = form.cleaned_data['token']
         slug = form.cleaned_data['action']
-        action = CheckoutAction.objects.get(slug=slug)
+        action = CheckoutAction.objects.lookup(slug)
         checkout = None
         try:
             with transaction.atomic():
@@ -222,15 +324,16 @@ class CheckoutMixin(object):
                     raise CheckoutError(
                         "No checkout 'token' for: '{}'".format(self.object)
                     )
+                if getattr(settings, 'CHECKOUT_ASYNC', False):
+                    return self._form_valid_async(checkout, token)
                 self._form_valid_stripe(checkout, token)
             with transaction.atomic():
                 if action.invoice:
                     self._form_valid_invoice(checkout, form)
                 checkout.success()
-                checkout.notify(self.request)
                 #self.object.checkout_mail(action)
+            dispatch.notify(checkout, self.request)
             url = self.object.checkout_success_url(checkout.pk)
-            process_mail.delay()
         except CheckoutError as e:
             logger.error(e)
             if checkout:
@@ -257,11 +360,77 @@ class CheckoutSuccessMixin(object):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         _check_perm_success(self.request, self.object)
-        if self.object.action == CheckoutAction.objects.payment_plan:
+        if self.object.action_id == CheckoutAction.objects.payment_plan.pk:
             context.update(example=payment_plan_example(self.object.total))
         return context
 
 
+class CheckoutStatusView(BaseMixin, DetailView):
+    """Wait for an asynchronous checkout (``CHECKOUT_ASYNC``).
+
+    The page refreshes until the payment succeeds (or fails), then redirects
+    to the ``checkout_success_url`` (or ``checkout_fail_url``) of the content
+    object.
+
+    If the task hasn't started to take the payment after
+    ``CHECKOUT_ASYNC_TIMEOUT_SECONDS``, we fail the checkout (so the task
+    won't take the payment) and redirect to the ``checkout_fail_url``.  If
+    the task has asked Stripe for the money (the 'request' state), we can't
+    fail the checkout, so we tell the customer the payment is still being
+    processed.
+
+    """
+
+    model = Checkout
+    template_name = 'checkout/checkout_status.html'
+
+    def _fail(self):
+        """Fail the checkout (if the task hasn't started the payment)."""
+        with transaction.atomic():
+            count = Checkout.objects.filter(
+                pk=self.object.pk,
+                state=CheckoutState.objects.pending,
+            ).update(
+                state=CheckoutState.objects.fail,
+                modified=timezone.now(),
+            )
+            if count:
+                logger.error(
+                    'checkout {} is still pending (timed out)'.format(
+                        self.object.pk
+                    )
+                )
+                self.object.refresh_from_db()
+                self.object.fail()
+        self.object.refresh_from_db()
+
+    def _timed_out(self):
+        seconds = getattr(settings, 'CHECKOUT_ASYNC_TIMEOUT_SECONDS', 120)
+        td = timezone.now() - self.object.created
+        return td.total_seconds() > seconds
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(dict(timed_out=self._timed_out()))
+        return context
+
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        # the success page checks the age of the checkout
+        _check_perm(request, self.object.content_object)
+        if self.object.is_pending and self._timed_out():
+            self._fail()
+        content_object = self.object.content_object
+        if self.object.failed:
+            url = content_object.checkout_fail_url(self.object.pk)
+            return HttpResponseRedirect(url)
+        if self.object.state_id == CheckoutState.objects.success.pk:
+            url = content_object.checkout_success_url(self.object.pk)
+            return HttpResponseRedirect(url)
+        context = self.get_context_data(object=self.object)
+        return self.render_to_response(context)
+
+
 class ObjectPaymentPlanDeleteView(
         LoginRequiredMixin, StaffuserRequiredMixin, BaseMixin, UpdateView):
 
@@ -293,7 +462,9 @@ class ObjectPaymentPlanListView(
         return context
 
     def get_queryset(self):
-        return ObjectPaymentPlan.objects.outstanding_payment_plans
+        return ObjectPaymentPlan.objects.prefetch_payments(
+            ObjectPaymentPlan.objects.outstanding_payment_plans
+        )
 
 
 class ObjectPaymentPlanCardExpiryListView(
@@ -303,8 +474,17 @@ class ObjectPaymentPlanCardExpiryListView(
     paginate_by = 10
     template_name = 'checkout/card_expiry_list.html'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(dict(
+            object_list=ObjectPaymentPlan.objects.card_expiry_dates(
+                context['object_list']
+            ),
+        ))
+        return context
+
     def get_queryset(self):
-        return ObjectPaymentPlan.objects.report_card_expiry_dates
+        return ObjectPaymentPlan.objects.card_expiry_payment_plans
 
 
 class ObjectPaymentPlanInstalmentDetailView(
@@ -407,3 +587,29 @@ class PaymentPlanUpdateView(
 
     def get_success_url(self):
         return reverse('checkout.payment.plan.list')
+
+
+class StripeWebhookView(CsrfExemptMixin, View):
+    """Receive the webhook events from Stripe.
+
+    The signature is checked using ``STRIPE_WEBHOOK_SECRET``.  The event is
+    stored and we reply straight away.  The events are applied in batches
+    (see ``StripeEventManager.process_events``).
+
+    """
+
+    def post(self, request, *args, **kwargs):
+        try:
+            verify_signature(
+                request.body,
+                request.META.get('HTTP_STRIPE_SIGNATURE'),
+                getattr(settings, 'STRIPE_WEBHOOK_SECRET', None),
+            )
+            data = json.loads(request.body.decode('utf-8'))
+            with transaction.atomic():
+                StripeEvent.objects.create_stripe_event(data)
+        except (CheckoutError, KeyError, ValueError) as e:
+            logger.error('Stripe webhook: {}'.format(e))
+            return HttpResponseBadRequest()
+        dispatch.process_stripe_events()
+        return HttpResponse()
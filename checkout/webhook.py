@@ -0,0 +1,67 @@
+# -*- encoding: utf-8 -*-
+"""Check the signature of a Stripe webhook request.
+
+The ``Stripe-Signature`` header has a timestamp and one (or more) HMAC
+SHA-256 signatures of ``<timestamp>.<payload>`` using the endpoint secret
+(``STRIPE_WEBHOOK_SECRET``) e.g::
+
+  t=1492774577,v1=5257a869e7ecebeda32affa62cdca3fa51cad7e77a0e56ff536d0ce8e1
+
+"""
+import hashlib
+import hmac
+import time
+
+from .models import CheckoutError
+
+
+SIGNATURE_SCHEME = 'v1'
+
+
+def _parse_header(header):
+    timestamp = None
+    signatures = []
+    for item in header.split(','):
+        key, _, value = item.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == SIGNATURE_SCHEME:
+            signatures.append(value)
+    return timestamp, signatures
+
+
+def signature(payload, secret, timestamp):
+    """The signature of ``payload`` (``bytes``) at ``timestamp``."""
+    signed_payload = '{}.'.format(timestamp).encode() + payload
+    return hmac.new(
+        secret.encode(), signed_payload, hashlib.sha256
+    ).hexdigest()
+
+
+def verify_signature(payload, header, secret, tolerance=300):
+    """Check the ``Stripe-Signature`` header for the ``payload``.
+
+    The request must have been signed in the last ``tolerance`` seconds (so
+    an old request can't be replayed).
+
+    """
+    if not secret:
+        raise CheckoutError('Stripe webhook secret is not set')
+    timestamp, signatures = _parse_header(header or '')
+    if not timestamp or not signatures:
+        raise CheckoutError('Stripe webhook signature is missing')
+    try:
+        seconds = abs(time.time() - int(timestamp))
+    except ValueError as e:
+        raise CheckoutError(
+            "Stripe webhook timestamp is not valid: '{}'".format(timestamp)
+        ) from e
+    if seconds > tolerance:
+        raise CheckoutError(
+            'Stripe webhook timestamp is too old: {:.0f} seconds'.format(
+                seconds
+            )
+        )
+    expected = signature(payload, secret, timestamp)
+    if not any(hmac.compare_digest(expected, s) for s in signatures):
+        raise CheckoutError('Stripe webhook signature does not match')
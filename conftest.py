@@ -0,0 +1,23 @@
+# -*- encoding: utf-8 -*-
+import pytest
+
+from django.core.cache import cache
+
+
+@pytest.fixture(autouse=True)
+def clear_checkout_caches():
+    """Start each test with empty caches.
+
+    The lookup rows, checkout settings and notify email addresses are cached
+    by the process (and the dispatch timers by the Django cache), so a value
+    cached by one test would be used by the next (even though the rows were
+    rolled back).
+
+    """
+    from checkout.models import (
+        clear_lookup_cache,
+        clear_payment_plan_cache,
+    )
+    clear_lookup_cache()
+    clear_payment_plan_cache()
+    cache.clear()
@@ -2,6 +2,8 @@
 """ Django settings """
 import os
 
+from datetime import timedelta
+
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse_lazy
 
@@ -182,6 +184,14 @@ CAPTCHA_LETTER_ROTATION = None
 CAPTCHA_NOISE_FUNCTIONS = None
 CAPTCHA_TEST_MODE = True
 
+# the cache is shared by all the processes (see 'checkout.dispatch')
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': '127.0.0.1:6379:1',
+    }
+}
+
 # Celery
 BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
@@ -189,6 +199,14 @@ CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 CELERY_DEFAULT_QUEUE = 'checkout'
 # http://celery.readthedocs.org/en/latest/userguide/tasks.html#disable-rate-limits-if-they-re-not-used
 CELERY_DISABLE_RATE_LIMITS = True
+# the webhook events for a checkout which was still being processed are
+# applied by 'reconcile_payments' (see 'checkout.tasks')
+CELERYBEAT_SCHEDULE = {
+    'reconcile_payments': {
+        'task': 'checkout.tasks.reconcile_payments',
+        'schedule': timedelta(minutes=15),
+    },
+}
 
 # django-compressor
 COMPRESS_ENABLED = False # defaults to the opposite of DEBUG
@@ -227,3 +245,5 @@ SENDFILE_ROOT = 'media-private'
 STRIPE_CAPTION = 'pkimber.net'
 STRIPE_PUBLISH_KEY = get_env_variable('STRIPE_PUBLISH_KEY')
 STRIPE_SECRET_KEY = get_env_variable('STRIPE_SECRET_KEY')
+# optional - the webhook will reject all events if it isn't set
+STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
@@ -12,8 +12,25 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': '',
         'PORT': '',
+        # a file (rather than memory), so worker threads can share the test
+        # database (see ``test_process_payments_workers``)
+        'TEST': {
+            'NAME': 'test_temp.db',
+        },
+    }
+}
+
+# don't need redis for testing
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
 # http://docs.celeryproject.org/en/2.5/django/unit-testing.html
 CELERY_ALWAYS_EAGER = True
+
+# don't wait between retries when a test makes a Stripe request fail
+CHECKOUT_STRIPE_RETRY_SECONDS = 0
+
+STRIPE_WEBHOOK_SECRET = 'whsec_test'
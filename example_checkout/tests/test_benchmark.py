@@ -0,0 +1,162 @@
+# -*- encoding: utf-8 -*-
+"""Benchmark the checkout using the fake payment gateway.
+
+To run with more data, see ``checkout.tests.benchmark``.
+
+Each benchmark has a budget for the number of queries per operation.  We
+don't check the time (it depends on the machine running the tests).
+
+"""
+import pytest
+
+from datetime import date
+
+from django.core.urlresolvers import reverse
+
+from checkout.models import (
+    Checkout,
+    CheckoutAction,
+    CheckoutState,
+    Customer,
+    ObjectPaymentPlan,
+    ObjectPaymentPlanInstalment,
+)
+from checkout.tests.benchmark import (
+    benchmark,
+    benchmark_count,
+)
+from checkout.tests.factories import (
+    CheckoutFactory,
+    CustomerFactory,
+)
+from checkout.tests.helper import (
+    login_staff,
+    object_payment_plans,
+)
+from checkout.views import CONTENT_OBJECT_PK
+from login.tests.scenario import (
+    default_scenario_login,
+    get_user_staff,
+)
+from mail.tests.factories import NotifyFactory
+from .factories import SalesLedgerFactory
+
+
+@pytest.fixture
+def fake_gateway(settings):
+    settings.CHECKOUT_PAYMENT_GATEWAY = 'checkout.gateway.FakeGateway'
+    settings.CHECKOUT_FAKE_GATEWAY_DECLINE_RATE = 0
+    settings.CHECKOUT_FAKE_GATEWAY_LATENCY = 0
+    settings.CHECKOUT_FAKE_GATEWAY_RATE_LIMIT_RATE = 0
+
+
+def _check_queries(result, max_queries):
+    """Fail if an operation uses more than ``max_queries``."""
+    assert result.queries_per_operation <= max_queries, str(result)
+
+
+@pytest.mark.django_db
+def test_benchmark_checkout_form_valid(client, fake_gateway):
+    NotifyFactory()
+    sales_ledgers = [SalesLedgerFactory() for i in range(benchmark_count())]
+
+    def _post(obj):
+        session = client.session
+        session[CONTENT_OBJECT_PK] = obj.pk
+        session.save()
+        url = reverse('example.sales.ledger.checkout', args=[obj.pk])
+        response = client.post(url, {
+            'action': CheckoutAction.PAYMENT,
+            'token': 'my-testing-token',
+        })
+        assert 302 == response.status_code
+
+    result = benchmark('CheckoutMixin.form_valid', _post, sales_ledgers)
+    _check_queries(result, 75)
+    assert benchmark_count() == Checkout.objects.filter(
+        state=CheckoutState.objects.success
+    ).count()
+
+
+@pytest.mark.django_db
+def test_benchmark_checkout_charge(fake_gateway):
+    NotifyFactory()
+    default_scenario_login()
+    staff = get_user_staff()
+    sales_ledgers = []
+    for i in range(benchmark_count()):
+        obj = SalesLedgerFactory()
+        CustomerFactory(email=obj.checkout_email)
+        sales_ledgers.append(obj)
+    result = benchmark(
+        'Checkout.objects.charge',
+        lambda obj: Checkout.objects.charge(obj, staff),
+        sales_ledgers,
+    )
+    _check_queries(result, 30)
+    assert benchmark_count() == Checkout.objects.filter(
+        state=CheckoutState.objects.success
+    ).count()
+
+
+@pytest.mark.django_db
+def test_benchmark_process_payments(fake_gateway):
+    object_payment_plans(benchmark_count())
+    manager = ObjectPaymentPlanInstalment.objects
+    result = benchmark(
+        'process_payments',
+        lambda: manager.process_payments()['count'],
+    )
+    assert benchmark_count() == result.count
+    _check_queries(result, 30)
+
+
+@pytest.mark.django_db
+def test_benchmark_refresh_card_expiry_dates(fake_gateway):
+    object_payment_plans(benchmark_count())
+
+    def _refresh():
+        ObjectPaymentPlan.objects.refresh_card_expiry_dates()
+        return benchmark_count()
+
+    result = benchmark('refresh_card_expiry_dates', _refresh)
+    # the expiry dates are saved in batches (but a customer might be sent an
+    # email asking them to refresh their card)
+    _check_queries(result, 10)
+
+
+@pytest.mark.django_db
+def test_benchmark_view_audit(client):
+    login_staff(client)
+    for i in range(benchmark_count()):
+        CheckoutFactory(
+            action=CheckoutAction.objects.payment,
+            content_object=SalesLedgerFactory(),
+        )
+    url = reverse('checkout.list.audit')
+
+    def _get(count):
+        response = client.get(url)
+        assert 200 == response.status_code
+
+    result = benchmark(
+        'CheckoutAuditListView', _get, range(benchmark_count())
+    )
+    _check_queries(result, 15)
+
+
+@pytest.mark.django_db
+def test_benchmark_view_card_expiry(client):
+    login_staff(client)
+    object_payment_plans(benchmark_count())
+    Customer.objects.update(expiry_date=date.today())
+    url = reverse('checkout.object.payment.plan.card.expiry.list')
+
+    def _get(count):
+        response = client.get(url)
+        assert 200 == response.status_code
+
+    result = benchmark(
+        'ObjectPaymentPlanCardExpiryListView', _get, range(benchmark_count())
+    )
+    _check_queries(result, 15)
@@ -1,10 +1,33 @@
 # -*- encoding: utf-8 -*-
 import pytest
 
-from django.db import IntegrityError
+from datetime import (
+    date,
+    datetime,
+    time,
+)
 
-from checkout.models import CheckoutAction
-from checkout.tests.factories import CheckoutFactory
+from django.contrib.auth.models import AnonymousUser
+from django.db import (
+    connection,
+    IntegrityError,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from checkout.gateway import StripeGateway
+from checkout.models import (
+    Checkout,
+    CheckoutAction,
+    CheckoutState,
+    notify_email_addresses,
+    refresh_checkout_details,
+)
+from checkout.tests.factories import (
+    CheckoutFactory,
+    CustomerFactory,
+)
+from mail.tests.factories import NotifyFactory
 
 from example_checkout.tests.factories import SalesLedgerFactory
 
@@ -136,6 +159,38 @@ from example_checkout.tests.factories import SalesLedgerFactory
 #    ]
 
 
+def _audit_queries():
+    with CaptureQueriesContext(connection) as queries:
+        for obj in Checkout.objects.audit():
+            obj.action.name
+            obj.content_object_url
+            obj.customer
+            obj.failed
+            obj.is_payment_plan
+            obj.state.name
+            obj.user
+    return len(queries)
+
+
+@pytest.mark.django_db
+def test_audit_queries():
+    """The number of queries should not depend on the number of rows."""
+    for count in range(2):
+        CheckoutFactory(
+            action=CheckoutAction.objects.payment,
+            content_object=SalesLedgerFactory(),
+        )
+    expect = _audit_queries()
+    for count in range(3):
+        CheckoutFactory(
+            action=CheckoutAction.objects.payment,
+            content_object=SalesLedgerFactory(),
+            state=CheckoutState.objects.fail,
+        )
+    assert 5 == Checkout.objects.audit().count()
+    assert expect == _audit_queries()
+
+
 @pytest.mark.django_db
 def test_no_content_object():
     """Payments must be linked to a content object."""
@@ -226,3 +281,162 @@ def test_is_payment_plan_not():
 #    sales_ledger.create_payment()
 #    with pytest.raises(IntegrityError):
 #        sales_ledger.create_payment()
+
+
+@pytest.mark.django_db
+def test_checkout_email_and_name():
+    """The email address and name are copied from the content object."""
+    sales_ledger = SalesLedgerFactory()
+    checkout = CheckoutFactory(
+        action=CheckoutAction.objects.payment,
+        content_object=sales_ledger,
+    )
+    assert sales_ledger.checkout_email == checkout.checkout_email
+    assert sales_ledger.checkout_name == checkout.checkout_name
+    assert sales_ledger.checkout_email == str(checkout)
+
+
+@pytest.mark.django_db
+def test_refresh_checkout_details():
+    sales_ledger = SalesLedgerFactory()
+    checkout = CheckoutFactory(
+        action=CheckoutAction.objects.payment,
+        content_object=sales_ledger,
+    )
+    CheckoutFactory(
+        action=CheckoutAction.objects.payment,
+        content_object=SalesLedgerFactory(),
+    )
+    user = sales_ledger.contact.user
+    user.email = 'new@pkimber.net'
+    user.save()
+    assert 1 == refresh_checkout_details(Checkout.objects.all())
+    checkout.refresh_from_db()
+    assert 'new@pkimber.net' == checkout.checkout_email
+
+
+@pytest.mark.django_db
+def test_notify_email_addresses():
+    NotifyFactory(email='a@pkimber.net')
+    assert ['a@pkimber.net'] == notify_email_addresses()
+    with CaptureQueriesContext(connection) as queries:
+        notify_email_addresses()
+    assert 0 == len(queries)
+    # saving a 'Notify' will clear the cache
+    NotifyFactory(email='b@pkimber.net')
+    assert ['a@pkimber.net', 'b@pkimber.net'] == sorted(
+        notify_email_addresses()
+    )
+
+
+@pytest.mark.django_db
+def test_charge_idempotency_key(mocker):
+    """The charge is tagged with the checkout (so it can be retried)."""
+    mock_create = mocker.patch.object(StripeGateway, 'charge_create')
+    NotifyFactory()
+    sales_ledger = SalesLedgerFactory()
+    CustomerFactory(email=sales_ledger.checkout_email)
+    checkout = Checkout.objects.charge(sales_ledger, AnonymousUser())
+    assert 'checkout-{}'.format(checkout.uuid) == checkout.idempotency_key
+    kwargs = mock_create.call_args[1]
+    assert checkout.idempotency_key == kwargs['idempotency_key']
+    assert {'checkout_pk': checkout.pk} == kwargs['metadata']
+
+
+@pytest.mark.django_db
+def test_process_checkout_error(mocker):
+    """An unexpected error, so the status page doesn't wait for ever."""
+    mocker.patch.object(
+        StripeGateway, 'customer_create', side_effect=ValueError('boom')
+    )
+    checkout = CheckoutFactory(
+        action=CheckoutAction.objects.payment,
+        content_object=SalesLedgerFactory(),
+        state=CheckoutState.objects.pending,
+    )
+    with pytest.raises(ValueError):
+        Checkout.objects.process_checkout(checkout.pk, 'my-testing-token')
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.fail == checkout.state
+
+
+@pytest.mark.django_db
+def test_idempotency_key_unique():
+    """The key doesn't use the ``pk`` (which might be used again)."""
+    checkout_1 = CheckoutFactory(
+        action=CheckoutAction.objects.payment,
+        content_object=SalesLedgerFactory(),
+    )
+    checkout_2 = CheckoutFactory(
+        action=CheckoutAction.objects.payment,
+        content_object=SalesLedgerFactory(),
+    )
+    assert checkout_1.idempotency_key != checkout_2.idempotency_key
+
+
+@pytest.mark.django_db
+def test_process_checkout_error_after_charge(mocker):
+    """The card was charged, so don't fail the checkout."""
+    mocker.patch.object(StripeGateway, 'charge_create')
+    mocker.patch.object(StripeGateway, 'customer_create')
+    mocker.patch.object(Checkout, 'success', side_effect=ValueError('boom'))
+    checkout = CheckoutFactory(
+        action=CheckoutAction.objects.payment,
+        content_object=SalesLedgerFactory(),
+        state=CheckoutState.objects.pending,
+    )
+    with pytest.raises(ValueError):
+        Checkout.objects.process_checkout(checkout.pk, 'my-testing-token')
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.request == checkout.state
+
+
+def _checkout(state, checkout_date, content_object=None):
+    return CheckoutFactory(
+        action=CheckoutAction.objects.payment,
+        checkout_date=checkout_date,
+        content_object=content_object or SalesLedgerFactory(),
+        state=state,
+    )
+
+
+def _midday(day):
+    return timezone.make_aware(datetime.combine(day, time(12)))
+
+
+@pytest.mark.django_db
+def test_for_content_object():
+    sales_ledger = SalesLedgerFactory()
+    c1 = _checkout(
+        CheckoutState.objects.fail, timezone.now(), sales_ledger
+    )
+    _checkout(CheckoutState.objects.success, timezone.now())
+    c3 = _checkout(
+        CheckoutState.objects.success, timezone.now(), sales_ledger
+    )
+    qs = Checkout.objects.for_content_object(sales_ledger)
+    assert [c3.pk, c1.pk] == [obj.pk for obj in qs]
+
+
+@pytest.mark.django_db
+def test_success_between():
+    success = CheckoutState.objects.success
+    _checkout(success, _midday(date(2015, 9, 30)))
+    c2 = _checkout(success, _midday(date(2015, 10, 1)))
+    c3 = _checkout(success, _midday(date(2015, 10, 31)))
+    _checkout(success, _midday(date(2015, 11, 1)))
+    _checkout(CheckoutState.objects.fail, _midday(date(2015, 10, 2)))
+    qs = Checkout.objects.success_between(
+        date(2015, 10, 1), date(2015, 10, 31)
+    )
+    assert [c3.pk, c2.pk] == [obj.pk for obj in qs]
+
+
+@pytest.mark.django_db
+def test_fail_between():
+    fail = CheckoutState.objects.fail
+    c1 = _checkout(fail, _midday(date(2015, 10, 1)))
+    _checkout(fail, _midday(date(2015, 10, 2)))
+    _checkout(CheckoutState.objects.success, _midday(date(2015, 10, 1)))
+    qs = Checkout.objects.fail_between(date(2015, 10, 1), date(2015, 10, 1))
+    assert [c1.pk] == [obj.pk for obj in qs]
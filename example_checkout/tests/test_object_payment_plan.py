@@ -1,13 +1,20 @@
 # -*- encoding: utf-8 -*-
 import pytest
+import reversion
+import stripe
 
 from datetime import date
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 from unittest import mock
 
-from django.db import transaction
+from django.db import (
+    connection,
+    transaction,
+)
+from django.test.utils import CaptureQueriesContext
 
+from checkout.gateway import StripeGateway
 from checkout.models import (
     CheckoutError,
     CheckoutState,
@@ -20,6 +27,7 @@ from checkout.tests.factories import (
     ObjectPaymentPlanInstalmentFactory,
     PaymentPlanFactory,
 )
+from login.tests.factories import UserFactory
 from mail.models import Message
 from mail.tests.factories import MailTemplateFactory
 from .factories import ContactFactory
@@ -87,6 +95,128 @@ def test_create_object_payment_plan():
     ] == result
 
 
+@pytest.mark.django_db
+def test_create_object_payment_plans():
+    payment_plan = PaymentPlanFactory(deposit=20, count=2, interval=1)
+    c1 = ContactFactory()
+    c2 = ContactFactory()
+    c3 = ContactFactory()
+    with transaction.atomic():
+        ObjectPaymentPlan.objects.create_object_payment_plan(
+            c2, payment_plan, Decimal('10')
+        )
+    plans, clashes = ObjectPaymentPlan.objects.create_object_payment_plans([
+        (c1, payment_plan, Decimal('100')),
+        (c2, payment_plan, Decimal('200')),
+        (c3, payment_plan, Decimal('300')),
+        (c1, payment_plan, Decimal('400')),
+    ])
+    assert [c1, c3] == [obj.content_object for obj in plans]
+    assert [c2, c1] == [item[0] for item in clashes]
+    assert 3 == ObjectPaymentPlan.objects.count()
+    obj = ObjectPaymentPlan.objects.for_content_object(c3)
+    assert obj.pk == plans[1].pk
+    assert [(1, Decimal('60'), date.today(), True)] == [
+        (p.count, p.amount, p.due, p.state.is_pending) for p in obj.payments
+    ]
+    # the instalments can be created after the deposit has been paid
+    obj.create_instalments()
+    assert 3 == obj.payment_count
+
+
+@pytest.mark.django_db
+def test_create_object_payment_plans_concurrent(mocker):
+    """Another process creates a plan after we check for clashes."""
+    payment_plan = PaymentPlanFactory(deposit=20, count=2, interval=1)
+    c1 = ContactFactory()
+    c2 = ContactFactory()
+    with transaction.atomic():
+        ObjectPaymentPlan.objects.create_object_payment_plan(
+            c2, payment_plan, Decimal('10')
+        )
+    manager = ObjectPaymentPlan.objects
+    plan_pks = manager._plan_pks
+    calls = []
+
+    def _plan_pks(keys):
+        calls.append(keys)
+        # the first check doesn't find the plan for 'c2'
+        return {} if len(calls) == 1 else plan_pks(keys)
+
+    mocker.patch.object(manager, '_plan_pks', side_effect=_plan_pks)
+    plans, clashes = manager.create_object_payment_plans([
+        (c1, payment_plan, Decimal('100')),
+        (c2, payment_plan, Decimal('200')),
+    ])
+    assert [c1] == [obj.content_object for obj in plans]
+    assert [c2] == [item[0] for item in clashes]
+    assert 2 == ObjectPaymentPlan.objects.count()
+
+
+@pytest.mark.django_db
+def test_create_object_payment_plans_revision():
+    """The plans and deposits are added to the current revision."""
+    payment_plan = PaymentPlanFactory(deposit=20, count=2, interval=1)
+    with reversion.create_revision():
+        plans, clashes = ObjectPaymentPlan.objects.create_object_payment_plans(
+            [(ContactFactory(), payment_plan, Decimal('100'))]
+        )
+    obj = ObjectPaymentPlan.objects.get(pk=plans[0].pk)
+    assert 1 == len(reversion.get_for_object(obj))
+    deposit = obj.payments[0]
+    assert deposit.deposit is True
+    assert 1 == len(reversion.get_for_object(deposit))
+
+
+@pytest.mark.django_db
+def test_create_object_payment_plans_empty():
+    assert ([], []) == ObjectPaymentPlan.objects.create_object_payment_plans(
+        []
+    )
+
+
+@pytest.mark.django_db
+def test_create_instalments_bulk():
+    payment_plan = PaymentPlanFactory(deposit=10, count=12, interval=1)
+    with transaction.atomic():
+        obj = ObjectPaymentPlan.objects.create_object_payment_plan(
+            ContactFactory(),
+            payment_plan,
+            Decimal('120')
+        )
+    CheckoutState.objects.warm_cache()
+    with CaptureQueriesContext(connection) as queries:
+        with transaction.atomic():
+            obj.create_instalments()
+    # check the deposit (two queries) then insert all the instalments
+    assert 3 == len(
+        [q for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+    )
+    assert 13 == obj.payment_count
+    result = [(p.count, p.amount, p.state.slug) for p in obj.payments]
+    assert (1, Decimal('12'), CheckoutState.PENDING) == result[0]
+    assert (2, Decimal('9'), CheckoutState.PENDING) == result[1]
+    assert (13, Decimal('9'), CheckoutState.PENDING) == result[12]
+
+
+@pytest.mark.django_db
+def test_create_instalments_revision():
+    """The instalments are added to the current revision."""
+    payment_plan = PaymentPlanFactory(deposit=20, count=2, interval=1)
+    with transaction.atomic():
+        obj = ObjectPaymentPlan.objects.create_object_payment_plan(
+            ContactFactory(),
+            payment_plan,
+            Decimal('100')
+        )
+    with transaction.atomic(), reversion.create_revision():
+        obj.create_instalments()
+    instalments = [p for p in obj.payments if not p.deposit]
+    assert 2 == len(instalments)
+    for instalment in instalments:
+        assert 1 == len(reversion.get_for_object(instalment))
+
+
 @pytest.mark.django_db
 def test_create_instalments_once_only():
     contact = ContactFactory()
@@ -130,6 +260,31 @@ def test_create_instalments_corrupt():
     assert 'no deposit record' in str(e.value)
 
 
+@pytest.mark.django_db
+def test_checkout_email_and_name():
+    contact = ContactFactory()
+    obj = ObjectPaymentPlanFactory(content_object=contact)
+    assert contact.checkout_email == obj.checkout_email
+    assert contact.checkout_name == obj.checkout_name
+
+
+@pytest.mark.django_db
+def test_refresh_card_expiry_dates_email_changed():
+    """The copy of the email address is refreshed first."""
+    user = UserFactory(email='old@pkimber.net')
+    obj = ObjectPaymentPlanFactory(content_object=ContactFactory(user=user))
+    ObjectPaymentPlanInstalmentFactory(object_payment_plan=obj)
+    user.email = 'new@pkimber.net'
+    user.save()
+    with mock.patch.object(
+            Customer.objects, 'update_card_expiry_dates') as mock_update:
+        ObjectPaymentPlan.objects.refresh_card_expiry_dates()
+    obj.refresh_from_db()
+    assert 'new@pkimber.net' == obj.checkout_email
+    args, kwargs = mock_update.call_args
+    assert ['new@pkimber.net'] == args[0]
+
+
 @pytest.mark.django_db
 def test_outstanding_payment_plans():
     assert 0 == ObjectPaymentPlan.objects.outstanding_payment_plans.count()
@@ -179,10 +334,28 @@ def test_outstanding_payment_plans_filter_two():
     assert 1 == ObjectPaymentPlan.objects.outstanding_payment_plans.count()
 
 
+@pytest.mark.django_db
+def test_outstanding_payment_plans_one_query():
+    """The instalments are filtered in a sub-query (not in Python)."""
+    for count in range(3):
+        ObjectPaymentPlanInstalmentFactory(
+            object_payment_plan=ObjectPaymentPlanFactory(
+                content_object=ContactFactory(),
+            ),
+        )
+    CheckoutState.objects.warm_cache()
+    with CaptureQueriesContext(connection) as queries:
+        qs = ObjectPaymentPlan.objects.outstanding_payment_plans
+        assert 0 == len(queries)
+        assert 3 == len(list(qs))
+    assert 1 == len(queries)
+
+
 @pytest.mark.django_db
 def test_refresh_card_expiry_dates():
     MailTemplateFactory(slug=Customer.MAIL_TEMPLATE_CARD_EXPIRY)
-    with mock.patch('stripe.Customer.retrieve') as mock_retrieve:
+    with mock.patch.object(
+            StripeGateway, 'customer_retrieve') as mock_retrieve:
         mock_retrieve.return_value = {
             'default_card': '1234',
             'cards': {
@@ -222,7 +395,8 @@ def test_refresh_card_expiry_dates():
 
 @pytest.mark.django_db
 def test_refresh_card_expiry_dates_future():
-    with mock.patch('stripe.Customer.retrieve') as mock_retrieve:
+    with mock.patch.object(
+            StripeGateway, 'customer_retrieve') as mock_retrieve:
         mock_retrieve.return_value = {
             'default_card': '1234',
             'cards': {
@@ -256,7 +430,8 @@ def test_refresh_card_expiry_dates_future():
 @pytest.mark.django_db
 def test_refresh_card_expiry_dates_refreshed():
     """Customer card already marked for 'refresh', so don't send an email."""
-    with mock.patch('stripe.Customer.retrieve') as mock_retrieve:
+    with mock.patch.object(
+            StripeGateway, 'customer_retrieve') as mock_retrieve:
         mock_retrieve.return_value = {
             'default_card': '1234',
             'cards': {
@@ -288,6 +463,81 @@ def test_refresh_card_expiry_dates_refreshed():
         assert 0 == Message.objects.count()
 
 
+@pytest.mark.django_db
+def test_refresh_card_expiry_dates_duplicate_email():
+    """Only ask Stripe once for each customer."""
+    with mock.patch.object(
+            StripeGateway, 'customer_retrieve') as mock_retrieve:
+        mock_retrieve.return_value = {
+            'default_card': '1234',
+            'cards': {
+                'data': [
+                    {
+                        'id': '1234',
+                        'exp_month': '8',
+                        'exp_year': '2050',
+                    },
+                ],
+            },
+        }
+        # two contacts (and payment plans) with the same email address
+        for count in range(2):
+            obj = ObjectPaymentPlanFactory(
+                content_object=ContactFactory(
+                    user=UserFactory(email='same@pkimber.net'),
+                ),
+            )
+            ObjectPaymentPlanInstalmentFactory(object_payment_plan=obj)
+            ObjectPaymentPlanInstalmentFactory(
+                object_payment_plan=obj,
+                due=date.today() + relativedelta(months=+1),
+            )
+        customer = CustomerFactory(email='same@pkimber.net')
+        ObjectPaymentPlan.objects.refresh_card_expiry_dates(workers=2)
+        assert 1 == mock_retrieve.call_count
+        customer.refresh_from_db()
+        assert date(2050, 8, 31) == customer.expiry_date
+        assert False == customer.refresh
+
+
+@pytest.mark.django_db
+def test_refresh_card_expiry_dates_rate_limit(settings):
+    """Retry if Stripe says we are making too many requests."""
+    settings.CHECKOUT_STRIPE_RETRY_SECONDS = 0.1
+    MailTemplateFactory(slug=Customer.MAIL_TEMPLATE_CARD_EXPIRY)
+    with mock.patch.object(
+            StripeGateway, 'customer_retrieve') as mock_retrieve, \
+            mock.patch('time.sleep') as mock_sleep:
+        mock_retrieve.side_effect = [
+            stripe.StripeError('Too many requests', http_status=429),
+            {
+                'default_card': '1234',
+                'cards': {
+                    'data': [
+                        {
+                            'id': '1234',
+                            'exp_month': '8',
+                            'exp_year': '1986',
+                        },
+                    ],
+                },
+            },
+        ]
+        obj = ObjectPaymentPlanFactory(content_object=ContactFactory())
+        ObjectPaymentPlanInstalmentFactory(object_payment_plan=obj)
+        ObjectPaymentPlanInstalmentFactory(
+            object_payment_plan=obj,
+            due=date.today() + relativedelta(months=+1),
+        )
+        customer = CustomerFactory(email=obj.content_object.checkout_email)
+        ObjectPaymentPlan.objects.refresh_card_expiry_dates()
+        assert 2 == mock_retrieve.call_count
+        mock_sleep.assert_called_once_with(0.1)
+        customer.refresh_from_db()
+        assert True == customer.refresh
+        assert 1 == Message.objects.count()
+
+
 @pytest.mark.django_db
 def test_report_card_expiry_dates():
     object_payment_plan = ObjectPaymentPlanFactory(
@@ -302,4 +552,37 @@ def test_report_card_expiry_dates():
     CustomerFactory(
         email=obj.object_payment_plan.content_object.checkout_email
     )
-    ObjectPaymentPlan.objects.report_card_expiry_dates
+    result = ObjectPaymentPlan.objects.report_card_expiry_dates
+    assert 2 == len(result)
+    assert set(['expiry_date', 'object_payment_plan']) == set(result[0])
+
+
+@pytest.mark.django_db
+def test_report_card_expiry_dates_order():
+    """Ordered by card expiry date (then by payment plan)."""
+    def _plan(email, expiry_date=None):
+        obj = ObjectPaymentPlanFactory(
+            content_object=ContactFactory(user=UserFactory(email=email)),
+        )
+        ObjectPaymentPlanInstalmentFactory(object_payment_plan=obj)
+        if expiry_date:
+            CustomerFactory(email=email, expiry_date=expiry_date)
+        return obj
+
+    # created in a different order to the report
+    later = _plan('later@pkimber.net', date(2016, 3, 31))
+    sooner = _plan('sooner@pkimber.net', date(2015, 1, 31))
+    no_customer = _plan('none@pkimber.net')
+    # a different contact with the same email address
+    sooner_too = _plan('sooner@pkimber.net')
+    qs = ObjectPaymentPlan.objects.card_expiry_payment_plans
+    assert [
+        no_customer.pk, sooner.pk, sooner_too.pk, later.pk
+    ] == [obj.pk for obj in qs]
+    result = ObjectPaymentPlan.objects.report_card_expiry_dates
+    assert [
+        no_customer.pk, sooner.pk, sooner_too.pk, later.pk
+    ] == [item['object_payment_plan'].pk for item in result]
+    assert [
+        None, date(2015, 1, 31), date(2015, 1, 31), date(2016, 3, 31)
+    ] == [item['expiry_date'] for item in result]
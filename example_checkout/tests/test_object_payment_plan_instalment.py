@@ -1,14 +1,24 @@
 # -*- encoding: utf-8 -*-
 import pytest
+import stripe
 
 from datetime import date
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 from unittest import mock
 
-from django.db import transaction
+from django.db import (
+    OperationalError,
+    transaction,
+)
+from django.utils import timezone
 
+from checkout.gateway import (
+    gateway,
+    StripeGateway,
+)
 from checkout.models import (
+    Checkout,
     CheckoutError,
     CheckoutAction,
     CheckoutState,
@@ -297,6 +307,30 @@ def test_checkout_email():
     assert 'me@test.com' == obj.checkout_email
 
 
+@pytest.mark.django_db
+def test_checkout_email_changed(mocker):
+    """Charge the card for the current email address of the contact."""
+    mocker.patch.object(StripeGateway, 'charge_create')
+    user = UserFactory(email='old@pkimber.net')
+    install = ObjectPaymentPlanInstalmentFactory(
+        due=date.today()+relativedelta(days=-1),
+        object_payment_plan=ObjectPaymentPlanFactory(
+            content_object=ContactFactory(user=user),
+        ),
+    )
+    user.email = 'new@pkimber.net'
+    user.save()
+    customer = CustomerFactory(email='new@pkimber.net')
+    result = ObjectPaymentPlanInstalment.objects.process_payments()
+    assert 1 == result['success']
+    checkout = Checkout.objects.get(
+        content_type__model='objectpaymentplaninstalment',
+        object_id=install.pk,
+    )
+    assert customer == checkout.customer
+    assert 'new@pkimber.net' == checkout.checkout_email
+
+
 #@pytest.mark.django_db
 #def test_checkout_list():
 #    c1 = CheckoutFactory(
@@ -349,6 +383,14 @@ def test_due():
     assert [Decimal('1'), Decimal('2')] == result
 
 
+@pytest.mark.django_db
+def test_due_state_id():
+    """Filter on the state id, so the database can use the partial index."""
+    sql = str(ObjectPaymentPlanInstalment.objects.due.query)
+    assert 'checkout_checkoutstate' not in sql
+    assert '"state_id" = {}'.format(CheckoutState.objects.pending.pk) in sql
+
+
 @pytest.mark.django_db
 def test_due_plan_deleted():
     today = date.today()
@@ -523,8 +565,8 @@ def test_create_instalments_first_of_month_after_15th():
 @pytest.mark.django_db
 def test_process_payments(mocker):
     """Process payments."""
-    mocker.patch('stripe.Charge.create')
-    mocker.patch('stripe.Customer.create')
+    mocker.patch.object(StripeGateway, 'charge_create')
+    mocker.patch.object(StripeGateway, 'customer_create')
     today = date.today()
     install_1 = ObjectPaymentPlanInstalmentFactory(
         due=today+relativedelta(days=1),
@@ -566,7 +608,7 @@ def test_process_payments(mocker):
 @pytest.mark.django_db
 def test_process_payments_fail(mocker):
     """Process payments."""
-    with mock.patch('stripe.Customer.create') as mock_customer:
+    with mock.patch.object(StripeGateway, 'customer_create') as mock_customer:
         mock_customer.side_effect = CheckoutError('Mock')
         today = date.today()
         install = ObjectPaymentPlanInstalmentFactory(
@@ -595,3 +637,348 @@ def test_str():
             content_object=ContactFactory(),
         ),
     ))
+
+
+@pytest.mark.django_db
+def test_process_payments_result(mocker):
+    mocker.patch.object(StripeGateway, 'charge_create')
+    today = date.today()
+    install_1 = ObjectPaymentPlanInstalmentFactory(
+        due=today+relativedelta(days=-1),
+        amount=Decimal('1'),
+        object_payment_plan=ObjectPaymentPlanFactory(
+            content_object=ContactFactory(),
+        ),
+    )
+    ObjectPaymentPlanInstalmentFactory(
+        due=today+relativedelta(days=-2),
+        amount=Decimal('2'),
+        object_payment_plan=ObjectPaymentPlanFactory(
+            content_object=ContactFactory(),
+        ),
+    )
+    CustomerFactory(
+        email=install_1.object_payment_plan.content_object.checkout_email
+    )
+    result = ObjectPaymentPlanInstalment.objects.process_payments()
+    assert 2 == result['count']
+    assert 1 == result['success']
+    # no customer record, so the instalment is left in the 'request' state
+    assert 1 == result['error']
+    assert 'per_second' in result
+
+
+@pytest.mark.django_db
+def test_process_payments_no_card(mocker):
+    """The customer has not registered a card, so tell a member of staff."""
+    mocker.patch.object(StripeGateway, 'charge_create')
+    NotifyFactory()
+    install = ObjectPaymentPlanInstalmentFactory(
+        due=date.today()+relativedelta(days=-1),
+        amount=Decimal('1'),
+        object_payment_plan=ObjectPaymentPlanFactory(
+            content_object=ContactFactory(),
+        ),
+    )
+    result = ObjectPaymentPlanInstalment.objects.process_payments()
+    assert 1 == result['error']
+    install.refresh_from_db()
+    assert CheckoutState.objects.request == install.state
+    assert 1 == Message.objects.count()
+    message = Message.objects.first()
+    assert 'FAIL - 1 payments failed' == message.subject
+    assert 'has not registered a card' in message.description
+
+
+@pytest.mark.django_db
+def test_process_payments_database_error(mocker):
+    """Only a locked instalment is skipped."""
+    ObjectPaymentPlanInstalmentFactory(
+        due=date.today()+relativedelta(days=-1),
+        amount=Decimal('1'),
+        object_payment_plan=ObjectPaymentPlanFactory(
+            content_object=ContactFactory(),
+        ),
+    )
+    mocker.patch.object(
+        ObjectPaymentPlanInstalment,
+        'save',
+        side_effect=OperationalError('disk full'),
+    )
+    with pytest.raises(OperationalError):
+        ObjectPaymentPlanInstalment.objects.process_payments()
+
+
+@pytest.mark.django_db
+def test_process_payments_skip_not_pending(mocker):
+    mocker.patch.object(StripeGateway, 'charge_create')
+    install = ObjectPaymentPlanInstalmentFactory(
+        due=date.today()+relativedelta(days=-1),
+        amount=Decimal('1'),
+        object_payment_plan=ObjectPaymentPlanFactory(
+            content_object=ContactFactory(),
+        ),
+    )
+    manager = ObjectPaymentPlanInstalment.objects
+    install.state = CheckoutState.objects.request
+    install.save()
+    assert manager._process_payments([install.pk]) == {'skip': 1}
+
+
+@pytest.mark.django_db
+def test_due_shard():
+    today = date.today()
+    for count in range(5):
+        ObjectPaymentPlanInstalmentFactory(
+            due=today+relativedelta(days=-1),
+            object_payment_plan=ObjectPaymentPlanFactory(
+                content_object=ContactFactory(),
+            ),
+        )
+    manager = ObjectPaymentPlanInstalment.objects
+    shards = [
+        set(manager.due_shard(shard, 3).values_list('pk', flat=True))
+        for shard in range(3)
+    ]
+    # every due instalment is in exactly one shard
+    assert set(manager.due.values_list('pk', flat=True)) == set.union(*shards)
+    assert 5 == sum(len(pks) for pks in shards)
+
+
+@pytest.mark.django_db
+def test_process_payments_shard(mocker):
+    mocker.patch.object(StripeGateway, 'charge_create')
+    install = ObjectPaymentPlanInstalmentFactory(
+        due=date.today()+relativedelta(days=-1),
+        object_payment_plan=ObjectPaymentPlanFactory(
+            content_object=ContactFactory(),
+        ),
+    )
+    CustomerFactory(
+        email=install.object_payment_plan.content_object.checkout_email
+    )
+    shard = install.object_payment_plan.pk % 2
+    manager = ObjectPaymentPlanInstalment.objects
+    assert 0 == manager.process_payments(shard=1-shard, shards=2)['count']
+    assert 1 == manager.process_payments(shard=shard, shards=2)['success']
+    install.refresh_from_db()
+    assert CheckoutState.objects.success == install.state
+
+
+@pytest.mark.django_db
+def test_process_payments_fake_gateway(settings):
+    settings.CHECKOUT_PAYMENT_GATEWAY = 'checkout.gateway.FakeGateway'
+    settings.CHECKOUT_FAKE_GATEWAY_DECLINE_RATE = 0
+    install = ObjectPaymentPlanInstalmentFactory(
+        due=date.today()+relativedelta(days=-1),
+        object_payment_plan=ObjectPaymentPlanFactory(
+            content_object=ContactFactory(),
+        ),
+    )
+    CustomerFactory(
+        email=install.object_payment_plan.content_object.checkout_email
+    )
+    result = ObjectPaymentPlanInstalment.objects.process_payments()
+    assert 1 == result['success']
+    install.refresh_from_db()
+    assert CheckoutState.objects.success == install.state
+
+
+@pytest.mark.django_db
+def test_process_payments_digest(settings):
+    """One notification email for all the failed payments."""
+    settings.CHECKOUT_PAYMENT_GATEWAY = 'checkout.gateway.FakeGateway'
+    settings.CHECKOUT_FAKE_GATEWAY_DECLINE_RATE = 1
+    NotifyFactory()
+    for count in range(2):
+        install = ObjectPaymentPlanInstalmentFactory(
+            due=date.today()+relativedelta(days=-1),
+            object_payment_plan=ObjectPaymentPlanFactory(
+                content_object=ContactFactory(),
+            ),
+        )
+        CustomerFactory(
+            email=install.object_payment_plan.content_object.checkout_email
+        )
+    result = ObjectPaymentPlanInstalment.objects.process_payments(digest=True)
+    assert 2 == result['fail']
+    assert 1 == Message.objects.count()
+    message = Message.objects.first()
+    assert 'FAIL - 2 payments failed' == message.subject
+
+
+@pytest.mark.django_db(transaction=True)
+def test_process_payments_workers(settings):
+    """Worker threads charge each instalment once (and only once).
+
+    The customers for the last two instalments have not registered a card.
+
+    """
+    settings.CHECKOUT_PAYMENT_GATEWAY = 'checkout.gateway.FakeGateway'
+    settings.CHECKOUT_FAKE_GATEWAY_DECLINE_RATE = 0.3
+    settings.CHECKOUT_FAKE_GATEWAY_LATENCY = 0.01
+    settings.CHECKOUT_FAKE_GATEWAY_RATE_LIMIT_RATE = 0
+    settings.CHECKOUT_FAKE_GATEWAY_SEED = 1
+    NotifyFactory()
+    pks = []
+    for count in range(10):
+        install = ObjectPaymentPlanInstalmentFactory(
+            due=date.today()+relativedelta(days=-1),
+            object_payment_plan=ObjectPaymentPlanFactory(
+                content_object=ContactFactory(),
+            ),
+        )
+        if count < 8:
+            CustomerFactory(
+                email=install.object_payment_plan.content_object.checkout_email
+            )
+        pks.append(install.pk)
+    result = ObjectPaymentPlanInstalment.objects.process_payments(
+        workers=2, digest=True
+    )
+    # check
+    assert 10 == result['count']
+    assert 2 == result['error']
+    success = result.get('success', 0)
+    fail = result.get('fail', 0)
+    assert 8 == success + fail
+    charges = gateway().charges
+    assert success == len(charges)
+    checkout_pks = [charge['metadata']['checkout_pk'] for charge in charges]
+    assert len(set(checkout_pks)) == len(checkout_pks)
+    checkouts = Checkout.objects.filter(
+        content_type__model='objectpaymentplaninstalment',
+        object_id__in=pks,
+    )
+    assert 8 == checkouts.count()
+    assert 8 == len(set(checkouts.values_list('object_id', flat=True)))
+    assert success == checkouts.filter(
+        state=CheckoutState.objects.success
+    ).count()
+    assert set(checkout_pks) == set(
+        checkouts.filter(
+            state=CheckoutState.objects.success
+        ).values_list('pk', flat=True)
+    )
+    assert fail == ObjectPaymentPlanInstalment.objects.filter(
+        pk__in=pks, state=CheckoutState.objects.fail
+    ).count()
+    assert 0 == ObjectPaymentPlanInstalment.objects.due.count()
+
+def _stuck_instalment(checkout=True):
+    """An instalment left in the 'request' state (two hours ago)."""
+    install = ObjectPaymentPlanInstalmentFactory(
+        due=date.today()+relativedelta(days=-1),
+        amount=Decimal('1'),
+        object_payment_plan=ObjectPaymentPlanFactory(
+            content_object=ContactFactory(),
+        ),
+        state=CheckoutState.objects.request,
+    )
+    ObjectPaymentPlanInstalment.objects.filter(pk=install.pk).update(
+        modified=timezone.now()+relativedelta(hours=-2)
+    )
+    result = None
+    if checkout:
+        result = CheckoutFactory(
+            action=CheckoutAction.objects.charge,
+            content_object=install,
+            customer=CustomerFactory(
+                customer_id='cus_{}'.format(install.pk),
+                email=install.checkout_email,
+            ),
+            state=CheckoutState.objects.pending,
+        )
+    return install, result
+
+
+@pytest.mark.django_db
+def test_reconcile_no_checkout():
+    """We didn't ask for the money, so the instalment is pending again."""
+    install, checkout = _stuck_instalment(checkout=False)
+    result = ObjectPaymentPlanInstalment.objects.reconcile()
+    assert 1 == result[CheckoutState.PENDING]
+    install.refresh_from_db()
+    assert CheckoutState.objects.pending == install.state
+    assert 1 == install.reconcile_count
+
+
+@pytest.mark.django_db
+def test_reconcile_no_checkout_give_up(settings):
+    """We tried too many times, so tell a member of staff."""
+    settings.CHECKOUT_RECONCILE_MAX_ATTEMPTS = 3
+    NotifyFactory()
+    install, checkout = _stuck_instalment(checkout=False)
+    ObjectPaymentPlanInstalment.objects.filter(pk=install.pk).update(
+        reconcile_count=2
+    )
+    result = ObjectPaymentPlanInstalment.objects.reconcile()
+    assert 1 == result[CheckoutState.FAIL]
+    assert 0 == result.get(CheckoutState.PENDING, 0)
+    install.refresh_from_db()
+    assert CheckoutState.objects.fail == install.state
+    assert 1 == Message.objects.count()
+    message = Message.objects.first()
+    assert 'FAIL - 1 payments failed' == message.subject
+    assert 'No checkout after 3 attempts' in message.description
+
+
+@pytest.mark.django_db
+def test_reconcile_not_stuck():
+    install, checkout = _stuck_instalment()
+    ObjectPaymentPlanInstalment.objects.filter(pk=install.pk).update(
+        modified=timezone.now()
+    )
+    result = ObjectPaymentPlanInstalment.objects.reconcile()
+    assert 0 == result['count']
+    install.refresh_from_db()
+    assert CheckoutState.objects.request == install.state
+
+
+@pytest.mark.django_db
+def test_reconcile_success(mocker):
+    install, checkout = _stuck_instalment()
+    mock_all = mocker.patch.object(StripeGateway, 'charge_list')
+    mock_all.return_value = [
+        {'id': 'ch_1', 'paid': True, 'metadata': {'checkout_pk': '0'}},
+        {
+            'id': 'ch_2',
+            'paid': True,
+            'metadata': {'checkout_pk': str(checkout.pk)},
+        },
+    ]
+    result = ObjectPaymentPlanInstalment.objects.reconcile()
+    assert 1 == result[CheckoutState.SUCCESS]
+    assert 'cus_{}'.format(install.pk) == mock_all.call_args[0][0]
+    install.refresh_from_db()
+    assert CheckoutState.objects.success == install.state
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.success == checkout.state
+
+
+@pytest.mark.django_db
+def test_reconcile_fail(mocker):
+    """The charge didn't reach Stripe."""
+    NotifyFactory()
+    install, checkout = _stuck_instalment()
+    mocker.patch.object(StripeGateway, 'charge_list', return_value=[])
+    result = ObjectPaymentPlanInstalment.objects.reconcile()
+    assert 1 == result[CheckoutState.FAIL]
+    install.refresh_from_db()
+    assert CheckoutState.objects.fail == install.state
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.fail == checkout.state
+    # one notification email for all the failures
+    assert 1 == Message.objects.count()
+    assert 'FAIL - 1 payments failed' == Message.objects.first().subject
+
+
+@pytest.mark.django_db
+def test_reconcile_stripe_error(mocker):
+    """If we can't ask Stripe, try again next time."""
+    install, checkout = _stuck_instalment()
+    mock_all = mocker.patch.object(StripeGateway, 'charge_list')
+    mock_all.side_effect = stripe.APIConnectionError('Timeout')
+    ObjectPaymentPlanInstalment.objects.reconcile()
+    install.refresh_from_db()
+    assert CheckoutState.objects.request == install.state
@@ -0,0 +1,153 @@
+# -*- encoding: utf-8 -*-
+"""The number of queries for a list should not grow with the number of rows."""
+import pytest
+
+from datetime import date
+
+from django.core.urlresolvers import reverse
+
+from checkout.models import (
+    Checkout,
+    CheckoutAction,
+    CheckoutState,
+    Customer,
+    ObjectPaymentPlan,
+)
+from checkout.tests.factories import (
+    CheckoutFactory,
+    CustomerFactory,
+    PaymentPlanFactory,
+)
+from checkout.tests.helper import (
+    login_staff,
+    object_payment_plans,
+)
+from checkout.tests.query_budget import (
+    assert_flat_queries,
+    QueryBudget,
+)
+from .factories import SalesLedgerFactory
+
+
+def _get(client, url):
+    def _func():
+        response = client.get(url)
+        assert 200 == response.status_code
+    return _func
+
+
+def _checkouts(count):
+    for i in range(count):
+        CheckoutFactory(
+            action=CheckoutAction.objects.payment,
+            content_object=SalesLedgerFactory(),
+        )
+
+
+@pytest.mark.django_db
+def test_query_budget():
+    with pytest.raises(AssertionError) as e:
+        with QueryBudget(1):
+            CheckoutState.objects.filter(slug='a').count()
+            CheckoutState.objects.filter(slug='b').count()
+    assert '2 queries (budget 1)' in str(e.value)
+    # the query is the same (apart from the parameter)
+    assert '2 x SELECT' in str(e.value)
+
+
+@pytest.mark.django_db
+def test_query_budget_not_flat():
+    def _func():
+        for obj in ObjectPaymentPlan.objects.all():
+            obj.payment_plan.name
+
+    with pytest.raises(AssertionError) as e:
+        assert_flat_queries(_func, object_payment_plans)
+    assert 'grows with the number of rows' in str(e.value)
+    # only the extra queries (one for each of the new rows)
+    assert 4 == str(e.value).count('+SELECT')
+
+
+@pytest.mark.django_db
+def test_audit():
+    def _func():
+        for obj in Checkout.objects.audit():
+            obj.action.name
+            obj.content_object_url
+            obj.customer
+            obj.failed
+            obj.invoice_data
+            obj.is_payment_plan
+            obj.state.name
+            obj.user
+
+    assert_flat_queries(_func, _checkouts, max_queries=10)
+
+
+@pytest.mark.django_db
+def test_prefetch_payments():
+    def _func():
+        qs = ObjectPaymentPlan.objects.prefetch_payments(
+            ObjectPaymentPlan.objects.outstanding_payment_plans
+        )
+        for obj in qs:
+            obj.payment_plan.name
+            for item in obj.payments:
+                item.state.name
+
+    assert_flat_queries(_func, object_payment_plans, max_queries=8)
+
+
+@pytest.mark.django_db
+def test_view_card_refresh_list(client):
+    login_staff(client)
+    assert_flat_queries(
+        _get(client, reverse('checkout.card.refresh.list')),
+        lambda count: [CustomerFactory(refresh=True) for i in range(count)],
+        max_queries=15,
+    )
+
+
+@pytest.mark.django_db
+def test_view_payment_plan_list(client):
+    login_staff(client)
+    assert_flat_queries(
+        _get(client, reverse('checkout.payment.plan.list')),
+        lambda count: [PaymentPlanFactory() for i in range(count)],
+        max_queries=15,
+    )
+
+
+@pytest.mark.django_db
+def test_view_audit_list(client):
+    login_staff(client)
+    assert_flat_queries(
+        _get(client, reverse('checkout.list.audit')),
+        _checkouts,
+        max_queries=15,
+    )
+
+
+@pytest.mark.django_db
+def test_view_object_payment_plan_list(client):
+    login_staff(client)
+    assert_flat_queries(
+        _get(client, reverse('checkout.object.payment.plan.list')),
+        object_payment_plans,
+        max_queries=15,
+    )
+
+
+@pytest.mark.django_db
+def test_view_card_expiry_list(client):
+    login_staff(client)
+
+    def _setup(count):
+        object_payment_plans(count)
+        Customer.objects.update(expiry_date=date.today())
+
+    assert_flat_queries(
+        _get(client, reverse('checkout.object.payment.plan.card.expiry.list')),
+        _setup,
+        max_queries=15,
+    )
@@ -0,0 +1,275 @@
+# -*- encoding: utf-8 -*-
+import json
+import pytest
+import time
+
+from datetime import date
+from dateutil.relativedelta import relativedelta
+
+from django.core.urlresolvers import reverse
+from django.utils import timezone
+
+from checkout.models import (
+    Checkout,
+    CheckoutAction,
+    CheckoutState,
+    Customer,
+    ObjectPaymentPlanInstalment,
+    StripeEvent,
+)
+from checkout.tasks import reconcile_payments
+from checkout.tests.factories import (
+    CheckoutFactory,
+    CustomerFactory,
+    ObjectPaymentPlanFactory,
+    ObjectPaymentPlanInstalmentFactory,
+)
+from checkout.webhook import signature
+from .factories import (
+    ContactFactory,
+    SalesLedgerFactory,
+)
+
+
+def _event(event_id, event_type, obj):
+    return {
+        'id': event_id,
+        'type': event_type,
+        'data': {'object': obj},
+    }
+
+
+def _checkout(minutes):
+    """A pending checkout (last updated ``minutes`` ago)."""
+    checkout = CheckoutFactory(
+        action=CheckoutAction.objects.payment,
+        content_object=SalesLedgerFactory(),
+        state=CheckoutState.objects.pending,
+    )
+    Checkout.objects.filter(pk=checkout.pk).update(
+        modified=timezone.now() + relativedelta(minutes=-minutes)
+    )
+    return checkout
+
+
+def _post(client, data, secret='whsec_test'):
+    payload = json.dumps(data).encode()
+    timestamp = int(time.time())
+    return client.post(
+        reverse('checkout.stripe.webhook'),
+        payload,
+        content_type='application/json',
+        HTTP_STRIPE_SIGNATURE='t={},v1={}'.format(
+            timestamp, signature(payload, secret, timestamp)
+        ),
+    )
+
+
+@pytest.mark.django_db
+def test_create_stripe_event():
+    data = _event('evt_1', 'charge.succeeded', {'id': 'ch_1'})
+    obj = StripeEvent.objects.create_stripe_event(data)
+    assert 'charge.succeeded' == obj.event_type
+    assert {'id': 'ch_1'} == obj.object_data
+    # Stripe might send the same event again
+    assert obj == StripeEvent.objects.create_stripe_event(data)
+    assert 1 == StripeEvent.objects.count()
+
+
+@pytest.mark.django_db
+def test_process_events_charge_failed():
+    checkout = _checkout(minutes=120)
+    StripeEvent.objects.create_stripe_event(_event(
+        'evt_1',
+        'charge.failed',
+        {'id': 'ch_1', 'metadata': {'checkout_pk': str(checkout.pk)}},
+    ))
+    assert 1 == StripeEvent.objects.process_events()
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.fail == checkout.state
+
+
+@pytest.mark.django_db
+def test_process_events_charge_succeeded():
+    checkout = _checkout(minutes=120)
+    StripeEvent.objects.create_stripe_event(_event(
+        'evt_1',
+        'charge.succeeded',
+        {'id': 'ch_1', 'metadata': {'checkout_pk': str(checkout.pk)}},
+    ))
+    assert 1 == StripeEvent.objects.process_events()
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.success == checkout.state
+    assert 0 == StripeEvent.objects.filter(processed=False).count()
+
+
+@pytest.mark.django_db
+def test_process_events_charge_request():
+    """The task charged the card, but didn't update the checkout."""
+    checkout = _checkout(minutes=120)
+    Checkout.objects.filter(pk=checkout.pk).update(
+        state=CheckoutState.objects.request
+    )
+    StripeEvent.objects.create_stripe_event(_event(
+        'evt_1',
+        'charge.succeeded',
+        {'id': 'ch_1', 'metadata': {'checkout_pk': str(checkout.pk)}},
+    ))
+    assert 1 == StripeEvent.objects.process_events()
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.success == checkout.state
+
+
+@pytest.mark.django_db
+def test_process_events_charge_error(mocker):
+    """An event which fails doesn't stop the events after it."""
+    checkout_1 = _checkout(minutes=120)
+    checkout_2 = _checkout(minutes=120)
+    mocker.patch.object(Checkout, 'success', side_effect=ValueError('boom'))
+    StripeEvent.objects.create_stripe_event(_event(
+        'evt_1',
+        'charge.succeeded',
+        {'id': 'ch_1', 'metadata': {'checkout_pk': str(checkout_1.pk)}},
+    ))
+    StripeEvent.objects.create_stripe_event(_event(
+        'evt_2',
+        'charge.failed',
+        {'id': 'ch_2', 'metadata': {'checkout_pk': str(checkout_2.pk)}},
+    ))
+    assert 1 == StripeEvent.objects.process_events()
+    checkout_1.refresh_from_db()
+    assert CheckoutState.objects.pending == checkout_1.state
+    checkout_2.refresh_from_db()
+    assert CheckoutState.objects.fail == checkout_2.state
+    assert 0 == StripeEvent.objects.filter(processed=False).count()
+    assert 'boom' == StripeEvent.objects.get(event_id='evt_1').error
+    assert '' == StripeEvent.objects.get(event_id='evt_2').error
+    # the failed event is not processed again
+    assert 0 == StripeEvent.objects.process_events()
+
+
+@pytest.mark.django_db
+def test_process_events_charge_instalment():
+    install = ObjectPaymentPlanInstalmentFactory(
+        object_payment_plan=ObjectPaymentPlanFactory(
+            content_object=ContactFactory(),
+        ),
+        state=CheckoutState.objects.request,
+    )
+    checkout = CheckoutFactory(
+        action=CheckoutAction.objects.charge,
+        content_object=install,
+        state=CheckoutState.objects.pending,
+    )
+    Checkout.objects.filter(pk=checkout.pk).update(
+        modified=timezone.now() + relativedelta(minutes=-120)
+    )
+    StripeEvent.objects.create_stripe_event(_event(
+        'evt_1',
+        'charge.succeeded',
+        {'id': 'ch_1', 'metadata': {'checkout_pk': str(checkout.pk)}},
+    ))
+    assert 1 == StripeEvent.objects.process_events()
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.success == checkout.state
+    install = ObjectPaymentPlanInstalment.objects.get(pk=install.pk)
+    assert CheckoutState.objects.success == install.state
+
+
+@pytest.mark.django_db
+def test_process_events_charge_in_progress():
+    """The checkout is still being processed, so try again later."""
+    checkout = _checkout(minutes=1)
+    StripeEvent.objects.create_stripe_event(_event(
+        'evt_1',
+        'charge.succeeded',
+        {'id': 'ch_1', 'metadata': {'checkout_pk': str(checkout.pk)}},
+    ))
+    assert 0 == StripeEvent.objects.process_events()
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.pending == checkout.state
+    assert 1 == StripeEvent.objects.filter(processed=False).count()
+
+
+@pytest.mark.django_db
+def test_process_events_charge_in_progress_later():
+    """The event is applied when the reconcile task runs (later on)."""
+    checkout = _checkout(minutes=1)
+    StripeEvent.objects.create_stripe_event(_event(
+        'evt_1',
+        'charge.succeeded',
+        {'id': 'ch_1', 'metadata': {'checkout_pk': str(checkout.pk)}},
+    ))
+    assert 0 == StripeEvent.objects.process_events()
+    Checkout.objects.filter(pk=checkout.pk).update(
+        modified=timezone.now() + relativedelta(hours=-2)
+    )
+    reconcile_payments()
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.success == checkout.state
+    assert 0 == StripeEvent.objects.filter(processed=False).count()
+
+
+@pytest.mark.django_db
+def test_process_events_customer_source_updated():
+    CustomerFactory(customer_id='cus_1', expiry_date=date(2015, 1, 31))
+    StripeEvent.objects.create_stripe_event(_event(
+        'evt_1',
+        'customer.source.updated',
+        {'id': 'card_1', 'customer': 'cus_1', 'exp_month': 2,
+         'exp_year': 2050},
+    ))
+    assert 1 == StripeEvent.objects.process_events()
+    customer = Customer.objects.get(customer_id='cus_1')
+    assert date(2050, 2, 28) == customer.expiry_date
+    assert customer.refresh is False
+
+
+@pytest.mark.django_db
+def test_process_events_customer_updated():
+    CustomerFactory(customer_id='cus_1')
+    StripeEvent.objects.create_stripe_event(_event(
+        'evt_1',
+        'customer.updated',
+        {
+            'id': 'cus_1',
+            'default_card': 'card_2',
+            'cards': {'data': [
+                {'id': 'card_1', 'exp_month': 1, 'exp_year': 2030},
+                {'id': 'card_2', 'exp_month': 8, 'exp_year': 2050},
+            ]},
+        },
+    ))
+    assert 1 == StripeEvent.objects.process_events()
+    customer = Customer.objects.get(customer_id='cus_1')
+    assert date(2050, 8, 31) == customer.expiry_date
+
+
+@pytest.mark.django_db
+def test_process_events_not_used():
+    StripeEvent.objects.create_stripe_event(
+        _event('evt_1', 'invoice.created', {'id': 'in_1'})
+    )
+    assert 1 == StripeEvent.objects.process_events()
+    assert 0 == StripeEvent.objects.filter(processed=False).count()
+
+
+@pytest.mark.django_db
+def test_webhook(client, mocker):
+    mock_process = mocker.patch('checkout.dispatch.process_stripe_events')
+    data = _event('evt_1', 'charge.succeeded', {'id': 'ch_1'})
+    response = _post(client, data)
+    assert 200 == response.status_code
+    assert 1 == mock_process.call_count
+    obj = StripeEvent.objects.get(event_id='evt_1')
+    assert 'charge.succeeded' == obj.event_type
+    assert obj.processed is False
+
+
+@pytest.mark.django_db
+def test_webhook_signature_does_not_match(client, mocker):
+    mocker.patch('checkout.dispatch.process_stripe_events')
+    data = _event('evt_1', 'charge.succeeded', {'id': 'ch_1'})
+    response = _post(client, data, secret='whsec_other')
+    assert 400 == response.status_code
+    assert 0 == StripeEvent.objects.count()
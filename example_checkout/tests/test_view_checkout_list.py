@@ -0,0 +1,58 @@
+# -*- encoding: utf-8 -*-
+import pytest
+
+from django.core.urlresolvers import reverse
+
+from checkout.models import CheckoutAction
+from checkout.tests.factories import CheckoutFactory
+from checkout.tests.helper import login_staff
+from .factories import SalesLedgerFactory
+
+
+def _checkouts(count):
+    return [
+        CheckoutFactory(
+            action=CheckoutAction.objects.payment,
+            content_object=SalesLedgerFactory(),
+        ).pk for i in range(count)
+    ]
+
+
+@pytest.mark.django_db
+def test_audit_first_page(client):
+    login_staff(client)
+    pks = _checkouts(12)
+    response = client.get(reverse('checkout.list.audit'))
+    assert 200 == response.status_code
+    page = response.context['page_obj']
+    # most recent first
+    assert list(reversed(pks))[:10] == [o.pk for o in page]
+    assert not page.has_previous()
+    assert page.has_next()
+    assert pks[2] == page.next_cursor
+
+
+@pytest.mark.django_db
+def test_audit_next_and_previous(client):
+    login_staff(client)
+    pks = _checkouts(12)
+    url = reverse('checkout.list.audit')
+    response = client.get(url, {'after': pks[2]})
+    assert 200 == response.status_code
+    page = response.context['page_obj']
+    assert [pks[1], pks[0]] == [o.pk for o in page]
+    assert not page.has_next()
+    assert page.has_previous()
+    # back to the first page
+    response = client.get(url, {'before': page.previous_cursor})
+    page = response.context['page_obj']
+    assert list(reversed(pks))[:10] == [o.pk for o in page]
+    assert not page.has_previous()
+    assert page.has_next()
+
+
+@pytest.mark.django_db
+def test_audit_invalid_cursor(client):
+    login_staff(client)
+    response = client.get(reverse('checkout.list.audit'), {'after': 'abc'})
+    assert 404 == response.status_code
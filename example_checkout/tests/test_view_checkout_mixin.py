@@ -1,12 +1,16 @@
 # -*- encoding: utf-8 -*-
 import pytest
+import stripe
+
 from decimal import Decimal
 
 from django.core.urlresolvers import reverse
 
+from checkout.gateway import StripeGateway
 from checkout.models import (
     Checkout,
     CheckoutAction,
+    CheckoutState,
 )
 from checkout.tests.factories import CheckoutSettingsFactory
 from checkout.views import CONTENT_OBJECT_PK
@@ -34,8 +38,8 @@ def test_get(client):
 
 @pytest.mark.django_db
 def test_post_card_payment(client, mocker):
-    mocker.patch('stripe.Charge.create')
-    mocker.patch('stripe.Customer.create')
+    mocker.patch.object(StripeGateway, 'charge_create')
+    mocker.patch.object(StripeGateway, 'customer_create')
     NotifyFactory()
     obj = SalesLedgerFactory()
     _set_session(client, obj.pk)
@@ -59,7 +63,7 @@ def test_post_card_payment(client, mocker):
 
 @pytest.mark.django_db
 def test_post_card_payment_plan(client, mocker):
-    mocker.patch('stripe.Customer.create')
+    mocker.patch.object(StripeGateway, 'customer_create')
     NotifyFactory()
     product = ProductFactory(price=Decimal('12.34'))
     obj = SalesLedgerFactory(product=product)
@@ -84,7 +88,7 @@ def test_post_card_payment_plan(client, mocker):
 
 @pytest.mark.django_db
 def test_post_card_refresh(client, mocker):
-    mocker.patch('stripe.Customer.create')
+    mocker.patch.object(StripeGateway, 'customer_create')
     NotifyFactory()
     obj = SalesLedgerFactory()
     _set_session(client, obj.pk)
@@ -136,3 +140,55 @@ def test_post_invoice(client):
     message = Message.objects.first()
     assert 'SUCCESS - Invoice' in message.subject
     assert 'SUCCESS - Invoice' in message.description
+
+
+@pytest.mark.django_db
+def test_post_card_payment_async(client, mocker, settings):
+    settings.CHECKOUT_ASYNC = True
+    mocker.patch.object(StripeGateway, 'charge_create')
+    mocker.patch.object(StripeGateway, 'customer_create')
+    NotifyFactory()
+    obj = SalesLedgerFactory()
+    _set_session(client, obj.pk)
+    url = reverse('example.sales.ledger.checkout', args=[obj.pk])
+    data = {
+        'action': CheckoutAction.PAYMENT,
+        'token': 'my-testing-token',
+    }
+    response = client.post(url, data)
+    assert 302 == response.status_code
+    assert 1 == Checkout.objects.count()
+    checkout = Checkout.objects.first()
+    expect = reverse('checkout.status', args=[checkout.pk])
+    assert expect in response['Location']
+    # celery is eager when testing, so the payment has been taken
+    assert CheckoutState.SUCCESS == checkout.state.slug
+    assert checkout.customer is not None
+    # check email notification
+    assert 1 == Message.objects.count()
+    assert 'SUCCESS - Payment' in Message.objects.first().subject
+
+
+@pytest.mark.django_db
+def test_post_card_payment_async_fail(client, mocker, settings):
+    settings.CHECKOUT_ASYNC = True
+    mocker.patch.object(
+        StripeGateway,
+        'charge_create',
+        side_effect=stripe.CardError(
+            'Your card was declined.', None, 'card_declined'
+        ),
+    )
+    mocker.patch.object(StripeGateway, 'customer_create')
+    NotifyFactory()
+    obj = SalesLedgerFactory()
+    _set_session(client, obj.pk)
+    url = reverse('example.sales.ledger.checkout', args=[obj.pk])
+    data = {
+        'action': CheckoutAction.PAYMENT,
+        'token': 'my-testing-token',
+    }
+    response = client.post(url, data)
+    assert 302 == response.status_code
+    checkout = Checkout.objects.first()
+    assert CheckoutState.FAIL == checkout.state.slug
@@ -0,0 +1,125 @@
+# -*- encoding: utf-8 -*-
+import pytest
+
+from dateutil.relativedelta import relativedelta
+from decimal import Decimal
+
+from django.core.urlresolvers import reverse
+from django.utils import timezone
+
+from checkout.models import (
+    Checkout,
+    CheckoutAction,
+    CheckoutState,
+)
+from checkout.gateway import StripeGateway
+from checkout.tests.factories import CheckoutFactory
+from example_checkout.tests.factories import SalesLedgerFactory
+
+from checkout.views import CONTENT_OBJECT_PK
+
+
+def _checkout(client, state, minutes=0):
+    """A checkout (created ``minutes`` ago)."""
+    obj = SalesLedgerFactory()
+    session = client.session
+    session[CONTENT_OBJECT_PK] = obj.pk
+    session.save()
+    checkout = CheckoutFactory(
+        action=CheckoutAction.objects.payment,
+        content_object=obj,
+        state=state,
+        total=Decimal('20'),
+    )
+    Checkout.objects.filter(pk=checkout.pk).update(
+        created=timezone.now() + relativedelta(minutes=-minutes)
+    )
+    return checkout
+
+
+@pytest.mark.django_db
+def test_pending(client):
+    checkout = _checkout(client, CheckoutState.objects.pending)
+    response = client.get(reverse('checkout.status', args=[checkout.pk]))
+    assert 200 == response.status_code
+
+
+@pytest.mark.django_db
+def test_success(client):
+    checkout = _checkout(client, CheckoutState.objects.success)
+    response = client.get(reverse('checkout.status', args=[checkout.pk]))
+    assert 302 == response.status_code
+    expect = reverse(
+        'example.sales.ledger.checkout.success', args=[checkout.pk]
+    )
+    assert expect in response['Location']
+
+
+@pytest.mark.django_db
+def test_fail(client):
+    checkout = _checkout(client, CheckoutState.objects.fail)
+    response = client.get(reverse('checkout.status', args=[checkout.pk]))
+    assert 302 == response.status_code
+    assert reverse('checkout.list.audit') in response['Location']
+
+
+@pytest.mark.django_db
+def test_pending_timeout(client, settings):
+    """The payment is taking too long, so stop waiting."""
+    settings.CHECKOUT_ASYNC_TIMEOUT_SECONDS = 120
+    checkout = _checkout(client, CheckoutState.objects.pending, minutes=3)
+    response = client.get(reverse('checkout.status', args=[checkout.pk]))
+    assert 302 == response.status_code
+    assert reverse('checkout.list.audit') in response['Location']
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.fail == checkout.state
+
+
+@pytest.mark.django_db
+def test_pending_timeout_task_runs_later(client, mocker, settings):
+    """The task runs after we stopped waiting, so the card isn't charged."""
+    settings.CHECKOUT_ASYNC_TIMEOUT_SECONDS = 120
+    mock_charge = mocker.patch.object(StripeGateway, 'charge_create')
+    mock_customer = mocker.patch.object(StripeGateway, 'customer_create')
+    checkout = _checkout(client, CheckoutState.objects.pending, minutes=3)
+    response = client.get(reverse('checkout.status', args=[checkout.pk]))
+    assert 302 == response.status_code
+    assert Checkout.objects.process_checkout(checkout.pk, 'token') is None
+    assert 0 == mock_charge.call_count
+    assert 0 == mock_customer.call_count
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.fail == checkout.state
+
+
+@pytest.mark.django_db
+def test_request_timeout(client, settings):
+    """The task has asked Stripe for the money, so we can't fail it."""
+    settings.CHECKOUT_ASYNC_TIMEOUT_SECONDS = 120
+    checkout = _checkout(client, CheckoutState.objects.request, minutes=3)
+    response = client.get(reverse('checkout.status', args=[checkout.pk]))
+    assert 200 == response.status_code
+    assert response.context['timed_out'] is True
+    checkout.refresh_from_db()
+    assert CheckoutState.objects.request == checkout.state
+
+
+@pytest.mark.django_db
+def test_success_old(client):
+    """The success page checks the age of the checkout (not this view)."""
+    checkout = _checkout(client, CheckoutState.objects.success, minutes=20)
+    response = client.get(reverse('checkout.status', args=[checkout.pk]))
+    assert 302 == response.status_code
+    expect = reverse(
+        'example.sales.ledger.checkout.success', args=[checkout.pk]
+    )
+    assert expect in response['Location']
+
+
+@pytest.mark.django_db
+def test_permission(client):
+    checkout = _checkout(client, CheckoutState.objects.pending)
+    session = client.session
+    del session[CONTENT_OBJECT_PK]
+    session.save()
+    response = client.get(reverse('checkout.status', args=[checkout.pk]))
+    assert 403 == response.status_code